@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Union
 
 import torch
 from torch.nn import Module
@@ -49,21 +49,32 @@ class LogarithmicEqualizationModifier(SmoothQuantModifier):
       use the whole dataset
     :param calibration_function: optional function to use for the forward pass, or None
       to use the default tensor_module_forward
+    :param smoothing_strength_grid: optional list of candidate smoothing strengths in
+      [0, 1] to choose from for each mapping. A strength raises the logarithmic
+      equalization scales to its power, 1 being the full equalization. Leave None to
+      apply the full equalization to all mappings
     """
 
     def _calculate_smoothing_scales(
-        self, balance_layers: List[Module], activation_scales: torch.Tensor
-    ) -> List[float]:
+        self,
+        balance_layers: List[Module],
+        activation_scales: torch.Tensor,
+        smoothing_strength: Union[float, torch.Tensor, None] = None,
+    ) -> torch.Tensor:
         """
         Calculate how much smoothing to apply to each channel based on the dynamic
         range of the activations and the following weights.
 
         :param balance_layers: layers to offset activation smoothing to
         :param activation_scales: channel-wise dynamic range of activations to smooth
+        :param smoothing_strength: optional power to raise the scales to, a tensor of
+            shape (candidates, 1) calculates the scales of each candidate strength
         :return: channel-wise scales to use for smoothing activations
         """
         # calculate the amount of smoothing to apply
         # s_j = max(|X_j|) / log2( 2 + max(|X_j|) )
         # where j is the input channel
         scales = activation_scales / torch.log2(2 + activation_scales)
+        if smoothing_strength is not None:
+            scales = scales.pow(smoothing_strength)
         return scales
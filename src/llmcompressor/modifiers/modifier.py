@@ -221,6 +221,19 @@ class Modifier(ModifierInterface, HooksMixin):
 
         return self.end is not None and current >= self.end
 
+    def fuse_calibration(self, modifier: "Modifier") -> bool:
+        """
+        Called before the modifiers of a stage are initialized, with the modifier
+        initialized directly before this one. Modifiers which run calibration data
+        through the model can take over the calibration of that modifier, so that
+        both share a single pass over the calibration data
+
+        :param modifier: the modifier initialized directly before this one
+        :return: True if this modifier runs the calibration of the given modifier,
+            False otherwise
+        """
+        return False
+
     def on_initialize_structure(self, state: State, **kwargs):
         """
         on_initialize_structure is called before the model is initialized
@@ -10,12 +10,21 @@ from tqdm import tqdm
 from llmcompressor.core import State
 from llmcompressor.modifiers import Modifier
 from llmcompressor.modifiers.obcq.utils.sgpt_wrapper import SparseGptWrapper
+from llmcompressor.modifiers.utils.layer_checkpoint import (
+    LayerCheckpoint,
+    get_compression_fingerprint,
+)
 from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
-from llmcompressor.modifiers.utils.pytorch_helpers import run_calibration_forward
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    run_calibration_forward,
+    run_layer_forward,
+)
+from llmcompressor.utils.helpers import DisableKVCache
 from llmcompressor.utils.pytorch.module import (
     get_layers,
     get_no_split_params,
     get_prunable_layers,
+    get_sequential_layers,
 )
 
 __all__ = ["SparseGPTModifier"]
@@ -32,6 +41,7 @@ class SparseGPTModifier(Modifier):
                 - LayerCompressor.pre_compress()
             - apply_compression()
                 - run_calibration_forward()
+                - LayerCompressor.calibrate_layer()
                 - LayerCompressor.compress()
                 - LayerCompressor.post_compress()
                 - LayerCompressor.revert_layer_wrappers()
@@ -56,7 +66,10 @@ class SparseGPTModifier(Modifier):
         Must be of the form N:M where N, M are integers that define a custom block
         shape. Defaults to 0:0 which represents an unstructured mask.
     :param sequential_update: Whether or not to update weights sequentially by layer,
-        True saves on GPU memory
+        True saves on GPU memory and allows compression of earlier layers to affect
+        the calibration of later layers. If the targets are decoder layers, calibration
+        data is passed through the decoder layers one at a time. Otherwise, such as
+        when lm_head is targeted, each target is calibrated with a full forward pass
     :param targets: list of layer names to compress during OBCQ, or '__ALL__'
         to compress every layer in the model
     :param block_size: Used to determine number of columns to compress in one pass
@@ -65,6 +78,14 @@ class SparseGPTModifier(Modifier):
     :param preserve_sparsity_mask: Whether or not to preserve the sparsity mask
         during when applying sparsegpt, this becomes useful when starting from a
         previously pruned model, defaults to False.
+    :param checkpoint_dir: optional directory to save the compressed weights of each
+        layer to as they are compressed. If a run is interrupted, rerunning with the
+        same recipe, model and calibration dataset resumes compression from the first
+        unfinished layer. Only supported when sequential_update is True
+    :param max_hessian_tokens: optional maximum number of tokens of each calibration
+        batch to accumulate into the Hessian of each module. Larger batches are
+        randomly subsampled, which bounds the cost of calibrating on long sequences
+        at the expense of a noisier Hessian estimate
     """
 
     sparsity: Union[float, List[float]] = 0.0
@@ -77,12 +98,15 @@ class SparseGPTModifier(Modifier):
     block_size: int = 128
     dampening_frac: Optional[float] = 0.01
     preserve_sparsity_mask: bool = False
+    checkpoint_dir: Optional[str] = None
+    max_hessian_tokens: Optional[int] = None
 
     model: Optional[Any] = None
     layer_compressors_: Optional[List[Any]] = None
     prunen_: Optional[int] = None
     prunem_: Optional[int] = None
     compressible_layers_: Optional[List] = None
+    sequential_layers_: Optional[List] = None
 
     def on_initialize(self, state: "State", **kwargs) -> bool:
         """
@@ -145,12 +169,36 @@ class SparseGPTModifier(Modifier):
                 layer_sparsity = self.sparsity
             args = self._pruning_arguments(layer_sparsity)
             comp_cls = self._compression_class()
-            compressor = LayerCompressor(comp_cls, self.model, layer, idx, name, args)
+            compressor = LayerCompressor(
+                comp_cls,
+                self.model,
+                layer,
+                idx,
+                name,
+                args,
+                wrapper_args={"max_hessian_tokens": self.max_hessian_tokens},
+            )
             if not self.sequential_update:
                 # add all batch processing hooks before the forward pass
                 compressor.pre_compress()
             self.layer_compressors_.append(compressor)
 
+        self.sequential_layers_ = None
+        if self.sequential_update:
+            self.sequential_layers_ = get_sequential_layers(
+                self.model, [compressor.layer for compressor in self.layer_compressors_]
+            )
+            if self.sequential_layers_ is None:
+                logger.warning(
+                    "Targets are not a chain of sequential layers, such as decoder "
+                    "layers. Running a forward pass through the whole model to "
+                    "calibrate each target"
+                )
+            else:
+                # for the initial forward data pass, add an early stop exception in
+                # order to capture inputs right before being compressed by first module
+                self.layer_compressors_[0].set_early_stop()
+
     def compressible_layers(self) -> Dict:
         """
         Retrieves the modules corresponding to a list of
@@ -182,30 +230,92 @@ class SparseGPTModifier(Modifier):
             f"Running {class_name} calibration with "
             f"{len(dataloader) if dataloader else 0} samples..."
         )
-        if not self.sequential_update:
-            # in non-sequential mode we run one forward batch for all modules
-            run_calibration_forward(self.model, dataloader, mask_padding=True)
+        with DisableKVCache(self.model):
+            if not self.sequential_update:
+                # in non-sequential mode we run one forward batch for all modules
+                run_calibration_forward(self.model, dataloader, mask_padding=True)
 
-        num_layers = len(self.compressible_layers_)
-        for idx, layer_compressor in enumerate(self.layer_compressors_):
-            layer_sparsity = layer_compressor.args["sparsity"]
-            logger.info(
-                f"\n===== Compressing layer {idx+1}/{num_layers} "
-                f"to sparsity {layer_sparsity} ====="
-            )
+            # restore layers compressed by a previous, interrupted run
+            checkpoint = None
+            num_completed, intermediates = 0, None
+            if self.checkpoint_dir is not None:
+                if self.sequential_update:
+                    fingerprint = get_compression_fingerprint(
+                        self, self.model, dataloader
+                    )
+                    checkpoint = LayerCheckpoint(self.checkpoint_dir, fingerprint)
+                    num_completed, intermediates = checkpoint.load(
+                        self.layer_compressors_,
+                        load_intermediates=self.sequential_layers_ is not None,
+                    )
+                else:
+                    logger.warning(
+                        "Layer checkpointing is only supported with sequential_update="
+                        f"True, ignoring checkpoint_dir={self.checkpoint_dir}"
+                    )
+
+            if self.sequential_layers_ is not None:
+                if intermediates is None:
+                    # run_calibration_forward uses the early stop exception to capture
+                    # values as intermediates right before the forward pass of the
+                    # first module
+                    intermediates = run_calibration_forward(
+                        self.model, dataloader, mask_padding=True
+                    )
+                self.layer_compressors_[0].clear_early_stop()
+                layers = self.sequential_layers_
+            else:
+                layers = [compressor.layer for compressor in self.layer_compressors_]
+
+            # resume from the layer after the last completed one
+            start = 0
+            if num_completed > 0:
+                last_completed = self.layer_compressors_[num_completed - 1].layer
+                start = layers.index(last_completed) + 1
+
+            layer_compressors = {
+                compressor.layer: compressor for compressor in self.layer_compressors_
+            }
+            num_layers = len(self.compressible_layers_)
+            for layer in layers[start:]:
+                layer_compressor = layer_compressors.get(layer)
+                if layer_compressor is None:
+                    # layers between targets are not compressed, only calculate the
+                    # inputs to the next layer
+                    intermediates = run_layer_forward(layer, intermediates)
+                    continue
+
+                layer_sparsity = layer_compressor.args["sparsity"]
+                logger.info(
+                    f"\n===== Compressing layer {layer_compressor.layer_index+1}/"
+                    f"{num_layers} to sparsity {layer_sparsity} ====="
+                )
 
-            # Prune/quantize using SparseGPT
-            if self.sequential_update:
-                # in sequential mode we run one forward pass for each module we
-                # want to compress, this will be really slow but allows compression in
-                # earlier layers to affect later layers
-                layer_compressor.pre_compress()
-                logger.info(f"Calibrating {layer_compressor.name}...")
-                run_calibration_forward(self.model, dataloader, mask_padding=True)
-            layer_compressor.compress()
-            layer_compressor.post_compress()
-            layer_compressor.revert_layer_wrappers()
-            torch.cuda.empty_cache()
+                # Prune/quantize using SparseGPT
+                if self.sequential_update:
+                    # in sequential mode we calibrate each layer after the previous
+                    # ones are compressed, which allows compression in earlier layers
+                    # to affect later layers
+                    layer_compressor.pre_compress()
+                    logger.info(f"Calibrating {layer_compressor.name}...")
+                    if self.sequential_layers_ is not None:
+                        layer_compressor.calibrate_layer(intermediates)
+                    else:
+                        run_calibration_forward(
+                            self.model, dataloader, mask_padding=True
+                        )
+                layer_compressor.compress()
+                layer_compressor.post_compress()
+                layer_compressor.revert_layer_wrappers()
+
+                if self.sequential_layers_ is not None:
+                    # perform a second forward pass of the compressed layer to
+                    # calculate the inputs to the next layer
+                    intermediates = layer_compressor.calibrate_layer(intermediates)
+                torch.cuda.empty_cache()
+
+                if checkpoint is not None:
+                    checkpoint.save_layer(layer_compressor, intermediates)
 
     def _validate_layerwise_sparsity(self):
         if isinstance(self.sparsity, float):
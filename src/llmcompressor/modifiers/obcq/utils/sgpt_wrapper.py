@@ -1,8 +1,12 @@
 import time
+from typing import Optional
 
 from compressed_tensors.quantization.lifecycle.forward import forward_quantize
 
 from llmcompressor.modifiers.utils.compression_wrapper import ModuleCompressionWrapper
+from llmcompressor.modifiers.utils.distributed import all_reduce_sum
+from llmcompressor.modifiers.utils.hessian import accumulate_hessian, normalize_hessian
+from llmcompressor.modifiers.utils.pytorch_helpers import remove_padding
 from llmcompressor.utils import getattr_chain
 
 try:
@@ -11,7 +15,6 @@ except ImportError as err:
     transformers = None
     transformers_err = err
 
-import math
 
 import torch
 import torch.nn as nn
@@ -31,10 +34,21 @@ class SparseGptWrapper(ModuleCompressionWrapper):
 
     :param name: name of module to run compression on
     :param layer: module to run compression on
+    :param max_hessian_tokens: optional maximum number of tokens of each calibration
+        batch to accumulate into the Hessian, larger batches are randomly subsampled
+    :param hessian_sampling_seed: seed of the random subsampling of tokens
     """
 
-    def __init__(self, name, layer):
+    def __init__(
+        self,
+        name,
+        layer,
+        max_hessian_tokens: Optional[int] = None,
+        hessian_sampling_seed: int = 0,
+    ):
         super().__init__(name=name, layer=layer)
+        self.max_hessian_tokens = max_hessian_tokens
+        self._hessian_generator = torch.Generator().manual_seed(hessian_sampling_seed)
 
         # for Hessian calculation
         self.register_buffer(
@@ -44,27 +58,47 @@ class SparseGptWrapper(ModuleCompressionWrapper):
             ),
         )
 
-    def add_batch(self, inp: torch.Tensor, out: torch.Tensor):
+    def add_batch(
+        self,
+        inp: torch.Tensor,
+        out: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ):
         """
         Add a batch of layer input and output data to the Hessian calculation
 
         :param inp: tensor containing layer input
         :param out: tensor containing layer output
+        :param attention_mask: optional attention mask of the calibration batch, padding
+            tokens are excluded from the Hessian
         """
         if len(inp.shape) == 2:
+            # tokens without a batch dimension, such as the inputs of an expert, are
+            # not aligned with the attention mask
             inp = inp.unsqueeze(0)
+            attention_mask = None
         tmp = inp.shape[0]
+        inp = remove_padding(inp, attention_mask)
         if isinstance(self.layer, nn.Linear) or isinstance(
             self.layer, transformers.Conv1D
         ):
-            if len(inp.shape) == 3:
-                inp = inp.reshape((-1, inp.shape[-1]))
-            inp = inp.t()
-        self.H *= self.nsamples / (self.nsamples + tmp)
+            inp = inp.reshape((-1, inp.shape[-1]))
+
+        # normalization by the number of samples is deferred to compression
+        accumulate_hessian(
+            self.H,
+            inp,
+            self.max_hessian_tokens,
+            generator=self._hessian_generator,
+        )
         self.nsamples += tmp
-        inp = inp.to(dtype=self.H.dtype)
-        inp = math.sqrt(2 / self.nsamples) * inp
-        self.H += inp.matmul(inp.t()).to(self.dev)
+
+    def all_reduce_statistics(self):
+        """
+        Sum the unnormalized Hessians and sample counts accumulated by each rank
+        """
+        all_reduce_sum(self.H)
+        all_reduce_sum(self.nsamples)
 
     def compress(
         self,
@@ -103,6 +137,7 @@ class SparseGptWrapper(ModuleCompressionWrapper):
 
         tick = time.time()
 
+        normalize_hessian(self.H, self.nsamples)
         dead = torch.diag(self.H) == 0
         self.H[dead, dead] = 1
         W[:, dead] = 0
@@ -11,11 +11,16 @@ from llmcompressor.core import State
 from llmcompressor.modifiers import Modifier
 from llmcompressor.modifiers.pruning.wanda.utils.wanda_wrapper import WandaWrapper
 from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
-from llmcompressor.modifiers.utils.pytorch_helpers import run_calibration_forward
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    run_calibration_forward,
+    run_layer_forward,
+)
+from llmcompressor.utils.helpers import DisableKVCache
 from llmcompressor.utils.pytorch.module import (
     get_layers,
     get_no_split_params,
     get_prunable_layers,
+    get_sequential_layers,
 )
 
 __all__ = ["WandaPruningModifier"]
@@ -33,6 +38,7 @@ class WandaPruningModifier(Modifier):
                 - LayerCompressor.pre_compress()
             - apply_compression()
                 - run_calibration_forward()
+                - LayerCompressor.calibrate_layer()
                 - LayerCompressor.compress()
                 - LayerCompressor.post_compress()
                 - LayerCompressor.revert_layer_wrappers()
@@ -43,7 +49,10 @@ class WandaPruningModifier(Modifier):
         Must be of the form N:M where N, M are integers that define a custom block
         shape. Defaults to 0:0 which represents an unstructured mask.
     :param sequential_update: Whether or not to update weights sequentially by layer,
-        True saves on GPU memory
+        True saves on GPU memory and allows compression of earlier layers to affect
+        the calibration of later layers. If the targets are decoder layers, calibration
+        data is passed through the decoder layers one at a time. Otherwise, such as
+        when lm_head is targeted, each target is calibrated with a full forward pass
     :param targets: list of layer names to compress during OBCQ, or '__ALL__'
         to compress every layer in the model
     """
@@ -59,6 +68,7 @@ class WandaPruningModifier(Modifier):
     layer_compressors_: List = None
 
     compressible_layers_: Optional[List] = None
+    sequential_layers_: Optional[List] = None
     prunen_: Optional[int] = None
     prunem_: Optional[int] = None
 
@@ -142,6 +152,22 @@ class WandaPruningModifier(Modifier):
                 compressor.pre_compress()
             self.layer_compressors_.append(compressor)
 
+        self.sequential_layers_ = None
+        if self.sequential_update:
+            self.sequential_layers_ = get_sequential_layers(
+                self.model, [compressor.layer for compressor in self.layer_compressors_]
+            )
+            if self.sequential_layers_ is None:
+                logger.warning(
+                    "Targets are not a chain of sequential layers, such as decoder "
+                    "layers. Running a forward pass through the whole model to "
+                    "calibrate each target"
+                )
+            else:
+                # for the initial forward data pass, add an early stop exception in
+                # order to capture inputs right before being compressed by first module
+                self.layer_compressors_[0].set_early_stop()
+
     @torch.no_grad()
     def apply_compression(
         self, dataloader: Optional[Iterable[Tuple[List, Dict[str, Any]]]] = None
@@ -155,30 +181,64 @@ class WandaPruningModifier(Modifier):
         logger.info(
             f"Running {class_name} calibration with " f"{len(dataloader)} samples..."
         )
-        if not self.sequential_update:
-            # in non-sequential mode we run one forward batch for all modules
-            run_calibration_forward(self.model, dataloader, mask_padding=True)
-
-        num_layers = len(self.compressible_layers_)
-        for idx, layer_compressor in enumerate(self.layer_compressors_):
-            layer_sparsity = layer_compressor.args["sparsity"]
-            logger.info(
-                f"\n===== Compressing layer {idx+1}/{num_layers} "
-                f"to sparsity {layer_sparsity} ====="
-            )
-
-            # Prune/quantize using the layer compressor
-            if self.sequential_update:
-                # in sequential mode we run one forward pass for each module we
-                # want to compress, this will be really slow but allows compression in
-                # earlier layers to affect later layers
-                layer_compressor.pre_compress()
-                logger.info(f"Calibrating {layer_compressor.name}...")
+        with DisableKVCache(self.model):
+            intermediates = None
+            if not self.sequential_update:
+                # in non-sequential mode we run one forward batch for all modules
                 run_calibration_forward(self.model, dataloader, mask_padding=True)
-            layer_compressor.compress()
-            layer_compressor.post_compress()
-            layer_compressor.revert_layer_wrappers()
-            torch.cuda.empty_cache()
+                layers = [compressor.layer for compressor in self.layer_compressors_]
+            elif self.sequential_layers_ is not None:
+                # run_calibration_forward uses the early stop exception to capture
+                # values as intermediates right before the forward pass of the first
+                # module
+                intermediates = run_calibration_forward(
+                    self.model, dataloader, mask_padding=True
+                )
+                self.layer_compressors_[0].clear_early_stop()
+                layers = self.sequential_layers_
+            else:
+                layers = [compressor.layer for compressor in self.layer_compressors_]
+
+            layer_compressors = {
+                compressor.layer: compressor for compressor in self.layer_compressors_
+            }
+            num_layers = len(self.compressible_layers_)
+            for layer in layers:
+                layer_compressor = layer_compressors.get(layer)
+                if layer_compressor is None:
+                    # layers between targets are not compressed, only calculate the
+                    # inputs to the next layer
+                    intermediates = run_layer_forward(layer, intermediates)
+                    continue
+
+                layer_sparsity = layer_compressor.args["sparsity"]
+                logger.info(
+                    f"\n===== Compressing layer {layer_compressor.layer_index+1}/"
+                    f"{num_layers} to sparsity {layer_sparsity} ====="
+                )
+
+                # Prune/quantize using the layer compressor
+                if self.sequential_update:
+                    # in sequential mode we calibrate each layer after the previous
+                    # ones are compressed, which allows compression in earlier layers
+                    # to affect later layers
+                    layer_compressor.pre_compress()
+                    logger.info(f"Calibrating {layer_compressor.name}...")
+                    if self.sequential_layers_ is not None:
+                        layer_compressor.calibrate_layer(intermediates)
+                    else:
+                        run_calibration_forward(
+                            self.model, dataloader, mask_padding=True
+                        )
+                layer_compressor.compress()
+                layer_compressor.post_compress()
+                layer_compressor.revert_layer_wrappers()
+
+                if self.sequential_layers_ is not None:
+                    # perform a second forward pass of the compressed layer to
+                    # calculate the inputs to the next layer
+                    intermediates = layer_compressor.calibrate_layer(intermediates)
+                torch.cuda.empty_cache()
 
     def _validate_layerwise_sparsity(self):
         if isinstance(self.sparsity, float):
@@ -1,10 +1,12 @@
 import time
+from typing import Optional
 
 import torch
 import torch.nn as nn
 from loguru import logger
 
 from llmcompressor.modifiers.utils.compression_wrapper import ModuleCompressionWrapper
+from llmcompressor.modifiers.utils.pytorch_helpers import remove_padding
 
 try:
     import transformers
@@ -40,16 +42,27 @@ class WandaWrapper(ModuleCompressionWrapper):
         super().__init__(name=name, layer=layer)
         self.register_buffer("scaler_row", torch.zeros(self.columns, device=self.dev))
 
-    def add_batch(self, inp: torch.Tensor, out: torch.Tensor):
+    def add_batch(
+        self,
+        inp: torch.Tensor,
+        out: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ):
         """
         Add a batch of layer input and output data to the layer statistics calculation
 
         :param inp: tensor containing layer input
         :param out: tensor containing layer output
+        :param attention_mask: optional attention mask of the calibration batch, padding
+            tokens are excluded from the layer statistics
         """
         if len(inp.shape) == 2:
+            # tokens without a batch dimension, such as the inputs of an expert, are
+            # not aligned with the attention mask
             inp = inp.unsqueeze(0)
+            attention_mask = None
         batch_size = inp.shape[0]
+        inp = remove_padding(inp, attention_mask)
         if isinstance(self.layer, nn.Linear):
             if len(inp.shape) == 3:
                 inp = inp.reshape((-1, inp.shape[-1]))
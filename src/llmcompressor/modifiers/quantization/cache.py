@@ -16,7 +16,10 @@
 from typing import Any, Dict, List, Optional, Tuple
 
 from compressed_tensors.quantization.lifecycle import KVCacheScaleType
-from compressed_tensors.quantization.quant_args import QuantizationArgs
+from compressed_tensors.quantization.quant_args import (
+    QuantizationArgs,
+    QuantizationStrategy,
+)
 from torch import Tensor
 from transformers import DynamicCache
 
@@ -32,6 +35,12 @@ class QuantizedKVParameterCache(DynamicCache):
      gets called appropriately.
     The size of tensor is
      `[batch_size, num_heads, seq_len - residual_length, head_dim]`.
+    With the channel strategy, there is a scale for each attention head.
+
+    When observe_only is set, .update() only updates the observers and returns the
+    unquantized key_states and value_states, so calibration does not run full tensor
+    quantization and dequantization passes. The scales are fetched once calibration
+    is complete with .get_scales()
 
 
     Triggered by adding kv_cache_scheme in the recipe.
@@ -62,7 +71,9 @@ class QuantizedKVParameterCache(DynamicCache):
             cls._instance = super(QuantizedKVParameterCache, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, quantization_args: QuantizationArgs):
+    def __init__(self, quantization_args: QuantizationArgs, observe_only: bool = False):
+        self.observe_only = observe_only
+
         if not self._initialized:
             super().__init__()
 
@@ -89,7 +100,8 @@ class QuantizedKVParameterCache(DynamicCache):
     ) -> Tuple[Tensor, Tensor]:
         """
         Get the k_scale and v_scale and output the
-         fakequant-ed key_states and value_states
+         fakequant-ed key_states and value_states, or the unquantized
+         key_states and value_states if observe_only is set
         """
 
         if len(self.k_observers) <= layer_idx:
@@ -105,6 +117,11 @@ class QuantizedKVParameterCache(DynamicCache):
             self.k_observers.append(k_observer)
             self.v_observers.append(v_observer)
 
+        if self.observe_only:
+            self._observe(key_states, KVCacheScaleType.KEY, layer_idx)
+            self._observe(value_states, KVCacheScaleType.VALUE, layer_idx)
+            return key_states, value_states
+
         q_key_states = self._quantize(
             key_states.contiguous(), KVCacheScaleType.KEY, layer_idx
         )
@@ -121,6 +138,27 @@ class QuantizedKVParameterCache(DynamicCache):
 
         return keys_to_return, values_to_return
 
+    def get_scales(self, layer_idx: int) -> Tuple[Tensor, Tensor]:
+        """
+        Get the k_scale and v_scale of an attention layer, flattened to one scale per
+        tensor or attention head. Observers which derive final scales from their
+        accumulated statistics take precedence over the latest observed scales
+
+        :param layer_idx: index of the attention layer
+        :return: tuple of k_scale and v_scale
+        """
+        k_scale = self.k_scales[layer_idx]
+        v_scale = self.v_scales[layer_idx]
+
+        k_qparams = self.k_observers[layer_idx].get_final_qparams()
+        if k_qparams is not None:
+            k_scale = k_qparams[0]
+        v_qparams = self.v_observers[layer_idx].get_final_qparams()
+        if v_qparams is not None:
+            v_scale = v_qparams[0]
+
+        return k_scale.reshape(-1), v_scale.reshape(-1)
+
     def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
         """
         Returns the sequence length of the cached states.
@@ -155,6 +193,18 @@ class QuantizedKVParameterCache(DynamicCache):
         """Quantizes a key/value using a defined quantization method."""
         from compressed_tensors.quantization.lifecycle.forward import quantize
 
+        scale, zp = self._observe(tensor, kv_type, layer_idx)
+
+        q_tensor = quantize(
+            x=tensor,
+            scale=scale,
+            zero_point=zp,
+            args=self.quantization_args,
+        )
+        return q_tensor
+
+    def _observe(self, tensor, kv_type, layer_idx):
+        """Updates the observer of a key/value and stores its latest scale and zp"""
         if kv_type == KVCacheScaleType.KEY:  # key type
             observer = self.k_observers[layer_idx]
             scales = self.k_scales
@@ -165,21 +215,20 @@ class QuantizedKVParameterCache(DynamicCache):
             scales = self.v_scales
             zps = self.v_zps
 
-        scale, zp = observer(tensor)
+        if self.quantization_args.strategy == QuantizationStrategy.CHANNEL:
+            # one scale per attention head, the second dimension of the states
+            scale, zp = observer.get_qparams_along_dim(tensor, dim=1)
+        else:
+            scale, zp = observer(tensor)
+
         if len(scales) <= layer_idx:
             scales.append(scale)
             zps.append(zp)
         else:
             scales[layer_idx] = scale
-            zps[layer_idx] = scale
+            zps[layer_idx] = zp
 
-        q_tensor = quantize(
-            x=tensor,
-            scale=scale,
-            zero_point=zp,
-            args=self.quantization_args,
-        )
-        return q_tensor
+        return scale, zp
 
     def _dequantize(self, qtensor, kv_type, layer_idx):
         """Dequantizes back the tensor that was quantized by `self._quantize()`"""
@@ -1,25 +1,43 @@
 from typing import Any, Dict, Optional, Tuple
 
 import torch
-from compressed_tensors.quantization import QuantizationStatus, is_attention_module
+from compressed_tensors.quantization import (
+    QuantizationStatus,
+    QuantizationStrategy,
+    is_attention_module,
+)
 from compressed_tensors.quantization.lifecycle.forward import forward_quantize
+from compressed_tensors.quantization.lifecycle.helpers import (
+    disable_quantization,
+    enable_quantization,
+)
 from compressed_tensors.quantization.utils import is_kv_cache_quant_scheme
 from compressed_tensors.utils.offload import is_module_offloaded, update_parameter_data
 from loguru import logger
 from torch.nn import Module
 
 from llmcompressor.modifiers.quantization.cache import QuantizedKVParameterCache
-from llmcompressor.observers import Observer
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    get_calibration_attention_mask,
+    remove_padding,
+)
+from llmcompressor.observers import Observer, TokenSampler
 
 __all__ = [
     "initialize_observer",
     "update_weight_zp_scale",
     "calibrate_input_hook",
     "calibrate_output_hook",
+    "observe_input_hook",
+    "observe_output_hook",
+    "defer_calibration",
+    "apply_deferred_calibration",
     "calibrate_kv_cache_input_hook",
     "calibrate_kv_cache_output_hook",
     "set_unset_kv_cache",
+    "update_kv_cache_scales",
     "freeze_module_quantization",
+    "update_final_qparams",
     "apply_calibration_status",
 ]
 
@@ -59,7 +77,12 @@ def initialize_observer(
         module.register_module(f"{base_name}_observer", observer)
 
 
-def call_observer(module: Module, base_name: str, value: Optional[torch.Tensor] = None):
+def call_observer(
+    module: Module,
+    base_name: str,
+    value: Optional[torch.Tensor] = None,
+    record_tokens: bool = True,
+):
     """
     Call a module's attached input/weight/output observer using a provided value.
     Update the module's scale and zp using the observer's return values.
@@ -68,6 +91,7 @@ def call_observer(module: Module, base_name: str, value: Optional[torch.Tensor]
     :param base_name: substring used to fetch the observer, scales, and zp
     :param value: torch.Tensor to be passed to the observer for activations. If
         base_name is "weight", then the module's weight tensor will be used
+    :param record_tokens: whether the observer counts the observed tokens
     """
     offloaded = is_module_offloaded(module)
     if offloaded:
@@ -82,7 +106,9 @@ def call_observer(module: Module, base_name: str, value: Optional[torch.Tensor]
         raise ValueError("Must provide a value to observe if not using weight observer")
 
     observer = getattr(module, f"{base_name}_observer")
-    updated_scale, updated_zero_point = observer(value, g_idx=g_idx)
+    updated_scale, updated_zero_point = observer(
+        value, g_idx=g_idx, record_tokens=record_tokens
+    )
 
     # update scale and zero point
     update_parameter_data(module, updated_scale, f"{base_name}_scale")
@@ -92,6 +118,35 @@ def call_observer(module: Module, base_name: str, value: Optional[torch.Tensor]
         module._hf_hook.post_forward(module, None)
 
 
+def update_final_qparams(module: Module, base_name: str, deferred: bool = False):
+    """
+    Update a module's scale and zp with the final values of its attached observer,
+    for observers which derive them from statistics accumulated during calibration
+
+    :param module: torch.nn.Module
+    :param base_name: substring used to fetch the observer, scales, and zp
+    :param deferred: if True, the observer was only called to accumulate statistics
+        and its latest scale and zp are written when it has no final values
+    """
+    observer = getattr(module, f"{base_name}_observer")
+    final_qparams = observer.get_final_qparams()
+    if final_qparams is None and deferred:
+        final_qparams = observer.get_qparams()
+    if final_qparams is None or final_qparams[0] is None:
+        return
+
+    offloaded = is_module_offloaded(module)
+    if offloaded:
+        module._hf_hook.pre_forward(module)
+
+    scale, zero_point = final_qparams
+    update_parameter_data(module, scale, f"{base_name}_scale")
+    update_parameter_data(module, zero_point, f"{base_name}_zero_point")
+
+    if offloaded:
+        module._hf_hook.post_forward(module, None)
+
+
 def update_weight_zp_scale(module: Module):
     """
     marks a layer as ready for calibration which activates observers
@@ -124,7 +179,13 @@ def update_weight_zp_scale(module: Module):
         call_observer(module=module, base_name="weight")
 
 
-def calibrate_activations(module: Module, value: torch.Tensor, base_name: str):
+def calibrate_activations(
+    module: Module,
+    value: torch.Tensor,
+    base_name: str,
+    deferred: bool = False,
+    token_sampler: Optional[TokenSampler] = None,
+):
     """
     Calibrate input or output activations by calling the a module's attached
     observer.
@@ -132,31 +193,64 @@ def calibrate_activations(module: Module, value: torch.Tensor, base_name: str):
     :param module: torch.nn.Module
     :param base_name: substring used to fetch the observer, scales, and zp
     :param value: torch.Tensor to be passed to the observer
-
+    :param deferred: if True, only update the statistics of the observer on the
+        device of the activations. The scale and zp are written to the module once
+        calibration is complete, see `apply_deferred_calibration`
+    :param token_sampler: optional sampler of the tokens passed to the observer, only
+        applied to per-tensor quantization
     """
     # If empty tensor, can't update zp/scale
     # Case for MoEs
     if value.numel() == 0:
         return
 
+    # exclude padding tokens from the observed statistics
+    value = remove_padding(value, get_calibration_attention_mask())
+
+    observer = getattr(module, f"{base_name}_observer")
+    record_tokens = True
+    if (
+        token_sampler is not None
+        and observer.quantization_args.strategy == QuantizationStrategy.TENSOR
+    ):
+        # all tokens are counted, so that the token distribution check of mixture
+        # of experts models is not affected by sampling
+        observer.record_observed_tokens(value)
+        record_tokens = False
+        value = token_sampler(value)
+
+    if deferred:
+        observer(value, record_tokens=record_tokens)
+        return
+
     call_observer(
         module=module,
         base_name=base_name,
         value=value,
+        record_tokens=record_tokens,
     )
 
 
-def calibrate_input_hook(module: Module, args: Any):
+def calibrate_input_hook(
+    module: Module, args: Any, token_sampler: Optional[TokenSampler] = None
+):
     """
     Hook to calibrate input activations.
     Will call the observers to update the scales/zp before applying
     input QDQ in the module's forward pass.
     """
     args = args[0] if isinstance(args, tuple) else args
-    calibrate_activations(module, value=args, base_name="input")
+    calibrate_activations(
+        module, value=args, base_name="input", token_sampler=token_sampler
+    )
 
 
-def calibrate_output_hook(module: Module, _args: Any, output: torch.Tensor):
+def calibrate_output_hook(
+    module: Module,
+    _args: Any,
+    output: torch.Tensor,
+    token_sampler: Optional[TokenSampler] = None,
+):
     """
     Hook to calibrate output activations.
     Will call the observers to update the scales/zp before applying
@@ -166,6 +260,7 @@ def calibrate_output_hook(module: Module, _args: Any, output: torch.Tensor):
         module,
         value=output,
         base_name="output",
+        token_sampler=token_sampler,
     )
     output = forward_quantize(
         module=module,
@@ -176,6 +271,84 @@ def calibrate_output_hook(module: Module, _args: Any, output: torch.Tensor):
     return output
 
 
+def observe_input_hook(
+    module: Module, args: Any, token_sampler: Optional[TokenSampler] = None
+):
+    """
+    Hook to accumulate input activation statistics for deferred calibration.
+    Scales/zp are not updated and input QDQ is not applied, as quantization of the
+    module is disabled by `defer_calibration` until `apply_deferred_calibration`
+    """
+    args = args[0] if isinstance(args, tuple) else args
+    calibrate_activations(
+        module,
+        value=args,
+        base_name="input",
+        deferred=True,
+        token_sampler=token_sampler,
+    )
+
+
+def observe_output_hook(
+    module: Module,
+    _args: Any,
+    output: torch.Tensor,
+    token_sampler: Optional[TokenSampler] = None,
+):
+    """
+    Hook to accumulate output activation statistics for deferred calibration.
+    Scales/zp are not updated and output QDQ is not applied, as quantization of the
+    module is disabled by `defer_calibration` until `apply_deferred_calibration`
+    """
+    calibrate_activations(
+        module,
+        value=output,
+        base_name="output",
+        deferred=True,
+        token_sampler=token_sampler,
+    )
+
+
+def defer_calibration(module: Module):
+    """
+    Disable quantization of a module calibrated with deferred calibration hooks and
+    mark it, so that `apply_deferred_calibration` writes its scales and zero points
+    and re-enables its quantization
+
+    :param module: module calibrated with observe_input_hook or observe_output_hook
+    """
+    disable_quantization(module)
+    module._deferred_calibration = True
+
+
+def apply_deferred_calibration(module: Module):
+    """
+    Write the scales and zero points of activations observed with deferred
+    calibration hooks and re-enable quantization of the module. For attention
+    modules calibrated with an observe_only kv_cache, write the k_scale and v_scale.
+
+    apply to full model with `model.apply(apply_deferred_calibration)`
+
+    :param module: module to apply deferred calibration to
+    """
+    kv_cache = getattr(module, "kv_cache", None)
+    if kv_cache is not None and kv_cache.observe_only:
+        if len(kv_cache.k_scales) > module.layer_idx:
+            update_kv_cache_scales(module)
+        return
+
+    if not getattr(module, "_deferred_calibration", False):
+        # not calibrated with deferred hooks, nothing to do
+        return
+
+    del module._deferred_calibration
+    for name in ("input", "output"):
+        if hasattr(module, f"{name}_observer"):
+            update_final_qparams(module, name, deferred=True)
+
+    enable_quantization(module)
+
+
 def calibrate_kv_cache_input_hook(
     module: Module, args: Any, kwargs: Dict[str, Any]
 ) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
@@ -195,21 +368,45 @@ def calibrate_kv_cache_output_hook(module: Module, _args: Any, _output: torch.Te
     Hook to update k_scale and v_scale parameters when running kv_cache quantization.
     """
     kv_cache = getattr(module, "kv_cache")
-    update_parameter_data(module, kv_cache.k_scales[module.layer_idx], "k_scale")
-    update_parameter_data(module, kv_cache.v_scales[module.layer_idx], "v_scale")
+    k_scale, v_scale = kv_cache.get_scales(module.layer_idx)
+    update_parameter_data(module, k_scale, "k_scale")
+    update_parameter_data(module, v_scale, "v_scale")
+
+
+def update_kv_cache_scales(module: Module):
+    """
+    Update the k_scale and v_scale parameters of an attention module with the
+    scales observed by its kv_cache
 
+    :param module: attention module with an attached kv_cache
+    """
+    offloaded = is_module_offloaded(module)
+    if offloaded:
+        module._hf_hook.pre_forward(module)
+
+    k_scale, v_scale = module.kv_cache.get_scales(module.layer_idx)
+    update_parameter_data(module, k_scale, "k_scale")
+    update_parameter_data(module, v_scale, "v_scale")
 
-def set_unset_kv_cache(module: Module):
+    if offloaded:
+        module._hf_hook.post_forward(module, None)
+
+
+def set_unset_kv_cache(module: Module, observe_only: bool = False):
     """
     Set or unset singleton QuantizedKVParameterCache for each
     attn module when running kv_cache quantization.
+
+    :param module: module to set or unset the kv_cache of
+    :param observe_only: if True, the kv_cache only observes keys and values
+        without quantizing them, see `apply_deferred_calibration`
     """
     if not hasattr(module, "quantization_scheme"):
         return
 
     if is_kv_cache_quant_scheme(module.quantization_scheme):
         output_args = module.quantization_scheme.output_activations
-        kv_cache = QuantizedKVParameterCache(output_args)
+        kv_cache = QuantizedKVParameterCache(output_args, observe_only=observe_only)
         if hasattr(module, "kv_cache"):
             delattr(module, "kv_cache")
         else:
@@ -244,6 +441,7 @@ def freeze_module_quantization(module: Module):
     for name in ("input", "weight", "output"):
         obs_name = f"{name}_observer"
         if hasattr(module, obs_name):
+            update_final_qparams(module, name)
             delattr(module, obs_name)
 
     module.quantization_status = QuantizationStatus.FROZEN
@@ -13,11 +13,24 @@ from torch.nn import Module
 
 from llmcompressor.core import State
 from llmcompressor.modifiers import Modifier, ModifierFactory
-from llmcompressor.modifiers.quantization.calibration import freeze_module_quantization
+from llmcompressor.modifiers.quantization.calibration import (
+    call_observer,
+    freeze_module_quantization,
+)
 from llmcompressor.modifiers.quantization.gptq.utils import (
     GPTQWrapper,
     get_output_error,
 )
+from llmcompressor.modifiers.smoothquant import SmoothQuantModifier
+from llmcompressor.modifiers.utils.distributed import (
+    shard_dataloader,
+    validate_data_parallel,
+)
+from llmcompressor.modifiers.utils.intermediates_cache import IntermediatesCache
+from llmcompressor.modifiers.utils.layer_checkpoint import (
+    LayerCheckpoint,
+    get_compression_fingerprint,
+)
 from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
 from llmcompressor.modifiers.utils.pytorch_helpers import run_calibration_forward
 from llmcompressor.utils.fsdp.context import fix_fsdp_module_name
@@ -42,6 +55,7 @@ class GPTQModifier(Modifier):
                 - LayerCompressor.pre_compress()
             - apply_compression()
                 - run_calibration_forward()
+                - SmoothQuantModifier.smooth_layer(), if calibration is fused
                 - LayerCompressor.compress()
                 - LayerCompressor.post_compress()
                 - LayerCompressor.revert_layer_wrappers()
@@ -76,6 +90,10 @@ class GPTQModifier(Modifier):
         already exist in the recipe
     :param dampening_frac: Amount of dampening to apply to H, as a fraction of the
         diagonal norm
+    :param max_dampening_frac: If a dampened Hessian cannot be inverted, the dampening
+        is doubled until it reaches this ceiling. If the Hessian still cannot be
+        inverted, its eigenvalues are clamped to this fraction of the diagonal mean
+        instead. The dampening used for each module is recorded in `dampening_fracs_`
     :param config_groups: [Used, if a quantization modifier is not specified],
         dictionary specifying quantization schemes to apply to target
         modules. Modules not matching a scheme target will NOT be quantized.
@@ -88,6 +106,17 @@ class GPTQModifier(Modifier):
         not be updated. Leave None to not disable observers during QAT. Default is None
     :param num_calibration_steps: Number of steps to run post training calibration for.
         When None, the entire calibration_dataloader is used
+    :param deferred_calibration: [Used, if a quantization modifier is not specified],
+        if True, activation scales and zero points are written once per module after
+        calibration rather than on every batch
+    :param token_sample_rate: [Used, if a quantization modifier is not specified],
+        optional fraction of the tokens of each calibration batch passed to the
+        observers of per-tensor activations
+    :param max_observed_tokens: [Used, if a quantization modifier is not specified],
+        optional maximum number of tokens of each calibration batch passed to the
+        observers of each per-tensor activation
+    :param token_sampling_seed: [Used, if a quantization modifier is not specified],
+        seed of the random sampling of observed tokens. Default is 0
     :param scheme: [Used, if a quantization modifier is not specified], the quantization
         scheme to apply to the model, this is a dictionary that supports all keys from
         QuantizationScheme except targets, which will be set to the targets parameter
@@ -95,6 +124,41 @@ class GPTQModifier(Modifier):
         `preset_scheme_name: targets` for example: `W8A8: ['Linear']` for weight 8 bit
         or a string of a preset scheme if targets is provided
         and activation 8 bit quantization on the Linear layers.
+    :param checkpoint_dir: optional directory to save the compressed weights and
+        quantization parameters of each layer to as they are compressed. If a run is
+        interrupted, rerunning with the same recipe, model and calibration dataset
+        resumes compression from the first unfinished layer
+    :param intermediates_dtype: optional dtype to store the calibration inputs to each
+        layer in, for example "bfloat16". Defaults to the dtype of the model
+    :param intermediates_max_memory: optional number of bytes of cpu memory to use for
+        storing the calibration inputs to each layer. Inputs beyond this budget are
+        stored in memory-mapped files in intermediates_offload_dir
+    :param intermediates_offload_dir: optional directory to write the memory-mapped
+        calibration inputs to, such as a fast local disk. Defaults to the system
+        temporary directory
+    :param max_hessian_tokens: optional maximum number of tokens of each calibration
+        batch to accumulate into the Hessian of each module. Larger batches are
+        randomly subsampled, which bounds the cost of calibrating on long sequences
+        at the expense of a noisier Hessian estimate
+    :param data_parallel: Set to True to calibrate using multiple processes, for
+        example launched with torchrun. Each rank of the initialized torch.distributed
+        process group calibrates on a shard of the calibration data, Hessians are
+        summed across ranks and rank 0 compresses each module, broadcasting the
+        results to the other ranks. Not supported together with checkpoint_dir
+    :param expert_batch_size: optional maximum number of experts of a mixture of
+        experts layer to compress at once. The Hessians of the same module of each
+        expert, such as `experts.*.w1`, are stacked and inverted together, and the
+        column updates of GPTQ are batched across experts. Experts using activation
+        ordering are compressed one at a time
+    :param fused_calibration: when directly preceded by a SmoothQuantModifier in the
+        same stage, collect its activation ranges during the layer by layer
+        calibration pass of GPTQ instead of a separate pass over the calibration
+        data. Each layer is smoothed before it is compressed. Statically quantized
+        activations are then calibrated in the same pass. Falls back to separate
+        passes if a smoothed or calibrated activation is not within a single
+        sequential layer. Later layers are smoothed by the ranges of their quantized
+        rather than original inputs, so results differ slightly from separate passes.
+        Default is False, the smoothing calibration runs its own pass
     """
 
     sequential_update: bool = True  # DEPRECIATED
@@ -103,16 +167,31 @@ class GPTQModifier(Modifier):
     block_size: int = 128
     quantize: Union[bool, Dict] = True
     dampening_frac: Optional[float] = 0.01
+    max_dampening_frac: float = 1.0
     config_groups: Optional[Dict[str, QuantizationScheme]] = None
     ignore: List[str] = Field(default_factory=list)
     disable_quantization_observer_epoch: Optional[float] = None
     num_calibration_steps: Optional[int] = None
+    deferred_calibration: bool = False
+    token_sample_rate: Optional[float] = None
+    max_observed_tokens: Optional[int] = None
+    token_sampling_seed: int = 0
     scheme: Optional[Union[str, Dict[str, Any]]] = None
+    checkpoint_dir: Optional[str] = None
+    intermediates_dtype: Optional[str] = None
+    intermediates_max_memory: Optional[int] = None
+    intermediates_offload_dir: Optional[str] = None
+    max_hessian_tokens: Optional[int] = None
+    data_parallel: bool = False
+    expert_batch_size: Optional[int] = None
+    fused_calibration: bool = False
 
     model: Optional[Any] = None
     layer_compressors_: Optional[List[Any]] = None
     compressible_layers_: Optional[List] = None
     quantization_modifier_: Any = None
+    smoothing_modifier_: Any = None
+    dampening_fracs_: Dict[str, float] = Field(default_factory=dict)
 
     @field_validator("sequential_update", mode="before")
     def validate_sequential_update(cls, value: bool) -> bool:
@@ -178,6 +257,28 @@ class GPTQModifier(Modifier):
         if self.quantization_modifier_:
             self.quantization_modifier_.on_initialize_structure(state, **kwargs)
 
+    def fuse_calibration(self, modifier: Modifier) -> bool:
+        """
+        Run the calibration of a directly preceding SmoothQuantModifier as part of the
+        layer by layer calibration pass of GPTQ
+
+        :param modifier: the modifier initialized directly before this one
+        :return: True if the calibration of the modifier is run by GPTQ
+        """
+        if (
+            not self.fused_calibration
+            or not isinstance(modifier, SmoothQuantModifier)
+            or modifier.num_calibration_steps is not None
+            or modifier.calibration_function is not None
+            or self.data_parallel
+            or self.checkpoint_dir is not None
+        ):
+            return False
+
+        modifier.fused_calibration_ = True
+        self.smoothing_modifier_ = modifier
+        return True
+
     def on_initialize(self, state: "State", **kwargs) -> bool:
         """
         Initialize and run the GPTQ algorithm on the current state
@@ -187,6 +288,12 @@ class GPTQModifier(Modifier):
         if not self.initialized_structure_:
             self.on_initialize_structure(state, **kwargs)
         if self.quantization_modifier_:
+            if self.smoothing_modifier_ is not None:
+                # static activations are calibrated on the smoothed layers
+                config = self.quantization_modifier_.create_init_config()
+                self.quantization_modifier_.fused_calibration_ = (
+                    config.requires_calibration_data()
+                )
             self.quantization_modifier_.initialize(state, **kwargs)
         if not self.quantize:
             raise ValueError("To use the GPTQModifier, quantization must be enabled.")
@@ -200,8 +307,40 @@ class GPTQModifier(Modifier):
             # decoder layers (ie LlamaDecoderLayer)
             self.sequential_targets = get_no_split_params(modifiable_model)
 
+        if self.smoothing_modifier_ is not None and not self._can_fuse_calibration(
+            modifiable_model
+        ):
+            logger.warning(
+                "Smoothed or calibrated activations are not within a single sequential "
+                "layer, running SmoothQuant calibration separately from GPTQ"
+            )
+            # collect activation ranges of the original model, as the calibration
+            # of a separate SmoothQuantModifier would
+            modifiable_model.apply(disable_quantization)
+            self.smoothing_modifier_.run_calibration(
+                modifiable_model, calibration_dataloader
+            )
+            modifiable_model.apply(enable_quantization)
+            self.smoothing_modifier_ = None
+            if self._fused_activation_calibration():
+                # weight quantization parameters were set before smoothing
+                for module in modifiable_model.modules():
+                    scheme = getattr(module, "quantization_scheme", None)
+                    if scheme is not None and scheme.weights is not None:
+                        module.weight_observer.reset()
+                        call_observer(module=module, base_name="weight")
+                self.quantization_modifier_.fused_calibration_ = False
+                self.quantization_modifier_.run_calibration(modifiable_model)
+                self.quantization_modifier_.complete_calibration(
+                    modifiable_model, kwargs.get("min_tokens_per_module")
+                )
+
         self.initialize_compression(modifiable_model, calibration_dataloader)
         self.apply_compression(calibration_dataloader)
+        if self._fused_activation_calibration():
+            self.quantization_modifier_.complete_calibration(
+                modifiable_model, kwargs.get("min_tokens_per_module")
+            )
         state.model.apply(freeze_module_quantization)
 
         return True
@@ -256,7 +395,16 @@ class GPTQModifier(Modifier):
             logger.info(f"Preparing {name} for compression")
             args = self._pruning_arguments()
             comp_cls = self._compression_class()
-            compressor = LayerCompressor(comp_cls, self.model, layer, idx, name, args)
+            compressor = LayerCompressor(
+                comp_cls,
+                self.model,
+                layer,
+                idx,
+                name,
+                args,
+                wrapper_args={"max_hessian_tokens": self.max_hessian_tokens},
+                expert_batch_size=self.expert_batch_size,
+            )
             self.layer_compressors_.append(compressor)
 
         # for the initial forward data pass, add an early stop exception in order
@@ -273,6 +421,14 @@ class GPTQModifier(Modifier):
 
         :param dataloader: calibration data for GPTQ
         """
+        if self.data_parallel:
+            validate_data_parallel()
+            if self.checkpoint_dir is not None:
+                raise ValueError(
+                    "checkpoint_dir is not supported with data parallel calibration"
+                )
+            dataloader = shard_dataloader(dataloader)
+
         class_name = self.__class__.__name__.replace("PyTorch", "")
         logger.info(
             f"Running {class_name} calibration with " f"{len(dataloader)} samples..."
@@ -283,36 +439,117 @@ class GPTQModifier(Modifier):
         self.model.apply(disable_quantization)
 
         with DisableKVCache(self.model):
-            # run_calibration_forward uses the early stop exception to capture values
-            # as intermediates right before the forward pass of the first module
-            intermediates = run_calibration_forward(
-                self.model, dataloader, mask_padding=True
-            )
+            # restore layers compressed by a previous, interrupted run
+            checkpoint = None
+            num_completed, intermediates = 0, None
+            if self.checkpoint_dir is not None:
+                fingerprint = get_compression_fingerprint(self, self.model, dataloader)
+                checkpoint = LayerCheckpoint(self.checkpoint_dir, fingerprint)
+                num_completed, intermediates = checkpoint.load(self.layer_compressors_)
+
+            if intermediates is None:
+                # run_calibration_forward uses the early stop exception to capture
+                # values as intermediates right before the forward pass of the first
+                # module
+                intermediates = run_calibration_forward(
+                    self.model,
+                    dataloader,
+                    mask_padding=True,
+                    intermediates=IntermediatesCache(
+                        self.intermediates_dtype,
+                        self.intermediates_max_memory,
+                        self.intermediates_offload_dir,
+                    ),
+                )
             self.layer_compressors_[0].clear_early_stop()
 
             num_layers = len(self.compressible_layers_)
             for idx, layer_compressor in enumerate(self.layer_compressors_):
+                if idx < num_completed:
+                    continue
+
                 logger.info(f"\n===== Compressing layer {idx+1}/{num_layers} " " =====")
 
                 # run the forward pass for each transformer layer (block) one at a time
                 logger.info(f"Calibrating {layer_compressor.name}...")
                 layer_compressor.pre_compress()
                 unquantized_outputs = layer_compressor.calibrate_layer(intermediates)
-
-                layer_compressor.compress()
+                if self.smoothing_modifier_ is not None:
+                    # smooth the calibrated layer before compressing it
+                    input_scales = self.smoothing_modifier_.smooth_layer(
+                        self.model, layer_compressor.layer
+                    )
+                    layer_compressor.scale_inputs(input_scales)
+
+                layer_compressor.compress(data_parallel=self.data_parallel)
+                for module in layer_compressor.modules.values():
+                    if module.dampening_frac is not None:
+                        self.dampening_fracs_[module.name] = module.dampening_frac
                 layer_compressor.post_compress()
                 layer_compressor.revert_layer_wrappers()
 
                 # perform a second forward pass of the module to calculate
                 # weight-quantized outputs for use as inputs to the next layer
+                if self._fused_activation_calibration():
+                    quantization_modifier = self.quantization_modifier_
+                    layer_compressor.layer.apply(
+                        quantization_modifier.register_calibration_hooks
+                    )
                 quantized_outputs = layer_compressor.calibrate_layer(intermediates)
+                if self._fused_activation_calibration():
+                    quantization_modifier.remove_hooks()
                 error = get_output_error(unquantized_outputs, quantized_outputs)
                 logger.info(f"Mean output error from quantization: {error:.3f}")
                 intermediates = quantized_outputs
 
+                if checkpoint is not None:
+                    checkpoint.save_layer(layer_compressor, intermediates)
+
+        if self._fused_activation_calibration():
+            self.quantization_modifier_.end_calibration(self.model)
+
         # re-enable quantization
         self.model.apply(enable_quantization)
 
+    def _fused_activation_calibration(self) -> bool:
+        """
+        :return: True if the activations of the quantization modifier are calibrated
+            during the layer by layer calibration pass of GPTQ
+        """
+        return (
+            self.quantization_modifier_ is not None
+            and self.quantization_modifier_.fused_calibration_
+        )
+
+    def _can_fuse_calibration(self, model: Module) -> bool:
+        """
+        :param model: model to compress
+        :return: True if each smoothed activation and its balance layers, as well as
+            each activation calibrated by the quantization modifier, are within a
+            single sequential layer
+        """
+        layers = list(get_layers(self.sequential_targets, model).values())
+        if not self.smoothing_modifier_.mappings_within_layers(layers):
+            return False
+
+        if self._fused_activation_calibration():
+            quantization_modifier = self.quantization_modifier_
+            if (
+                quantization_modifier.num_calibration_steps is not None
+                or quantization_modifier.kv_cache_scheme is not None
+            ):
+                return False
+
+            sequential_modules = set().union(*(layer.modules() for layer in layers))
+            for module in model.modules():
+                calibrated = hasattr(module, "input_observer") or hasattr(
+                    module, "output_observer"
+                )
+                if calibrated and module not in sequential_modules:
+                    return False
+
+        return True
+
     def _build_quant_modifier(self):
         """
         Build a quantization modifier based on the specified config_groups,
@@ -329,12 +566,17 @@ class GPTQModifier(Modifier):
             "num_calibration_steps",
             "ignore",
             "disable_quantization_observer_epoch",
+            "deferred_calibration",
+            "token_sample_rate",
+            "max_observed_tokens",
+            "token_sampling_seed",
         ]
 
         quant_args = {
             key: getattr(self, key)
             for key in quantization_args_names
-            if getattr(self, key, False)
+            # a token_sampling_seed of 0 is falsy, but still forwarded
+            if getattr(self, key, False) or key == "token_sampling_seed"
         }
 
         logger.info(f"Building quantization modifier with args: {quant_args}")
@@ -360,6 +602,7 @@ class GPTQModifier(Modifier):
         return {
             "blocksize": self.block_size,
             "percdamp": self.dampening_frac,
+            "max_percdamp": self.max_dampening_frac,
         }
 
     def _compression_class(self):
@@ -1,11 +1,24 @@
 import time
-from typing import Tuple
+from typing import List, Optional, Tuple
 
-from compressed_tensors.quantization import ActivationOrdering, QuantizationStrategy
-from compressed_tensors.quantization.lifecycle.forward import fake_quantize
+from compressed_tensors.quantization import (
+    ActivationOrdering,
+    QuantizationArgs,
+    QuantizationStrategy,
+)
+from compressed_tensors.quantization.quant_args import round_to_quantized_type
+from compressed_tensors.quantization.utils import calculate_range
 
 from llmcompressor.modifiers.utils import SPARSITY_THRESHOLD
 from llmcompressor.modifiers.utils.compression_wrapper import ModuleCompressionWrapper
+from llmcompressor.modifiers.utils.distributed import all_reduce_sum
+from llmcompressor.modifiers.utils.hessian import (
+    accumulate_hessian,
+    batch_invert_hessian,
+    invert_hessian,
+    normalize_hessian,
+)
+from llmcompressor.modifiers.utils.pytorch_helpers import remove_padding
 from llmcompressor.observers import Observer
 from llmcompressor.pytorch.utils.helpers import tensor_sparsity
 from llmcompressor.utils import getattr_chain
@@ -17,8 +30,6 @@ except ImportError as err:
     transformers = None
     transformers_err = err
 
-import math
-from copy import copy
 
 import torch
 import torch.nn as nn
@@ -44,10 +55,21 @@ class GPTQWrapper(ModuleCompressionWrapper):
 
     :param name: name of module to run compression on
     :param layer: module to run compression on
+    :param max_hessian_tokens: optional maximum number of tokens of each calibration
+        batch to accumulate into the Hessian, larger batches are randomly subsampled
+    :param hessian_sampling_seed: seed of the random subsampling of tokens
     """
 
-    def __init__(self, name, layer):
+    def __init__(
+        self,
+        name,
+        layer,
+        max_hessian_tokens: Optional[int] = None,
+        hessian_sampling_seed: int = 0,
+    ):
         super().__init__(name=name, layer=layer)
+        self.max_hessian_tokens = max_hessian_tokens
+        self._hessian_generator = torch.Generator().manual_seed(hessian_sampling_seed)
 
         # for Hessian calculation
         self.register_buffer(
@@ -57,32 +79,119 @@ class GPTQWrapper(ModuleCompressionWrapper):
             ),
         )
 
-    def add_batch(self, inp: torch.Tensor, out: torch.Tensor):
+        # cache of inverse hessians, shared between wrappers with identical inputs
+        self._hessian_inverses = None
+
+        # Hessian and sample count before the latest batch, kept while the Hessian is
+        # shared so that wrappers whose inputs stop being identical can exclude it
+        self._previous_statistics = None
+
+        # dampening fraction used to invert the Hessian, set during compression
+        self.dampening_frac = None
+
+    def add_batch(
+        self,
+        inp: torch.Tensor,
+        out: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ):
         """
         Add a batch of layer input and output data to the Hessian calculation
 
         :param inp: tensor containing layer input
         :param out: tensor containing layer output
+        :param attention_mask: optional attention mask of the calibration batch, padding
+            tokens are excluded from the Hessian
         """
         if len(inp.shape) == 2:
+            # tokens without a batch dimension, such as the inputs of an expert, are
+            # not aligned with the attention mask
             inp = inp.unsqueeze(0)
+            attention_mask = None
         tmp = inp.shape[0]
+        inp = remove_padding(inp, attention_mask)
         if isinstance(self.layer, nn.Linear) or isinstance(
             self.layer, transformers.Conv1D
         ):
-            if len(inp.shape) == 3:
-                inp = inp.reshape((-1, inp.shape[-1]))
-            inp = inp.t()
-        self.H *= self.nsamples / (self.nsamples + tmp)
+            inp = inp.reshape((-1, inp.shape[-1]))
+
+        if self._previous_statistics is not None:
+            self._previous_statistics["H"] = self.H.clone()
+            self._previous_statistics["nsamples"] = self.nsamples.clone()
+
+        # normalization by the number of samples is deferred to compression
+        accumulate_hessian(
+            self.H,
+            inp,
+            self.max_hessian_tokens,
+            generator=self._hessian_generator,
+        )
         self.nsamples += tmp
-        inp = inp.to(dtype=self.H.dtype)
-        inp = math.sqrt(2 / self.nsamples) * inp
-        self.H += inp.matmul(inp.t())
+
+    def share_statistics(self, wrapper: "GPTQWrapper") -> bool:
+        """
+        Accumulate into the Hessian of another GPTQWrapper which observes identical
+        inputs. The inverse Hessian computed by either wrapper is reused by the other
+
+        :param wrapper: wrapper whose Hessian will be shared
+        :return: True, sharing is supported by GPTQ
+        """
+        if wrapper._hessian_inverses is None:
+            wrapper._hessian_inverses = {}
+        if wrapper._previous_statistics is None:
+            wrapper._previous_statistics = {}
+
+        self.H = wrapper.H
+        self.nsamples = wrapper.nsamples
+        self._hessian_inverses = wrapper._hessian_inverses
+        self._previous_statistics = wrapper._previous_statistics
+
+        return True
+
+    def unshare_statistics(self, exclude_latest_batch: bool = False):
+        """
+        Copy the shared Hessian so that future batches are accumulated separately
+
+        :param exclude_latest_batch: if True, copy the Hessian from before the latest
+            batch accumulated by the wrapper it was shared with, as that batch was not
+            an input to this wrapper
+        """
+        statistics = self._previous_statistics
+        if exclude_latest_batch and statistics:
+            self.H = statistics["H"].clone()
+            self.nsamples = statistics["nsamples"].clone()
+        else:
+            self.H = self.H.clone()
+            self.nsamples = self.nsamples.clone()
+        self._hessian_inverses = None
+        self._previous_statistics = None
+
+    def all_reduce_statistics(self):
+        """
+        Sum the unnormalized Hessians and sample counts accumulated by each rank
+        """
+        all_reduce_sum(self.H)
+        all_reduce_sum(self.nsamples)
+
+    def scale_inputs(self, scales: torch.Tensor):
+        """
+        Update the Hessian after the inputs were divided by channel-wise scales,
+        H = diag(scales)^-1 H diag(scales)^-1. A Hessian shared with other wrappers
+        is updated for all of them
+
+        :param scales: scales of shape (columns,) which inputs were divided by
+        """
+        inverse_scales = scales.to(self.H.device, self.H.dtype).reciprocal()
+        self.H *= inverse_scales.unsqueeze(0)
+        self.H *= inverse_scales.unsqueeze(1)
+        if self._hessian_inverses is not None:
+            self._hessian_inverses.clear()
 
     def compress(
         self,
         blocksize: int = 128,
         percdamp: float = 0.01,
+        max_percdamp: Optional[float] = None,
     ):
         """
         Run pruning and quantization(if applicable) on the layer up to the target
@@ -91,6 +200,8 @@ class GPTQWrapper(ModuleCompressionWrapper):
         :param blocksize: Number of columns to compress in one pass
         :param percdamp: Amount of dampening to apply to H, as a fraction of the
             diagonal norm
+        :param max_percdamp: maximum dampening to retry with if the dampened Hessian
+            cannot be inverted, before falling back to clamping its eigenvalues
         """
         args_loc = "quantization_scheme.weights"
         quant_args = getattr_chain(self.layer, args_loc, None)
@@ -108,11 +219,7 @@ class GPTQWrapper(ModuleCompressionWrapper):
         W = self.layer.weight.data.clone()
 
         # create observer for calculating quantization parameters
-        observer = Observer.load_from_registry(
-            quant_args.observer,
-            quantization_args=quant_args,
-            averaging_constant=1.0,  # ignore moving average
-        )
+        observer = _load_gptq_observer(quant_args)
 
         # standardize shape and dtype
         if isinstance(self.layer, nn.Conv2d):
@@ -132,7 +239,10 @@ class GPTQWrapper(ModuleCompressionWrapper):
 
             if actorder == ActivationOrdering.GROUP:
                 # permute by activation order first, then update groups
-                W, self.H, perm = self._apply_activation_ordering(W, self.H)
+                Hinv, dead, perm = self._get_hessian_inverse(
+                    percdamp, max_percdamp, actorder=True
+                )
+                W = W[:, perm]
                 scale, zero_point = observer(W, g_idx=None)
 
                 # use identity g_idx (invert permutation later)
@@ -140,15 +250,20 @@ class GPTQWrapper(ModuleCompressionWrapper):
             elif actorder == ActivationOrdering.WEIGHT:
                 # update groups first, then permute by activation order
                 scale, zero_point = observer(W, g_idx=None)
-                W, self.H, perm = self._apply_activation_ordering(W, self.H)
+                Hinv, dead, perm = self._get_hessian_inverse(
+                    percdamp, max_percdamp, actorder=True
+                )
+                W = W[:, perm]
 
                 # permute g_idx to maintain identity mapping after unpermutation
                 g_idx = g_idx[perm]
 
             else:
                 scale, zero_point = observer(W, g_idx=None)
+                Hinv, dead, _ = self._get_hessian_inverse(percdamp, max_percdamp)
         else:
             scale, zero_point = observer(W, g_idx=None)
+            Hinv, dead, _ = self._get_hessian_inverse(percdamp, max_percdamp)
 
         # sparsity mask
         sparsity = tensor_sparsity(W)
@@ -160,26 +275,22 @@ class GPTQWrapper(ModuleCompressionWrapper):
         )
 
         # mask dead hessian values
-        dead = torch.diag(self.H) == 0
-        self.H[dead, dead] = 1
         W[:, dead] = 0
 
         Losses = torch.zeros(self.rows, device=self.dev)
 
-        # compute inverse hessian in place to save memory
-        try:
-            damp = percdamp * torch.mean(torch.diag(self.H))
-            diag = torch.arange(self.columns, device=self.dev)
-            self.H[diag, diag] += damp
-            self.H = torch.linalg.cholesky(self.H)
-            self.H = torch.cholesky_inverse(self.H)
-            self.H = torch.linalg.cholesky(self.H, upper=True)
-            Hinv = self.H
-        except torch._C._LinAlgError:
+        # resolve quantization parameters up front to minimize per-column overhead
+        q_min, q_max = calculate_range(quant_args, W.device)
+        if strategy == QuantizationStrategy.TENSOR:
+            column_scale, column_zero_point = scale, zero_point
+        elif strategy == QuantizationStrategy.CHANNEL:
+            column_scale, column_zero_point = scale[:, 0], zero_point[:, 0]
+        elif strategy == QuantizationStrategy.GROUP:
+            group_size = quant_args.group_size
+            column_groups = g_idx.tolist()
+        else:
             raise ValueError(
-                "Failed to invert hessian due to numerical instability. Consider "
-                "increasing GPTQModifier.dampening_frac, increasing the number "
-                "of calibration samples, or shuffling the calibration dataset"
+                f"Quantization strategy is not supported for GPTQ: {strategy}"
             )
 
         # See section 3.4 of https://arxiv.org/abs/2203.07259
@@ -190,7 +301,6 @@ class GPTQWrapper(ModuleCompressionWrapper):
             W1 = W[:, i1:i2].clone()
             Q1 = torch.zeros_like(W1)
             Err1 = torch.zeros_like(W1)
-            Losses1 = torch.zeros_like(W1)
             Hinv1 = Hinv[i1:i2, i1:i2]
 
             if preserve_zeros:
@@ -199,59 +309,37 @@ class GPTQWrapper(ModuleCompressionWrapper):
             for i in range(count):
                 w = W1[:, i]
                 d = Hinv1[i, i]
-                q = w.clone()
 
-                # quantize column
-                if strategy == QuantizationStrategy.TENSOR:
-                    q = fake_quantize(
-                        q,
-                        scale,
-                        zero_point,
-                        self.layer.quantization_scheme.weights,
-                    )
-                elif strategy == QuantizationStrategy.CHANNEL:
-                    q = fake_quantize(
-                        q,
-                        scale[:, 0],
-                        zero_point[:, 0],
-                        quant_args,
-                    )
-                elif strategy == QuantizationStrategy.GROUP:
+                if strategy == QuantizationStrategy.GROUP:
                     # get the group index for the current column
                     column_idx = i1 + i
-                    group_index = g_idx[column_idx]
+                    group_index = column_groups[column_idx]
 
                     # update quantization parameters to reflect changes
-                    # resulting from previous blocks
+                    # resulting from previous blocks. Unless permuted by weight
+                    # order, the columns of each group are contiguous
                     if (
                         actorder != ActivationOrdering.WEIGHT
-                        and column_idx % quant_args.group_size == 0
+                        and column_idx % group_size == 0
                     ):
                         _scale, _zero_point = observer.get_qparams_along_dim(
-                            W[:, g_idx == group_index], dim=0
+                            W[:, column_idx : column_idx + group_size], dim=0
                         )
                         scale[:, group_index] = _scale[:, 0]
                         zero_point[:, group_index] = _zero_point[:, 0]
 
                     # Since we're only applying quantization to a slice, this
                     # ends up being a channelwise application
-                    altered_qargs = copy(quant_args)
-                    altered_qargs.strategy = QuantizationStrategy.CHANNEL
-                    q = fake_quantize(
-                        q,
-                        scale[:, group_index],
-                        zero_point[:, group_index],
-                        altered_qargs,
-                    )
-                else:
-                    raise ValueError(
-                        "Quantization strategy is not supported for GPTQ: "
-                        f"{strategy}"
-                    )
+                    column_scale = scale[:, group_index]
+                    column_zero_point = zero_point[:, group_index]
+
+                # quantize column
+                q = _fake_quantize_column(
+                    w, column_scale, column_zero_point, q_min, q_max, quant_args
+                )
 
                 # propagate column error
                 Q1[:, i] = q
-                Losses1[:, i] = (w - q) ** 2 / d**2
 
                 err1 = (w - q) / d
                 w1_err = err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
@@ -263,7 +351,7 @@ class GPTQWrapper(ModuleCompressionWrapper):
 
             # propagate block error
             W[:, i1:i2] = Q1
-            Losses += torch.sum(Losses1, 1) / 2
+            Losses += torch.sum(Err1**2, 1) / 2
 
             w_err = Err1.matmul(Hinv[i1:i2, i2:])
             if preserve_zeros:
@@ -306,23 +394,333 @@ class GPTQWrapper(ModuleCompressionWrapper):
             update_prefix_dict(self.layer, "weight", self.layer.weight.to(device))
             self.layer._hf_hook.post_forward(self.layer, None)
 
+    @classmethod
+    def compress_batch(
+        cls,
+        wrappers: List["GPTQWrapper"],
+        blocksize: int = 128,
+        percdamp: float = 0.01,
+        max_percdamp: Optional[float] = None,
+    ):
+        """
+        Run GPTQ on a batch of linear modules with weights of the same shape and
+        quantization arguments, such as the experts of a mixture of experts layer.
+        The Hessians are stacked, and the inverse Hessians and column updates are
+        computed for all modules at once. Batches which use activation ordering or
+        differ in shape or quantization arguments are compressed one module at a time
+
+        :param wrappers: wrappers of the modules to compress
+        :param blocksize: Number of columns to compress in one pass
+        :param percdamp: Amount of dampening to apply to H, as a fraction of the
+            diagonal norm
+        :param max_percdamp: maximum dampening to retry with if a dampened Hessian
+            cannot be inverted, before falling back to clamping its eigenvalues
+        """
+        args_loc = "quantization_scheme.weights"
+        quant_args = getattr_chain(wrappers[0].layer, args_loc, None)
+        weight = wrappers[0].layer.weight
+        if (
+            len(wrappers) <= 1
+            or quant_args is None
+            or quant_args.actorder is not None
+            or any(
+                not isinstance(wrapper.layer, nn.Linear)
+                or wrapper.layer.weight.shape != weight.shape
+                or wrapper.layer.weight.dtype != weight.dtype
+                or getattr_chain(wrapper.layer, args_loc, None) != quant_args
+                for wrapper in wrappers
+            )
+        ):
+            return super().compress_batch(
+                wrappers,
+                blocksize=blocksize,
+                percdamp=percdamp,
+                max_percdamp=max_percdamp,
+            )
+
+        for wrapper in wrappers:
+            if is_module_offloaded(wrapper.layer):
+                wrapper.layer._hf_hook.pre_forward(wrapper.layer)
+
+        num_modules = len(wrappers)
+        strategy = quant_args.strategy
+        final_shape = weight.shape
+        final_dtype = weight.dtype
+        rows, columns = final_shape
+        W = torch.stack([wrapper.layer.weight.data for wrapper in wrappers]).float()
+
+        tick = time.time()
+
+        # quantization parameters are calculated per row, except for the tensor
+        # strategy which requires one observer per module
+        if strategy == QuantizationStrategy.TENSOR:
+            qparams = [
+                _load_gptq_observer(quant_args)(W[index], g_idx=None)
+                for index in range(num_modules)
+            ]
+            scales = [scale for scale, _ in qparams]
+            zero_points = [zero_point for _, zero_point in qparams]
+        else:
+            observer = _load_gptq_observer(quant_args)
+            scale, zero_point = observer(W.reshape(-1, columns), g_idx=None)
+            scale = scale.reshape(num_modules, rows, -1)
+            zero_point = zero_point.reshape(num_modules, rows, -1)
+
+        Hinv, dead = cls._get_batch_hessian_inverse(wrappers, percdamp, max_percdamp)
+
+        # sparsity masks, only applied to modules whose sparsity is preserved
+        preserve_zeros = torch.stack(
+            [
+                tensor_sparsity(W[index]) >= SPARSITY_THRESHOLD
+                for index in range(num_modules)
+            ]
+        )
+        W_nz_mask = None
+        if preserve_zeros.any():
+            W_nz_mask = (~torch.isclose(W, torch.zeros(1, device=W.device))).float()
+            W_nz_mask[~preserve_zeros] = 1
+
+        # mask dead hessian values
+        W.masked_fill_(dead.unsqueeze(1), 0)
+
+        Losses = torch.zeros(num_modules, rows, device=W.device)
+
+        # resolve quantization parameters up front to minimize per-column overhead
+        q_min, q_max = calculate_range(quant_args, W.device)
+        if strategy == QuantizationStrategy.TENSOR:
+            column_scale = torch.stack(scales).reshape(num_modules, 1)
+            column_zero_point = torch.stack(zero_points).reshape(num_modules, 1)
+        elif strategy == QuantizationStrategy.CHANNEL:
+            column_scale, column_zero_point = scale[:, :, 0], zero_point[:, :, 0]
+        elif strategy == QuantizationStrategy.GROUP:
+            group_size = quant_args.group_size
+        else:
+            raise ValueError(
+                f"Quantization strategy is not supported for GPTQ: {strategy}"
+            )
+
+        # See section 3.4 of https://arxiv.org/abs/2203.07259
+        for i1 in range(0, columns, blocksize):
+            i2 = min(i1 + blocksize, columns)
+            count = i2 - i1
+
+            W1 = W[:, :, i1:i2].clone()
+            Q1 = torch.zeros_like(W1)
+            Err1 = torch.zeros_like(W1)
+            Hinv1 = Hinv[:, i1:i2, i1:i2]
+
+            if W_nz_mask is not None:
+                W1_nz_mask = W_nz_mask[:, :, i1:i2]
+
+            for i in range(count):
+                w = W1[:, :, i]
+                d = Hinv1[:, i, i].unsqueeze(1)
+
+                if strategy == QuantizationStrategy.GROUP:
+                    # update quantization parameters to reflect changes
+                    # resulting from previous blocks
+                    column_idx = i1 + i
+                    group_index = column_idx // group_size
+                    if column_idx % group_size == 0:
+                        _scale, _zero_point = observer.get_qparams_along_dim(
+                            W[:, :, column_idx : column_idx + group_size].reshape(
+                                num_modules * rows, -1
+                            ),
+                            dim=0,
+                        )
+                        scale[:, :, group_index] = _scale.reshape(num_modules, rows)
+                        zero_point[:, :, group_index] = _zero_point.reshape(
+                            num_modules, rows
+                        )
+
+                    column_scale = scale[:, :, group_index]
+                    column_zero_point = zero_point[:, :, group_index]
+
+                # quantize column
+                q = _fake_quantize_column(
+                    w, column_scale, column_zero_point, q_min, q_max, quant_args
+                )
+
+                # propagate column error
+                Q1[:, :, i] = q
+
+                err1 = (w - q) / d
+                w1_err = err1.unsqueeze(2) * Hinv1[:, i, i:].unsqueeze(1)
+                if W_nz_mask is not None:
+                    W1[:, :, i:] -= w1_err * W1_nz_mask[:, :, i:]
+                else:
+                    W1[:, :, i:] -= w1_err
+                Err1[:, :, i] = err1
+
+            # propagate block error
+            W[:, :, i1:i2] = Q1
+            Losses += torch.sum(Err1**2, 2) / 2
+
+            w_err = torch.bmm(Err1, Hinv[:, i1:i2, i2:])
+            if W_nz_mask is not None:
+                W[:, :, i2:] -= w_err * W_nz_mask[:, :, i2:]
+            else:
+                W[:, :, i2:] -= w_err
+
+        for index, wrapper in enumerate(wrappers):
+            if "METRIC" in logger._core.levels.keys():
+                wrapper._log_metrics(tick, Losses[index])
+
+            if strategy == QuantizationStrategy.TENSOR:
+                module_scale, module_zero_point = scales[index], zero_points[index]
+            else:
+                module_scale = scale[index].clone()
+                module_zero_point = zero_point[index].clone()
+            update_parameter_data(wrapper.layer, module_scale, "weight_scale")
+            update_parameter_data(wrapper.layer, module_zero_point, "weight_zero_point")
+
+            # This is a bit hacky, but FSDP updates only work if we change
+            # the weight in place, clone() or direct assignment won't work
+            layer = wrapper.layer
+            layer.weight -= layer.weight
+            layer.weight += W[index].reshape(final_shape).to(final_dtype)
+
+            if is_module_offloaded(layer):
+                device = get_offloaded_device(layer)
+                update_prefix_dict(layer, "weight", layer.weight.to(device))
+                layer._hf_hook.post_forward(layer, None)
+
     def free(self):
         """
         Free the Hessian memory after the layer is complete
         """
         delattr(self, "H")
+        self._hessian_inverses = None
+        self._previous_statistics = None
         super().free()
 
-    def _apply_activation_ordering(
-        self, W: torch.Tensor, H: torch.Tensor
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def _get_hessian_inverse(
+        self,
+        percdamp: float,
+        max_percdamp: Optional[float] = None,
+        actorder: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Compute the upper cholesky factor of the dampened inverse Hessian. If the
+        Hessian is shared with other wrappers, the result is cached and reused by
+        them. Otherwise the inverse is computed in place to save memory. The
+        dampening used is stored in `dampening_frac`
+
+        :param percdamp: Amount of dampening to apply to H, as a fraction of the
+            diagonal norm
+        :param max_percdamp: maximum dampening to retry with if the dampened Hessian
+            cannot be inverted
+        :param actorder: whether to permute the Hessian in order of greatest
+            input activations
+        :return: tuple of inverse Hessian, mask of dead columns and the activation
+            order permutation, or None if actorder is False
+        """
+        key = (percdamp, max_percdamp, actorder)
+        if self._hessian_inverses is not None and key in self._hessian_inverses:
+            H, dead, perm, self.dampening_frac = self._hessian_inverses[key]
+            return H, dead, perm
+
+        H = self.H
+        perm = None
+        if actorder:
+            perm = torch.argsort(torch.diag(H), descending=True)
+            H = H[perm][:, perm]
+        elif self._hessian_inverses is not None:
+            # do not modify the hessian shared with other wrappers
+            H = H.clone()
+
+        if self._hessian_inverses is None:
+            # compute inverse hessian in place to save memory
+            self.H = None
+        normalize_hessian(H, self.nsamples)
+
+        # mask dead hessian values
+        dead = torch.diag(H) == 0
+        H[dead, dead] = 1
+
+        H, self.dampening_frac = invert_hessian(H, percdamp, max_percdamp, self.name)
+
+        if self._hessian_inverses is not None:
+            self._hessian_inverses[key] = (H, dead, perm, self.dampening_frac)
+        else:
+            self.H = H
+
+        return H, dead, perm
+
+    @staticmethod
+    def _get_batch_hessian_inverse(
+        wrappers: List["GPTQWrapper"],
+        percdamp: float,
+        max_percdamp: Optional[float] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Permute weight and hessian in order of greatest outupt activations
+        Compute the upper cholesky factors of the dampened inverse Hessians of a batch
+        of wrappers at once. Inverses cached by wrappers with shared Hessians are
+        reused, and Hessians shared within the batch are only inverted once. The
+        dampening used is stored in `dampening_frac` of each wrapper
 
-        :param W: weight to permute
+        :param wrappers: wrappers to compute the inverse Hessians of
+        :param percdamp: Amount of dampening to apply to H, as a fraction of the
+            diagonal norm
+        :param max_percdamp: maximum dampening to retry with if a dampened Hessian
+            cannot be inverted
+        :return: tuple of the stacked inverse Hessians and masks of dead columns
         """
-        perm = torch.argsort(torch.diag(H), descending=True)
-        return W[:, perm], H[perm][:, perm], perm
+        key = (percdamp, max_percdamp, False)
+        inverses = [None] * len(wrappers)
+
+        # wrappers with inverses to compute, grouped by shared Hessian
+        pending = {}
+        for index, wrapper in enumerate(wrappers):
+            if (
+                wrapper._hessian_inverses is not None
+                and key in wrapper._hessian_inverses
+            ):
+                inverses[index] = wrapper._hessian_inverses[key]
+            else:
+                pending.setdefault(id(wrapper.H), []).append(index)
+
+        if len(pending) > 0:
+            leaders = [wrappers[indices[0]] for indices in pending.values()]
+            H = torch.empty(
+                (len(leaders), *leaders[0].H.shape),
+                device=leaders[0].H.device,
+                dtype=leaders[0].H.dtype,
+            )
+            for index, leader in enumerate(leaders):
+                H[index] = leader.H
+                if leader._hessian_inverses is None:
+                    # release each Hessian once copied to save memory
+                    leader.H = None
+            nsamples = torch.stack([leader.nsamples for leader in leaders])
+            normalize_hessian(H, nsamples.unsqueeze(-1))
+
+            # mask dead hessian values
+            diag = torch.diagonal(H, dim1=-2, dim2=-1)
+            dead = diag == 0
+            diag[dead] = 1
+
+            names = [leader.name for leader in leaders]
+            Hinv, damp_fracs = batch_invert_hessian(H, percdamp, max_percdamp, names)
+            del H
+
+            for leader_index, indices in enumerate(pending.values()):
+                inverse = (Hinv[leader_index], dead[leader_index], None)
+                inverse += (damp_fracs[leader_index],)
+                for index in indices:
+                    inverses[index] = inverse
+                    if wrappers[index]._hessian_inverses is not None:
+                        wrappers[index]._hessian_inverses[key] = inverse
+
+        for wrapper, (_, _, _, dampening_frac) in zip(wrappers, inverses):
+            wrapper.dampening_frac = dampening_frac
+
+        if len(pending) == len(wrappers):
+            return Hinv, dead
+
+        Hinv = torch.stack([inverse[0] for inverse in inverses])
+        dead = torch.stack([inverse[1] for inverse in inverses])
+        return Hinv, dead
 
     def _log_metrics(self, start_tick: float, losses: torch.Tensor):
         """
@@ -352,3 +750,47 @@ class GPTQWrapper(ModuleCompressionWrapper):
             "METRIC",
             f"Compressed layer size: {get_layer_size_mb(self.layer)} MB",
         )
+
+
+def _load_gptq_observer(quant_args: QuantizationArgs) -> Observer:
+    """
+    :param quant_args: quantization args of the weight
+    :return: observer for calculating weight quantization parameters during GPTQ
+    """
+    return Observer.load_from_registry(
+        quant_args.observer,
+        quantization_args=quant_args,
+        averaging_constant=1.0,  # ignore moving average
+    )
+
+
+def _fake_quantize_column(
+    column: torch.Tensor,
+    scale: torch.Tensor,
+    zero_point: Optional[torch.Tensor],
+    q_min: torch.Tensor,
+    q_max: torch.Tensor,
+    args: QuantizationArgs,
+) -> torch.Tensor:
+    """
+    Fake quantize a single weight column. Numerically equivalent to `fake_quantize`
+    with a channel strategy, but avoids recomputing the quantization range and
+    validating arguments for each of the columns quantized by GPTQ
+
+    :param column: weight column to quantize
+    :param scale: scale for each row of the column
+    :param zero_point: zero point for each row of the column
+    :param q_min: minimum value of the quantized range
+    :param q_max: maximum value of the quantized range
+    :param args: quantization args of the weight
+    :return: fake quantized column
+    """
+    scaled = column / scale
+    if zero_point is not None:
+        scaled += zero_point.to(column.dtype)
+    quantized = round_to_quantized_type(torch.clamp(scaled, q_min, q_max), args)
+
+    dequantized = quantized.to(scale.dtype)
+    if zero_point is not None:
+        dequantized = dequantized - zero_point.to(scale.dtype)
+    return dequantized * scale
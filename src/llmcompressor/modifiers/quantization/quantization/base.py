@@ -1,3 +1,4 @@
+from functools import partial
 from typing import Any, Dict, List, Optional, Union
 
 from compressed_tensors.quantization import (
@@ -18,12 +19,16 @@ from llmcompressor.core import Event, EventType, State
 from llmcompressor.modifiers import Modifier
 from llmcompressor.modifiers.quantization.calibration import (
     apply_calibration_status,
+    apply_deferred_calibration,
     calibrate_input_hook,
     calibrate_kv_cache_input_hook,
     calibrate_kv_cache_output_hook,
     calibrate_output_hook,
+    defer_calibration,
     freeze_module_quantization,
     initialize_observer,
+    observe_input_hook,
+    observe_output_hook,
     set_unset_kv_cache,
     update_weight_zp_scale,
 )
@@ -31,7 +36,7 @@ from llmcompressor.modifiers.utils.pytorch_helpers import (
     is_moe_model,
     run_calibration_forward,
 )
-from llmcompressor.observers.helpers import get_observer_token_count
+from llmcompressor.observers.helpers import TokenSampler, get_observer_token_count
 
 __all__ = ["QuantizationModifier"]
 
@@ -62,7 +67,8 @@ class QuantizationModifier(Modifier):
               keys and values are compressed before storing them in the cache
         There is an explicit assumption that the model contains modules with
         `k_proj` and `v_proj` in their names. If this is not the case
-        and kv_cache_scheme != None, the quantization of kv cache will fail
+        and kv_cache_scheme != None, the quantization of kv cache will fail.
+        With the channel strategy, there is a scale for each attention head
     :param targets: list of layer names to quantize if a scheme is provided. Defaults
         to Linear layers
     :param disable_quantization_observer_epoch: Epoch to disable updates to the module
@@ -70,6 +76,20 @@ class QuantizationModifier(Modifier):
         not be updated. Leave None to not disable observers during QAT. Default is None
     :param num_calibration_steps: Number of steps to run post training calibration for.
         When None, the entire calibration_dataloader is used
+    :param deferred_calibration: if True, calibration hooks only update the running
+        statistics of the activation observers on the execution device, and the
+        activation scales and zero points are written once per module after
+        calibration. Modules with calibrated activations are not quantized during
+        the calibration forward passes. Avoids writing parameters on every batch,
+        which is slow for offloaded models. Keys and values are observed without
+        quantizing them when running kv cache quantization. Default is False
+    :param token_sample_rate: optional fraction of the tokens of each calibration
+        batch passed to the observers of per-tensor activations. Tokens are sampled
+        separately for each module. Leave None to observe all tokens
+    :param max_observed_tokens: optional maximum number of tokens of each
+        calibration batch passed to the observers of each per-tensor activation
+    :param token_sampling_seed: seed of the random sampling of observed tokens.
+        Default is 0
     """
 
     config_groups: Optional[Dict[str, QuantizationScheme]] = None
@@ -79,9 +99,16 @@ class QuantizationModifier(Modifier):
     kv_cache_scheme: Optional[QuantizationArgs] = None
     disable_quantization_observer_epoch: Optional[float] = None
     num_calibration_steps: Optional[int] = None
+    deferred_calibration: bool = False
+    token_sample_rate: Optional[float] = None
+    max_observed_tokens: Optional[int] = None
+    token_sampling_seed: int = 0
 
     calibration_dataloader_: Any = None
     calibration_function_: Any = None
+    token_sampler_: Any = None
+    fused_calibration_: bool = False
+    calibration_pending_: bool = False
 
     @field_validator("targets", mode="before")
     def validate_targets(cls, value: Union[str, List[str]]) -> List[str]:
@@ -109,10 +136,11 @@ class QuantizationModifier(Modifier):
             module.apply(update_weight_zp_scale)
             module.apply(apply_calibration_status)
             self._calibrate_if_possible(module)
-            self._check_token_distribution(
-                module, threshold=kwargs.get("min_tokens_per_module")
-            )
-            module.apply(freeze_module_quantization)
+            if self.fused_calibration_:
+                # calibration data is passed through the model by the modifier
+                # running the calibration, which ends and completes calibration
+                return True
+            self.complete_calibration(module, kwargs.get("min_tokens_per_module"))
 
         return True
 
@@ -210,7 +238,11 @@ class QuantizationModifier(Modifier):
         modifier_as_config = self.create_init_config()
         # Add step to attach kv_cache to the model, if present within the config
         apply_quantization_config(model, modifier_as_config)
-        model.apply(set_unset_kv_cache)
+        model.apply(
+            lambda module: set_unset_kv_cache(
+                module, observe_only=self.deferred_calibration
+            )
+        )
         return modifier_as_config
 
     def _calibrate_if_possible(self, module: Module):
@@ -261,8 +293,65 @@ class QuantizationModifier(Modifier):
 
         module.apply(lambda model: initialize_observer(model, base_name="input"))
         module.apply(lambda model: initialize_observer(model, base_name="output"))
+        if self.token_sample_rate is not None or self.max_observed_tokens is not None:
+            self.token_sampler_ = TokenSampler(
+                sample_rate=self.token_sample_rate,
+                max_tokens=self.max_observed_tokens,
+                seed=self.token_sampling_seed,
+            )
+        self.calibration_pending_ = True
+        if not self.fused_calibration_:
+            self.run_calibration(module)
+
+    def run_calibration(self, module: Module):
+        """
+        Run the calibration data through the module with the calibration hooks
+        registered, if calibration is pending
+
+        :param module: module to calibrate
+        """
+        if not self.calibration_pending_:
+            return
+
         module.apply(self.register_calibration_hooks)
         self._calibrate(module)
+        self.end_calibration(module)
+
+    def complete_calibration(
+        self, module: Module, min_tokens_per_module: Optional[float] = None
+    ):
+        """
+        Check the distribution of calibration tokens and freeze the quantization of
+        the module once calibration has ended
+
+        :param module: calibrated module
+        :param min_tokens_per_module: the minimum percentage of tokens a module of
+            a MoE model should receive during calibration
+        """
+        self._check_token_distribution(module, threshold=min_tokens_per_module)
+        module.apply(freeze_module_quantization)
+
+    def end_calibration(self, module: Module):
+        """
+        Apply the statistics observed while calibration data was passed through the
+        module, remove the calibration hooks and detach the kv_cache. Called by the
+        modifier running the calibration pass when calibration is fused
+
+        :param module: calibrated module
+        """
+        if not self.calibration_pending_:
+            return
+
+        self.calibration_pending_ = False
+        if self.token_sampler_ is not None:
+            num_tokens = self.token_sampler_.num_tokens
+            num_sampled_tokens = self.token_sampler_.num_sampled_tokens
+            logger.info(
+                f"Observed {num_sampled_tokens} of {num_tokens} activation tokens "
+                f"({num_sampled_tokens / max(num_tokens, 1):.2%}) during calibration"
+            )
+        if self.deferred_calibration:
+            module.apply(apply_deferred_calibration)
         module.apply(set_unset_kv_cache)
         self.remove_hooks()
 
@@ -284,7 +373,13 @@ class QuantizationModifier(Modifier):
 
         # Calibrate inputs if an input_quant is provided and not running dynamic quant
         if calibrate_inputs:
-            self.register_hook(module, calibrate_input_hook, "forward_pre")
+            if self.deferred_calibration:
+                defer_calibration(module)
+                input_hook = observe_input_hook
+            else:
+                input_hook = calibrate_input_hook
+            input_hook = partial(input_hook, token_sampler=self.token_sampler_)
+            self.register_hook(module, input_hook, "forward_pre")
 
         if output_quant:
             # hooks for attn modules if running kv_cache quant
@@ -296,11 +391,21 @@ class QuantizationModifier(Modifier):
                     with_kwargs=True,
                 )
 
-                self.register_hook(module, calibrate_kv_cache_output_hook, "forward")
+                # scales of an observe_only kv_cache are written after calibration
+                if not self.deferred_calibration:
+                    self.register_hook(
+                        module, calibrate_kv_cache_output_hook, "forward"
+                    )
 
             # hooks for output quant if not running dynamic quant
             elif not output_quant.dynamic:
-                self.register_hook(module, calibrate_output_hook, "forward")
+                if self.deferred_calibration:
+                    defer_calibration(module)
+                    output_hook = observe_output_hook
+                else:
+                    output_hook = calibrate_output_hook
+                output_hook = partial(output_hook, token_sampler=self.token_sampler_)
+                self.register_hook(module, output_hook, "forward")
 
     def _calibrate(self, module: Module):
         class_name = self.__class__.__name__.replace("PyTorch", "")
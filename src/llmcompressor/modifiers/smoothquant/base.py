@@ -1,8 +1,9 @@
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from loguru import logger
+from pydantic import field_validator
 from torch.nn import Module
 
 from llmcompressor.core import State
@@ -11,12 +12,22 @@ from llmcompressor.modifiers.smoothquant.utils import (
     get_layer_mappings_from_architecture,
     handle_mapping_resolution_errors,
 )
-from llmcompressor.modifiers.utils.pytorch_helpers import run_calibration_forward
+from llmcompressor.modifiers.utils.intermediates_cache import IntermediatesCache
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    run_calibration_forward,
+    run_layer_forward,
+    set_early_stop,
+)
 from llmcompressor.utils.fsdp.helpers import get_fsdp_parent
+from llmcompressor.utils.helpers import DisableKVCache
 from llmcompressor.utils.pytorch.module import get_layers, get_matching_layer
 
 MINIMUM_SMOOTHING_SCALE = 1e-5
 
+# number of weight elements of the balance layers evaluated at once when searching
+# for the smoothing strength, bounds the memory used by the search
+SEARCH_CHUNK_NUMEL = 2**28
+
 
 __all__ = ["SmoothQuantScale", "SmoothQuantMapping", "SmoothQuantModifier"]
 
@@ -25,7 +36,7 @@ __all__ = ["SmoothQuantScale", "SmoothQuantMapping", "SmoothQuantModifier"]
 class SmoothQuantScale:
     """
     Dataclass for storing the channel-wise minimum and maximum values for a layer. This
-    is updated each forward pass during calibration
+    is updated in place each forward pass during calibration
 
     :param min_channel_vals: minimum output value seen so far, per channel
     :param max_channel_vals: maximum output value seen so far, per channel
@@ -62,7 +73,11 @@ class SmoothQuantModifier(Modifier):
 
      Because this modifier manipulates the weights of the model, it can only be used in
      in one-shot and not during training. Activation ranges are determined by running a
-     small set of calibration data through the model.
+     small set of calibration data through the model, or one sequential layer at a
+     time if sequential_targets is set. When directly followed by a
+     GPTQModifier in the same stage, activation ranges are collected during the layer
+     by layer calibration pass of GPTQ, and each layer is smoothed before it is
+     compressed.
 
     example recipe:
      ```yaml
@@ -91,6 +106,20 @@ class SmoothQuantModifier(Modifier):
      use the whole dataset
     :param calibration_function: optional function to use for the forward pass, or None
     to use the default tensor_module_forward
+    :param sequential_targets: optional list of layer names or class names, such as
+        the decoder layers, to pass calibration data through one at a time. Each layer
+        is smoothed as soon as calibration data has passed through it, so that only
+        one layer needs to be on the execution device at a time. Leave None to run
+        calibration data through the whole model at once
+    :param smoothing_strength_grid: optional list of candidate smoothing strengths.
+        If set, the strength of each mapping is chosen from the candidates, instead
+        of using smoothing_strength for all of them. A sample of the calibration
+        activations of each mapping, drawn uniformly from all calibration batches,
+        is cached. Each candidate is evaluated on the sample by the error of the
+        balance layer outputs under 8 bit per-token activation and per-channel
+        weight quantization, and the candidate with the lowest error is used
+    :param max_search_tokens: maximum number of activation tokens cached per mapping
+        to search for the smoothing strength with. Default is 512
     """
 
     smoothing_strength: float = 0.5
@@ -98,9 +127,28 @@ class SmoothQuantModifier(Modifier):
     ignore: Optional[List[str]] = None
     num_calibration_steps: Optional[int] = None
     calibration_function: Optional[Callable] = None
+    sequential_targets: Union[str, List[str], None] = None
+    smoothing_strength_grid: Optional[List[float]] = None
+    max_search_tokens: int = 512
 
     resolved_mappings_: Optional[List] = None
     scales_: Optional[Dict] = None
+    scale_hooks_: Optional[Dict] = None
+    search_inputs_: Optional[Dict] = None
+    smoothing_strengths_: Optional[Dict] = None
+    fused_calibration_: bool = False
+
+    @field_validator("smoothing_strength_grid")
+    def validate_smoothing_strength_grid(
+        cls, value: Optional[List[float]]
+    ) -> Optional[List[float]]:
+        if value is not None:
+            if len(value) == 0:
+                raise ValueError("smoothing_strength_grid must not be empty")
+            if any(not 0.0 <= strength <= 1.0 for strength in value):
+                raise ValueError(f"Smoothing strengths must be in [0, 1], got {value}")
+
+        return value
 
     def on_initialize(self, state: State, **kwargs) -> bool:
         """
@@ -124,15 +172,84 @@ class SmoothQuantModifier(Modifier):
         self.mappings = self._infer_mappings_from_model(state.model)
         self.resolved_mappings_ = self._resolve_mappings(state.model)
         self.scales_ = {}
-
-        calibration_dataloader = state.data.calib
+        self.search_inputs_ = {}
+        self.smoothing_strengths_ = {}
 
         self._setup_scale_hooks()
-        self._calibrate(state.model, calibration_dataloader)
-        self._apply_smoothing(state.model)
+        if self.fused_calibration_:
+            # statistics are collected by the calibration pass of the following
+            # modifier, which smooths each layer with `smooth_layer`
+            return True
+
+        self.run_calibration(state.model, state.data.calib)
+
+        return True
+
+    def run_calibration(self, model: Module, calibration_dataloader: List):
+        """
+        Run a calibration pass over the whole model and apply smoothing
+
+        :param model: model to smooth
+        :param calibration_dataloader: calibration data to collect dynamic ranges with
+        """
+        if self.sequential_targets is not None:
+            layers = get_layers(self.sequential_targets, model)
+            if self.mappings_within_layers(list(layers.values())):
+                self._calibrate_sequential(model, calibration_dataloader, layers)
+                return
+
+            logger.warning(
+                "Not all smoothed activations are within a single sequential layer, "
+                "running SmoothQuant calibration through the whole model"
+            )
+
+        self._calibrate(model, calibration_dataloader)
+        self._apply_smoothing(model)
+
+    def mappings_within_layers(self, layers: List[Module]) -> bool:
+        """
+        :param layers: layers of the model which calibration data is passed through
+            one at a time
+        :return: True if each smoothed activation and its balance layers are within
+            a single one of the layers
+        """
+        layer_modules = [set(layer.modules()) for layer in layers]
+        for mapping in self.resolved_mappings_:
+            mapping_modules = [mapping.smooth_layer, *mapping.balance_layers]
+            if not any(
+                all(module in modules for module in mapping_modules)
+                for modules in layer_modules
+            ):
+                return False
 
         return True
 
+    @torch.no_grad()
+    def smooth_layer(self, model: Module, layer: Module) -> Dict[Module, torch.Tensor]:
+        """
+        Apply smoothing to the activations within a layer of the model, such as a
+        decoder layer, once calibration data has been passed through it. Used when
+        the calibration of this modifier is run by another modifier, which passes
+        calibration data through the model one layer at a time
+
+        :param model: model containing the layer
+        :param layer: layer containing the activations to smooth
+        :return: mapping from each balance layer to the scales its inputs were
+            divided by
+        """
+        submodules = set(layer.modules())
+        input_scales = {}
+        for mapping in self.resolved_mappings_:
+            if mapping.smooth_layer not in submodules:
+                continue
+
+            self.scale_hooks_.pop(mapping.smooth_name).remove()
+            scales = self._smooth_mapping(model, mapping)
+            for balance_layer in mapping.balance_layers:
+                input_scales[balance_layer] = scales
+
+        return input_scales
+
     def on_finalize(self, state: State, **kwargs) -> bool:
         """
         Clean up by clearing the scale and mapping data
@@ -142,6 +259,8 @@ class SmoothQuantModifier(Modifier):
         """
         if self.scales_ is not None:
             self.scales_.clear()
+        if self.search_inputs_ is not None:
+            self.search_inputs_.clear()
         if self.resolved_mappings_ is not None:
             self.resolved_mappings_.clear()
 
@@ -199,34 +318,54 @@ class SmoothQuantModifier(Modifier):
         """
 
         def create_hook_fn(layer_name):
+            batch_vals = None
+            generator = torch.Generator().manual_seed(0)
+
+            @torch.no_grad()
             def hook_fn(module, inp, out):
                 # update the per-channel min/max output values seen during calibration
+                nonlocal batch_vals
                 if isinstance(out, tuple):
                     out = out[0]
 
                 hidden_dim = out.shape[-1]
-                out = out.view(-1, hidden_dim)
-                latest_mins = torch.min(out, dim=0)[0]
-                latest_maxes = torch.max(out, dim=0)[0]
-
-                if layer_name in self.scales_:
-                    self.scales_[layer_name].min_channel_vals = torch.minimum(
-                        self.scales_[layer_name].min_channel_vals, latest_mins
-                    )
-                    self.scales_[layer_name].max_channel_vals = torch.maximum(
-                        self.scales_[layer_name].max_channel_vals, latest_maxes
-                    )
-                else:
-                    self.scales_[layer_name] = SmoothQuantScale(
-                        min_channel_vals=latest_mins, max_channel_vals=latest_maxes
+                out = out.reshape(-1, hidden_dim)
+
+                scale = self.scales_.get(layer_name)
+                if scale is None:
+                    # preallocate the running range and the range of a single batch
+                    kwargs = dict(dtype=out.dtype, device=out.device)
+                    scale = SmoothQuantScale(
+                        min_channel_vals=torch.full(
+                            (hidden_dim,), float("inf"), **kwargs
+                        ),
+                        max_channel_vals=torch.full(
+                            (hidden_dim,), float("-inf"), **kwargs
+                        ),
                     )
+                    self.scales_[layer_name] = scale
+                    batch_vals = torch.empty((2, hidden_dim), **kwargs)
+
+                torch.aminmax(out, dim=0, out=(batch_vals[0], batch_vals[1]))
+                torch.minimum(
+                    scale.min_channel_vals, batch_vals[0], out=scale.min_channel_vals
+                )
+                torch.maximum(
+                    scale.max_channel_vals, batch_vals[1], out=scale.max_channel_vals
+                )
+
+                if self.smoothing_strength_grid is not None:
+                    self._cache_search_inputs(layer_name, out, generator)
 
             return hook_fn
 
+        self.scale_hooks_ = {}
         for mapping in self.resolved_mappings_:
             name = mapping.smooth_name
             layer = mapping.smooth_layer
-            self.register_hook(layer, create_hook_fn(name), "forward")
+            self.scale_hooks_[name] = self.register_hook(
+                layer, create_hook_fn(name), "forward"
+            )
 
     @torch.no_grad()
     def _calibrate(self, model: Module, calibration_dataloader: List):
@@ -255,6 +394,51 @@ class SmoothQuantModifier(Modifier):
         # remove the hooks now that we are done calibrating
         self.remove_hooks()
 
+    @torch.no_grad()
+    def _calibrate_sequential(
+        self,
+        model: Module,
+        calibration_dataloader: List,
+        layers: Dict[str, Module],
+    ):
+        """
+        Catch the output dynamic ranges of each layer that will be smoothed by passing
+        calibration_dataloader through one sequential layer at a time, smoothing each
+        layer before moving on to the next one. Smoothing does not change the outputs
+        of a layer, so they are used as inputs to the next layer
+        """
+        class_name = self.__class__.__name__.replace("PyTorch", "")
+        logger.info(
+            f"Running {class_name} sequential calibration with "
+            f"{len(calibration_dataloader)} samples..."
+        )
+        if not calibration_dataloader:
+            raise ValueError(
+                "Calibration data loader not set, must populate the calib_data field of"
+                " CompressionSession to run the SmoothQuant modifier"
+            )
+
+        with DisableKVCache(model):
+            # capture the inputs to the first layer
+            early_stop_handle = set_early_stop(next(iter(layers.values())))
+            try:
+                intermediates = run_calibration_forward(
+                    model,
+                    calibration_dataloader,
+                    self.num_calibration_steps,
+                    self.calibration_function,
+                    intermediates=IntermediatesCache(),
+                )
+            finally:
+                early_stop_handle.remove()
+
+            for layer in layers.values():
+                intermediates = run_layer_forward(layer, intermediates)
+                self.smooth_layer(model, layer)
+
+        # clear out allocated smoothing scales
+        torch.cuda.empty_cache()
+
     @torch.no_grad()
     def _apply_smoothing(self, model: Module):
         """
@@ -268,53 +452,159 @@ class SmoothQuantModifier(Modifier):
         """
         logger.info("Smoothing activation scales...")
         for mapping in self.resolved_mappings_:
-            activation_scales = (  # get dynamic range for each activation channel
-                self.scales_[mapping.smooth_name].max_channel_vals
-                - self.scales_[mapping.smooth_name].min_channel_vals
-            )
-            smooth_layer = mapping.smooth_layer
-            balance_layers = mapping.balance_layers
+            self._smooth_mapping(model, mapping)
+
+        # clear out allocated smoothing scales
+        torch.cuda.empty_cache()
 
-            scales = self._calculate_smoothing_scales(balance_layers, activation_scales)
-            scales = torch.maximum(
-                scales, torch.Tensor([MINIMUM_SMOOTHING_SCALE]).to(scales.device)
+    @torch.no_grad()
+    def _smooth_mapping(
+        self, model: Module, mapping: SmoothQuantMapping
+    ) -> torch.Tensor:
+        """
+        Apply smoothing to a single activation using its calibrated dynamic range
+
+        :param model: model containing the mapping
+        :param mapping: activation to smooth and the weights to balance
+        :return: channel-wise scales the activation was divided by
+        """
+        activation_scales = (  # get dynamic range for each activation channel
+            self.scales_[mapping.smooth_name].max_channel_vals
+            - self.scales_[mapping.smooth_name].min_channel_vals
+        )
+        smooth_layer = mapping.smooth_layer
+        balance_layers = mapping.balance_layers
+
+        smoothing_strength = None
+        if self.smoothing_strength_grid is not None:
+            smoothing_strength = self._search_smoothing_strength(
+                mapping, activation_scales
+            )
+            self.smoothing_strengths_[mapping.smooth_name] = smoothing_strength
+            logger.debug(
+                f"Smoothing {mapping.smooth_name} with strength {smoothing_strength}"
             )
 
-            @torch.no_grad()
-            def smooth(module):
-                if module in balance_layers:
-                    module.weight.mul_(scales.view(1, -1))
-                elif module == smooth_layer:
-                    if module.weight.ndim == 1:
-                        module.weight.div_(scales)
-                    else:
-                        module.weight.div_(scales.view(-1, 1))
-                    if hasattr(module, "bias") and module.bias is not None:
-                        module.bias.div_(scales)
-
-            parent = get_fsdp_parent(mapping.smooth_name, model)
-            if parent is not None:
-                parent.apply(smooth)
-            else:
-                # if we're not running with FSDP we can apply smoothing directly
-                for layer in balance_layers:
-                    smooth(layer)
-                smooth(smooth_layer)
+        scales = self._calculate_smoothing_scales(
+            balance_layers, activation_scales, smoothing_strength
+        )
+        scales = torch.maximum(
+            scales, torch.Tensor([MINIMUM_SMOOTHING_SCALE]).to(scales.device)
+        )
 
-        # clear out allocated smoothing scales
-        torch.cuda.empty_cache()
+        @torch.no_grad()
+        def smooth(module):
+            if module in balance_layers:
+                module.weight.mul_(scales.view(1, -1))
+            elif module == smooth_layer:
+                if module.weight.ndim == 1:
+                    module.weight.div_(scales)
+                else:
+                    module.weight.div_(scales.view(-1, 1))
+                if hasattr(module, "bias") and module.bias is not None:
+                    module.bias.div_(scales)
+
+        parent = get_fsdp_parent(mapping.smooth_name, model)
+        if parent is not None:
+            parent.apply(smooth)
+        else:
+            # if we're not running with FSDP we can apply smoothing directly
+            for layer in balance_layers:
+                smooth(layer)
+            smooth(smooth_layer)
+
+        return scales
+
+    def _cache_search_inputs(
+        self,
+        layer_name: str,
+        activations: torch.Tensor,
+        generator: torch.Generator,
+    ):
+        """
+        Keep a uniform sample of up to max_search_tokens rows of the activations of a
+        mapping over all calibration batches. Each row is given a random key and the
+        rows with the smallest keys seen so far are kept, so that every batch is
+        equally likely to contribute rows to the sample
+
+        :param layer_name: name of the activation layer
+        :param activations: activations of shape (tokens, channels)
+        :param generator: generator to draw the keys of the rows with
+        """
+        keys = torch.rand(len(activations), generator=generator)
+        keys = keys.to(activations.device)
+        if len(keys) > self.max_search_tokens:
+            keys, indices = keys.topk(self.max_search_tokens, largest=False)
+            activations = activations[indices]
+
+        cached = self.search_inputs_.get(layer_name)
+        if cached is not None:
+            keys = torch.cat([cached[0], keys])
+            activations = torch.cat([cached[1], activations])
+            if len(keys) > self.max_search_tokens:
+                keys, indices = keys.topk(self.max_search_tokens, largest=False)
+                activations = activations[indices]
+
+        self.search_inputs_[layer_name] = (keys, activations.clone())
+
+    @torch.no_grad()
+    def _search_smoothing_strength(
+        self, mapping: SmoothQuantMapping, activation_scales: torch.Tensor
+    ) -> float:
+        """
+        Choose the smoothing strength of a mapping from smoothing_strength_grid by the
+        error of the balance layer outputs for the cached activations, when both the
+        smoothed activations and balanced weights are quantized to 8 bits. The
+        candidates are evaluated with one batched matmul per chunk of candidates
+
+        :param mapping: activation to smooth and the weights to balance
+        :param activation_scales: channel-wise dynamic range of the activations
+        :return: smoothing strength with the lowest output error
+        """
+        weight = torch.cat([layer.weight for layer in mapping.balance_layers], dim=0)
+        weight = weight.float()
+        _, inputs = self.search_inputs_.pop(mapping.smooth_name)
+        inputs = inputs.to(weight.device, torch.float32)
+        expected = inputs @ weight.T
+
+        candidates = torch.tensor(self.smoothing_strength_grid, device=weight.device)
+        scales = self._calculate_smoothing_scales(
+            mapping.balance_layers,
+            activation_scales.to(weight.device, torch.float32),
+            candidates.unsqueeze(1),
+        )
+        scales = scales.clamp(min=MINIMUM_SMOOTHING_SCALE)
+
+        errors = []
+        chunk_size = max(SEARCH_CHUNK_NUMEL // weight.numel(), 1)
+        for chunk_scales in scales.split(chunk_size):
+            smoothed_inputs = _fake_quantize_rows(inputs / chunk_scales.unsqueeze(1))
+            balanced_weights = _fake_quantize_rows(weight * chunk_scales.unsqueeze(1))
+            outputs = torch.bmm(smoothed_inputs, balanced_weights.transpose(1, 2))
+            errors.append((outputs - expected).pow(2).mean(dim=(1, 2)))
+
+        return self.smoothing_strength_grid[torch.cat(errors).argmin().item()]
 
     def _calculate_smoothing_scales(
-        self, balance_layers: List[Module], activation_scales: torch.Tensor
-    ) -> List[float]:
+        self,
+        balance_layers: List[Module],
+        activation_scales: torch.Tensor,
+        smoothing_strength: Union[float, torch.Tensor, None] = None,
+    ) -> torch.Tensor:
         """
         Calculate how much smoothing to apply to each channel based on the dynamic
         range of the activation and the following weights
 
         :param balance_layers: layers to offset activation smoothing to
         :param activation_scales: channel-wise dynamic range of activations to smooth
+        :param smoothing_strength: optional smoothing strength to use instead of
+            smoothing_strength, a tensor of shape (candidates, 1) calculates the
+            scales of each candidate strength
         :return: channel-wise scales to use for smoothing activations
         """
+        if smoothing_strength is None:
+            smoothing_strength = self.smoothing_strength
+
         # get the channel-wise dynamic range for each layer to be balanced
         weight_scales = []
         for layer in balance_layers:
@@ -325,8 +615,22 @@ class SmoothQuantModifier(Modifier):
         # calculate the amount of smoothing to apply
         # s_j = max(|X_j|)^alpha / max(|W_j|)^(1-alpha)
         # where j is the input channel, alpha is smoothing strength
-        scales = activation_scales.pow(self.smoothing_strength) / weight_scales.pow(
-            1 - self.smoothing_strength
+        scales = activation_scales.pow(smoothing_strength) / weight_scales.pow(
+            1 - smoothing_strength
         )
         scales = torch.where(weight_scales > 0.0, scales, activation_scales)
         return scales
+
+
+def _fake_quantize_rows(value: torch.Tensor, num_bits: int = 8) -> torch.Tensor:
+    """
+    Symmetric fake quantization with a scale for each row of the last two dimensions
+
+    :param value: tensor to quantize
+    :param num_bits: number of bits to quantize to
+    :return: quantized and dequantized tensor
+    """
+    q_max = 2 ** (num_bits - 1) - 1
+    scale = value.abs().amax(dim=-1, keepdim=True) / q_max
+    scale = scale.clamp(min=torch.finfo(scale.dtype).tiny)
+    return (value / scale).round().clamp(-q_max - 1, q_max) * scale
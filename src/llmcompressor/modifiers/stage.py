@@ -119,6 +119,8 @@ class StageModifiers(ModifierInterface, BaseModel):
         if self.applied:
             return
 
+        self._fuse_calibration()
+
         accelerator = kwargs.get("accelerator", None)
         for modifier in self.modifiers:
             modifier.initialize(state, **kwargs)
@@ -162,3 +164,17 @@ class StageModifiers(ModifierInterface, BaseModel):
 
         for modifier in self.modifiers:
             modifier.update_event(state, event, **kwargs)
+
+    def _fuse_calibration(self):
+        """
+        Let each modifier take over the calibration of the modifier initialized
+        directly before it, so that they share a single pass over the calibration data
+        """
+        for previous, modifier in zip(self.modifiers, self.modifiers[1:]):
+            if previous.initialized or modifier.initialized:
+                continue
+            if modifier.fuse_calibration(previous):
+                logger.info(
+                    f"{modifier.__class__.__name__} runs the calibration of "
+                    f"{previous.__class__.__name__}"
+                )
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Set
+from typing import List, Optional, Set
 
 import torch
 import torch.nn as nn
@@ -79,6 +79,46 @@ class ModuleCompressionWrapper(Module, ABC):
         """
         raise NotImplementedError("Child class must implement `add_batch`")
 
+    def share_statistics(self, wrapper: "ModuleCompressionWrapper") -> bool:
+        """
+        Accumulate layer statistics into those of another wrapper which observes
+        identical inputs, so that they are only calculated once
+
+        :param wrapper: wrapper whose statistics will be shared
+        :return: True if statistics are shared, False if sharing is not supported
+        """
+        return False
+
+    def unshare_statistics(self, exclude_latest_batch: bool = False):
+        """
+        Copy shared layer statistics so that future batches are accumulated
+        separately from the wrapper they were shared with
+
+        :param exclude_latest_batch: if True, exclude the latest batch accumulated by
+            the wrapper the statistics were shared with
+        """
+        pass
+
+    def all_reduce_statistics(self):
+        """
+        Sum the layer statistics accumulated by each rank of the process group, used
+        for data parallel calibration
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support data parallel calibration"
+        )
+
+    def scale_inputs(self, scales: torch.Tensor):
+        """
+        Update the layer statistics after the inputs of the layer were divided by
+        channel-wise scales, such as by smoothing the activations which feed into it
+
+        :param scales: scales of shape (columns,) which inputs were divided by
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support scaling its inputs"
+        )
+
     @abstractmethod
     def compress(self, *args, **kwargs):
         """
@@ -86,6 +126,19 @@ class ModuleCompressionWrapper(Module, ABC):
         """
         raise NotImplementedError("Child class must implement `compress`")
 
+    @classmethod
+    def compress_batch(cls, wrappers: List["ModuleCompressionWrapper"], **kwargs):
+        """
+        Run compression on a batch of modules with weights of the same shape, such as
+        the experts of a mixture of experts layer. Compresses the modules one at a
+        time unless overridden by a child class
+
+        :param wrappers: wrappers of the modules to compress
+        :param kwargs: keyword arguments passed to `compress`
+        """
+        for wrapper in wrappers:
+            wrapper.compress(**kwargs)
+
     def state_dict(self, destination=None, prefix="", keep_vars=False, **kwargs):
         """
         Pass request to wrapped layer, so compression wrapper does not appear in
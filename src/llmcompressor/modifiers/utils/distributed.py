@@ -0,0 +1,102 @@
+from typing import Any, Iterable, List
+
+import torch
+import torch.distributed as dist
+from compressed_tensors.utils import is_module_offloaded, update_parameter_data
+from torch.nn import Module
+
+__all__ = [
+    "validate_data_parallel",
+    "shard_dataloader",
+    "all_reduce_sum",
+    "broadcast_tensor",
+    "broadcast_module_parameters",
+]
+
+
+def validate_data_parallel():
+    """
+    Check that a process group is available for data parallel calibration
+
+    :raises ValueError: if torch.distributed is not initialized
+    """
+    if not dist.is_available() or not dist.is_initialized():
+        raise ValueError(
+            "Data parallel calibration requires an initialized torch.distributed "
+            "process group. Launch one process per worker, for example with torchrun, "
+            'and call torch.distributed.init_process_group("gloo") before running '
+            "oneshot"
+        )
+
+
+def shard_dataloader(dataloader: Iterable) -> List[Any]:
+    """
+    Select the calibration batches processed by the current rank. Batches are
+    assigned to ranks in a round robin fashion
+
+    :param dataloader: calibration data shared by all ranks
+    :return: batches of the current rank
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    batches = [
+        batch
+        for batch_index, batch in enumerate(dataloader)
+        if batch_index % world_size == rank
+    ]
+    if len(batches) == 0:
+        raise ValueError(
+            f"Rank {rank} received no calibration data, use at least as many "
+            f"calibration batches as processes ({world_size})"
+        )
+
+    return batches
+
+
+def all_reduce_sum(tensor: torch.Tensor):
+    """
+    Sum a tensor across all ranks in place
+
+    :param tensor: tensor to reduce
+    """
+    _communicate(tensor, lambda buffer: dist.all_reduce(buffer, op=dist.ReduceOp.SUM))
+
+
+def broadcast_tensor(tensor: torch.Tensor, src: int = 0):
+    """
+    Overwrite a tensor in place with its value on the source rank
+
+    :param tensor: tensor to broadcast
+    :param src: rank to broadcast from
+    """
+    _communicate(tensor, lambda buffer: dist.broadcast(buffer, src=src))
+
+
+def broadcast_module_parameters(module: Module, src: int = 0):
+    """
+    Overwrite the direct parameters of a module, such as its weight and quantization
+    parameters, with their values on the source rank
+
+    :param module: module to broadcast the parameters of
+    :param src: rank to broadcast from
+    """
+    offloaded = is_module_offloaded(module)
+    if offloaded:
+        module._hf_hook.pre_forward(module)
+
+    for name, param in module.named_parameters(recurse=False):
+        broadcast_tensor(param.data, src=src)
+        if offloaded:
+            update_parameter_data(module, param.data, name)
+
+    if offloaded:
+        module._hf_hook.post_forward(module, None)
+
+
+def _communicate(tensor: torch.Tensor, fn):
+    # gloo only supports cpu tensors
+    if dist.get_backend() == dist.Backend.GLOO and tensor.device.type != "cpu":
+        buffer = tensor.cpu()
+        fn(buffer)
+        tensor.copy_(buffer)
+    else:
+        fn(tensor)
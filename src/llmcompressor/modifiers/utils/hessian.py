@@ -0,0 +1,175 @@
+from typing import List, Optional, Tuple
+
+import torch
+from loguru import logger
+
+__all__ = [
+    "HESSIAN_CHUNK_SIZE",
+    "DAMPENING_GROWTH",
+    "MIN_RETRY_DAMPENING",
+    "accumulate_hessian",
+    "normalize_hessian",
+    "invert_hessian",
+    "batch_invert_hessian",
+]
+
+HESSIAN_CHUNK_SIZE: int = 2048
+DAMPENING_GROWTH: float = 2.0
+MIN_RETRY_DAMPENING: float = 1e-3
+
+
+def accumulate_hessian(
+    H: torch.Tensor,
+    inp: torch.Tensor,
+    max_tokens: Optional[int] = None,
+    chunk_size: int = HESSIAN_CHUNK_SIZE,
+    generator: Optional[torch.Generator] = None,
+):
+    """
+    Accumulate module inputs into an unnormalized Hessian in place, H += X^T X.
+    Tokens are processed in chunks, so the temporary copies of the inputs in the
+    dtype of H are at most chunk_size tokens long
+
+    :param H: unnormalized Hessian of shape (columns, columns)
+    :param inp: module inputs of shape (num_tokens, columns)
+    :param max_tokens: optional maximum number of tokens to accumulate. If there are
+        more tokens, a random subset is accumulated and scaled such that H remains an
+        unbiased estimate
+    :param chunk_size: number of tokens to accumulate at once
+    :param generator: optional cpu generator to subsample tokens with, so that the
+        sampled tokens are reproducible on any device
+    """
+    num_tokens = inp.shape[0]
+    scale = 1.0
+    if max_tokens is not None and num_tokens > max_tokens:
+        indices = torch.randperm(num_tokens, generator=generator)[:max_tokens]
+        inp = inp[indices.to(inp.device)]
+        scale = num_tokens / max_tokens
+
+    for chunk in inp.split(chunk_size):
+        chunk = chunk.to(device=H.device, dtype=H.dtype)
+        H.addmm_(chunk.t(), chunk, alpha=scale)
+
+
+def normalize_hessian(H: torch.Tensor, nsamples: torch.Tensor):
+    """
+    Normalize a Hessian accumulated with `accumulate_hessian` in place, such that it
+    is the mean over calibration samples, H = 2 / nsamples * X^T X
+
+    :param H: unnormalized Hessian
+    :param nsamples: number of calibration samples accumulated into H
+    """
+    H *= 2 / nsamples.clamp(min=1)
+
+
+def invert_hessian(
+    H: torch.Tensor,
+    percdamp: float,
+    max_percdamp: Optional[float] = None,
+    name: str = "",
+) -> Tuple[torch.Tensor, float]:
+    """
+    Compute the upper cholesky factor of the dampened inverse of a Hessian. If the
+    dampened Hessian is not numerically positive definite, the dampening is increased
+    geometrically by DAMPENING_GROWTH, starting from at least MIN_RETRY_DAMPENING, up
+    to max_percdamp. As a last resort, the
+    inverse is computed from an eigendecomposition of the Hessian with eigenvalues
+    clamped to the maximum dampening
+
+    :param H: normalized Hessian, whose diagonal is modified in place
+    :param percdamp: amount of dampening to apply to H, as a fraction of the
+        diagonal mean
+    :param max_percdamp: maximum dampening to retry with. Defaults to percdamp, in
+        which case there are no retries
+    :param name: name of the module the Hessian belongs to, used for logging
+    :return: tuple of the upper cholesky factor of the inverse Hessian and the
+        dampening fraction used. If eigenvalues were clamped, this is the fraction of
+        the diagonal mean they were clamped to
+    """
+    if max_percdamp is None:
+        max_percdamp = percdamp
+
+    diag = torch.arange(H.shape[0], device=H.device)
+    diag_values = H[diag, diag].clone()
+    diag_mean = torch.mean(diag_values)
+
+    damp_frac = percdamp
+    while True:
+        H[diag, diag] = diag_values + damp_frac * diag_mean
+        try:
+            Hinv = torch.linalg.cholesky(H)
+            Hinv = torch.cholesky_inverse(Hinv)
+            Hinv = torch.linalg.cholesky(Hinv, upper=True)
+        except torch._C._LinAlgError:
+            if damp_frac >= max_percdamp:
+                break
+
+            damp_frac = max(damp_frac * DAMPENING_GROWTH, MIN_RETRY_DAMPENING)
+            damp_frac = min(damp_frac, max_percdamp)
+            logger.warning(
+                f"Failed to invert the Hessian of {name}, retrying with "
+                f"dampening_frac={damp_frac}"
+            )
+            continue
+
+        return Hinv, damp_frac
+
+    logger.warning(
+        f"Failed to invert the Hessian of {name} with dampening_frac={damp_frac}, "
+        "falling back to clamping its eigenvalues. Consider increasing the number of "
+        "calibration samples or shuffling the calibration dataset"
+    )
+    H[diag, diag] = diag_values
+    eigenvalues, eigenvectors = torch.linalg.eigh(H)
+    eigenvalues = eigenvalues.clamp(min=max_percdamp * diag_mean)
+    Hinv = (eigenvectors / eigenvalues) @ eigenvectors.T
+    Hinv = torch.linalg.cholesky(Hinv, upper=True)
+
+    return Hinv, max_percdamp
+
+
+def batch_invert_hessian(
+    H: torch.Tensor,
+    percdamp: float,
+    max_percdamp: Optional[float] = None,
+    names: Optional[List[str]] = None,
+) -> Tuple[torch.Tensor, List[float]]:
+    """
+    Compute the upper cholesky factors of the dampened inverses of a batch of
+    Hessians at once. Hessians which cannot be inverted with the initial dampening
+    are inverted individually using `invert_hessian`
+
+    :param H: normalized Hessians of shape (batch, columns, columns), whose
+        diagonals are modified in place
+    :param percdamp: amount of dampening to apply to H, as a fraction of the
+        diagonal mean
+    :param max_percdamp: maximum dampening to retry with
+    :param names: optional names of the modules the Hessians belong to, used for
+        logging
+    :return: tuple of the upper cholesky factors of the inverse Hessians and the
+        dampening fraction used for each Hessian
+    """
+    diag = torch.diagonal(H, dim1=-2, dim2=-1)
+    diag_values = diag.clone()
+    diag += percdamp * torch.mean(diag_values, dim=-1, keepdim=True)
+
+    Hinv, info = torch.linalg.cholesky_ex(H)
+    failed = info != 0
+
+    # failed factorizations are replaced so that the batched inverse succeeds
+    identity = torch.eye(H.shape[-1], dtype=H.dtype, device=H.device)
+    Hinv = torch.where(failed.reshape(-1, 1, 1), identity, Hinv)
+    Hinv = torch.cholesky_inverse(Hinv)
+    Hinv, info = torch.linalg.cholesky_ex(Hinv, upper=True)
+    failed |= info != 0
+
+    damp_fracs = [percdamp] * H.shape[0]
+    failed = torch.nonzero(failed).flatten().tolist()
+    for index in failed:
+        diag[index] = diag_values[index]
+        name = names[index] if names is not None else ""
+        Hinv[index], damp_fracs[index] = invert_hessian(
+            H[index], percdamp, max_percdamp, name
+        )
+
+    return Hinv, damp_fracs
@@ -0,0 +1,236 @@
+import os
+import tempfile
+import weakref
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import torch
+
+__all__ = ["IntermediatesCache"]
+
+
+@dataclass
+class _OffloadedTensor:
+    """
+    Activation stored in host memory or a memory-mapped file
+
+    :param buffer: contiguous storage of the activation, possibly down-cast
+    :param dtype: original dtype of the activation
+    """
+
+    buffer: torch.Tensor
+    dtype: torch.dtype
+
+
+class _MemoryBudget:
+    """
+    Tracks the host memory used by activation buffers, which may be shared between
+    multiple caches
+
+    :param max_memory: maximum number of bytes to allocate, or None for no limit
+    """
+
+    def __init__(self, max_memory: Optional[int] = None):
+        self.max_memory = max_memory
+        self.used = 0
+
+    def reserve(self, num_bytes: int) -> bool:
+        if self.max_memory is not None and self.used + num_bytes > self.max_memory:
+            return False
+
+        self.used += num_bytes
+        return True
+
+    def release(self, num_bytes: int):
+        self.used -= num_bytes
+
+
+class IntermediatesCache:
+    """
+    Stores the inputs of a layer for each calibration sample in a compact form.
+    Activations (positional args) are copied into contiguous, pinned host buffers,
+    optionally down-cast to a smaller dtype. Once the host memory budget is exceeded,
+    further activations are written to memory-mapped files. Keyword inputs such as
+    attention masks and position embeddings are usually identical between samples,
+    so identical keyword tensors are stored only once and kept on their device
+
+    Samples are fetched as `(args, kwargs)` tuples, with activations on cpu in their
+    original dtype. The attention mask of each sample's calibration batch, used to
+    exclude padding tokens from calibration statistics, is stored alongside it
+
+    :param offload_dtype: optional floating point dtype to store activations in, for
+        example "bfloat16". Defaults to storing activations in their original dtype
+    :param max_memory: optional number of bytes of host memory to use for stored
+        activations. The budget is shared by caches created with `like`
+    :param offload_dir: directory to write memory-mapped activations to once the
+        memory budget is exceeded. Defaults to the system temporary directory
+    """
+
+    def __init__(
+        self,
+        offload_dtype: Union[str, torch.dtype, None] = None,
+        max_memory: Optional[int] = None,
+        offload_dir: Optional[str] = None,
+    ):
+        if isinstance(offload_dtype, str):
+            dtype = getattr(torch, offload_dtype, None)
+            if not isinstance(dtype, torch.dtype):
+                raise ValueError(f"Unrecognized offload dtype {offload_dtype}")
+            offload_dtype = dtype
+
+        self.offload_dtype = offload_dtype
+        self.offload_dir = offload_dir
+        self._budget = _MemoryBudget(max_memory)
+        self._pin_memory = torch.cuda.is_available()
+        self._samples: List[Tuple[Any, Any, Optional[torch.Tensor]]] = []
+
+        # keyword tensors already stored, keyed by shape, dtype, device and content.
+        # Tensors are dropped once no cache sharing the dictionary refers to them
+        self._kwargs_tensors: weakref.WeakValueDictionary = (
+            weakref.WeakValueDictionary()
+        )
+
+    @classmethod
+    def like(cls, intermediates: "IntermediatesCache") -> "IntermediatesCache":
+        """
+        Create an empty cache with the same settings as an existing cache, sharing its
+        memory budget and deduplicated keyword tensors
+
+        :param intermediates: existing cache
+        :return: empty cache
+        """
+        cache = cls(intermediates.offload_dtype, offload_dir=intermediates.offload_dir)
+        cache._budget = intermediates._budget
+        cache._kwargs_tensors = intermediates._kwargs_tensors
+        return cache
+
+    def append(
+        self,
+        args: Any,
+        kwargs: Dict[str, Any],
+        attention_mask: Optional[torch.Tensor] = None,
+    ):
+        """
+        Store the inputs of a layer for one calibration sample
+
+        :param args: positional inputs, whose tensors are offloaded
+        :param kwargs: keyword inputs, whose tensors are deduplicated
+        :param attention_mask: optional attention mask of the calibration batch
+        """
+        self._samples.append(
+            (
+                self._offload(args),
+                self._deduplicate(kwargs),
+                self._deduplicate(attention_mask),
+            )
+        )
+
+    def get_attention_mask(self, index: int) -> Optional[torch.Tensor]:
+        """
+        :param index: index of the calibration sample
+        :return: attention mask of the calibration batch of the sample, if stored
+        """
+        return self._samples[index][2]
+
+    def __getitem__(self, index: int) -> Tuple[Any, Dict[str, Any]]:
+        args, kwargs, _ = self._samples[index]
+        return self._onload(args), kwargs
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def __iter__(self) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # memory-mapped buffers are serialized as regular tensors, which are not
+        # accounted for by a restored memory budget
+        state = self.__dict__.copy()
+        state["_budget"] = _MemoryBudget(self._budget.max_memory)
+        del state["_kwargs_tensors"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._kwargs_tensors = weakref.WeakValueDictionary()
+
+    def _offload(self, value: Any) -> Any:
+        if isinstance(value, torch.Tensor):
+            dtype = value.dtype
+            if self.offload_dtype is not None and value.is_floating_point():
+                dtype = self.offload_dtype
+
+            buffer = self._allocate(value.shape, dtype)
+            buffer.copy_(value)
+            return _OffloadedTensor(buffer, value.dtype)
+
+        if isinstance(value, tuple):
+            return tuple(self._offload(item) for item in value)
+        if isinstance(value, list):
+            return [self._offload(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self._offload(item) for key, item in value.items()}
+
+        return value
+
+    def _onload(self, value: Any) -> Any:
+        if isinstance(value, _OffloadedTensor):
+            return value.buffer.to(value.dtype)
+
+        if isinstance(value, tuple):
+            return tuple(self._onload(item) for item in value)
+        if isinstance(value, list):
+            return [self._onload(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self._onload(item) for key, item in value.items()}
+
+        return value
+
+    def _deduplicate(self, value: Any) -> Any:
+        if isinstance(value, torch.Tensor):
+            key = (value.shape, value.dtype, value.device, _hash_content(value))
+            stored = self._kwargs_tensors.get(key)
+            if stored is not None and (stored is value or torch.equal(stored, value)):
+                return stored
+
+            self._kwargs_tensors[key] = value
+            return value
+
+        if isinstance(value, tuple):
+            return tuple(self._deduplicate(item) for item in value)
+        if isinstance(value, list):
+            return [self._deduplicate(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self._deduplicate(item) for key, item in value.items()}
+
+        return value
+
+    def _allocate(self, shape: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        num_bytes = shape.numel() * torch.empty((), dtype=dtype).element_size()
+        if self._budget.reserve(num_bytes):
+            buffer = torch.empty(shape, dtype=dtype, pin_memory=self._pin_memory)
+            weakref.finalize(buffer, self._budget.release, num_bytes)
+            return buffer
+
+        # the file is unlinked right away, the mapping remains valid until the
+        # buffer is freed
+        file_descriptor, path = tempfile.mkstemp(suffix=".bin", dir=self.offload_dir)
+        os.close(file_descriptor)
+        try:
+            buffer = torch.from_file(
+                path, shared=True, size=shape.numel(), dtype=dtype
+            ).view(shape)
+        finally:
+            os.remove(path)
+
+        return buffer
+
+
+def _hash_content(value: torch.Tensor) -> int:
+    """
+    :param value: tensor to hash, such as an attention mask or position embeddings
+    :return: hash of the bytes of the tensor
+    """
+    data = value.detach().reshape(-1).cpu().contiguous()
+    return hash(data.view(torch.uint8).numpy().tobytes())
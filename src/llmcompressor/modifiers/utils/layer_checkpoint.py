@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from compressed_tensors.utils import is_module_offloaded, update_parameter_data
+from loguru import logger
+from torch.nn import Module
+
+from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
+from llmcompressor.utils.pytorch.module import get_prunable_layers
+
+__all__ = ["LayerCheckpoint", "get_compression_fingerprint"]
+
+
+class LayerCheckpoint:
+    """
+    Saves the progress of sequential, layer by layer compression to disk so that an
+    interrupted run can resume from the first unfinished layer. After each layer is
+    compressed, the parameters of its compressible modules (weights and quantization
+    parameters) are saved along with the intermediate inputs to the next layer
+
+    Lifecycle:
+        - load()
+        - save_layer(), after each layer is compressed
+
+    :param checkpoint_dir: directory to save the checkpoint to
+    :param fingerprint: identifier of the recipe, model and calibration data of the
+        run, a checkpoint is only loaded if it was saved with the same fingerprint
+    """
+
+    METADATA_FILENAME = "layer_checkpoint.json"
+    INTERMEDIATES_FILENAME = "intermediates.pt"
+
+    def __init__(self, checkpoint_dir: str, fingerprint: str):
+        self.checkpoint_dir = checkpoint_dir
+        self.fingerprint = fingerprint
+        self.num_completed = 0
+
+    def load(
+        self,
+        layer_compressors: List[LayerCompressor],
+        load_intermediates: bool = True,
+    ) -> Tuple[int, Optional[List[Tuple[Tuple, Dict]]]]:
+        """
+        Restore the compressed parameters of all layers completed by a previous run
+
+        :param layer_compressors: layer compressors of the current run, in order
+        :param load_intermediates: whether the intermediate inputs to the first
+            unfinished layer are required to resume compression
+        :return: number of completed layers and the intermediate inputs to the first
+            unfinished layer, or None if no intermediates were loaded
+        """
+        metadata = self._load_metadata()
+        if metadata is None or metadata["completed_layers"] == 0:
+            return 0, None
+
+        if metadata["fingerprint"] != self.fingerprint:
+            logger.warning(
+                f"Ignoring layer checkpoint at {self.checkpoint_dir}, it was created "
+                "with a different recipe, model or calibration dataset"
+            )
+            return 0, None
+
+        intermediates_path = os.path.join(
+            self.checkpoint_dir, self.INTERMEDIATES_FILENAME
+        )
+        if load_intermediates and not os.path.exists(intermediates_path):
+            logger.warning(
+                f"Ignoring layer checkpoint at {self.checkpoint_dir}, intermediates "
+                "were not saved"
+            )
+            return 0, None
+
+        num_completed = min(metadata["completed_layers"], len(layer_compressors))
+        for layer_compressor in layer_compressors[:num_completed]:
+            params = torch.load(
+                self._layer_path(layer_compressor.layer_index), map_location="cpu"
+            )
+            _load_layer_params(layer_compressor.layer, params)
+
+        intermediates = None
+        if load_intermediates:
+            intermediates = torch.load(intermediates_path)
+
+        logger.info(
+            f"Resuming compression from layer checkpoint at {self.checkpoint_dir}, "
+            f"skipping {num_completed}/{len(layer_compressors)} completed layers"
+        )
+        self.num_completed = num_completed
+        return num_completed, intermediates
+
+    def save_layer(
+        self,
+        layer_compressor: LayerCompressor,
+        intermediates: Optional[List[Tuple[Tuple, Dict]]] = None,
+    ):
+        """
+        Save the parameters of a compressed layer and the intermediate inputs to the
+        next layer. Files are written before the metadata is updated, so an
+        interruption while saving leaves the previous checkpoint intact
+
+        :param layer_compressor: compressor of the layer which was just compressed
+        :param intermediates: optional inputs to the next layer
+        """
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        params = _get_layer_params(layer_compressor.layer)
+        _atomic_save(params, self._layer_path(layer_compressor.layer_index))
+        if intermediates is not None:
+            intermediates_path = os.path.join(
+                self.checkpoint_dir, self.INTERMEDIATES_FILENAME
+            )
+            _atomic_save(intermediates, intermediates_path)
+
+        self.num_completed = layer_compressor.layer_index + 1
+        metadata_path = os.path.join(self.checkpoint_dir, self.METADATA_FILENAME)
+        with open(metadata_path + ".tmp", "w") as metadata_file:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "completed_layers": self.num_completed,
+                },
+                metadata_file,
+            )
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def _load_metadata(self) -> Optional[Dict[str, Any]]:
+        metadata_path = os.path.join(self.checkpoint_dir, self.METADATA_FILENAME)
+        if not os.path.exists(metadata_path):
+            return None
+
+        with open(metadata_path) as metadata_file:
+            return json.load(metadata_file)
+
+    def _layer_path(self, layer_index: int) -> str:
+        return os.path.join(self.checkpoint_dir, f"layer_{layer_index}.pt")
+
+
+def get_compression_fingerprint(
+    modifier: Any, model: Module, dataloader: Optional[Iterable]
+) -> str:
+    """
+    Compute an identifier of a compression run from the modifier arguments, the model
+    architecture and quantization schemes, and the calibration data
+
+    :param modifier: modifier running compression
+    :param model: model being compressed
+    :param dataloader: calibration data used for compression
+    :return: hex digest identifying the compression run
+    """
+    fingerprint = hashlib.sha256()
+
+    # modifier arguments, excluding runtime state
+    modifier_args = {
+        key: value
+        for key, value in modifier.model_dump().items()
+        if not key.endswith("_")
+        and key not in ("model", "checkpoint_dir", "intermediates_offload_dir")
+    }
+    fingerprint.update(modifier.__class__.__name__.encode())
+    fingerprint.update(json.dumps(modifier_args, sort_keys=True, default=str).encode())
+
+    # model architecture and quantization schemes
+    config = getattr(model, "config", None)
+    fingerprint.update(model.__class__.__name__.encode())
+    fingerprint.update(str(getattr(config, "_name_or_path", None)).encode())
+    for name, param in model.named_parameters():
+        fingerprint.update(f"{name}:{tuple(param.shape)}:{param.dtype}".encode())
+    for name, module in model.named_modules():
+        scheme = getattr(module, "quantization_scheme", None)
+        if scheme is not None:
+            fingerprint.update(f"{name}:{scheme.model_dump_json()}".encode())
+
+    # calibration data, independent of sample order
+    sample_digests = []
+    for batch in dataloader or []:
+        sample_digest = hashlib.sha256()
+        for key in sorted(batch.keys()):
+            sample_digest.update(key.encode())
+            sample_digest.update(torch.as_tensor(batch[key]).cpu().numpy().tobytes())
+        sample_digests.append(sample_digest.hexdigest())
+    for sample_digest in sorted(sample_digests):
+        fingerprint.update(sample_digest.encode())
+
+    return fingerprint.hexdigest()
+
+
+def _get_layer_params(layer: Module) -> Dict[str, Dict[str, torch.Tensor]]:
+    params = {}
+    for name, module in get_prunable_layers(layer).items():
+        offloaded = is_module_offloaded(module)
+        if offloaded:
+            module._hf_hook.pre_forward(module)
+
+        params[name] = {
+            param_name: param.data.cpu().clone()
+            for param_name, param in module.named_parameters(recurse=False)
+        }
+
+        if offloaded:
+            module._hf_hook.post_forward(module, None)
+
+    return params
+
+
+def _load_layer_params(layer: Module, params: Dict[str, Dict[str, torch.Tensor]]):
+    modules = get_prunable_layers(layer)
+    for name, module_params in params.items():
+        for param_name, value in module_params.items():
+            update_parameter_data(modules[name], value, param_name)
+
+
+def _atomic_save(obj: Any, path: str):
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
@@ -1,15 +1,23 @@
 import operator
-from typing import Dict, Tuple
+import re
+from typing import Dict, List, Optional
 
 import torch
-from compressed_tensors import get_execution_device
+import torch.distributed as dist
 from loguru import logger
 from torch.nn import Module
-from tqdm import tqdm
 
 from llmcompressor.modifiers.utils.compression_wrapper import ModuleCompressionWrapper
-from llmcompressor.modifiers.utils.pytorch_helpers import EarlyStopException
-from llmcompressor.pytorch.utils import tensors_to_device
+from llmcompressor.modifiers.utils.distributed import (
+    all_reduce_sum,
+    broadcast_module_parameters,
+)
+from llmcompressor.modifiers.utils.intermediates_cache import IntermediatesCache
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    get_calibration_attention_mask,
+    run_layer_forward,
+    set_early_stop,
+)
 from llmcompressor.utils.fsdp.context import (
     fix_fsdp_module_name,
     summon_full_params_context,
@@ -17,7 +25,10 @@ from llmcompressor.utils.fsdp.context import (
 from llmcompressor.utils.pytorch import set_layer
 from llmcompressor.utils.pytorch.module import get_prunable_layers
 
-__all__ = ["LayerCompressor"]
+__all__ = ["LayerCompressor", "EXPERT_PATTERN"]
+
+# matches the index of an expert in module names such as `mlp.experts.3.gate_proj`
+EXPERT_PATTERN = re.compile(r"(?<![^.])experts\.\d+(?=\.|$)")
 
 
 class LayerCompressor:
@@ -40,6 +51,11 @@ class LayerCompressor:
     :param layer: layer to run compression on
     :param layer_index: index of layer in the model
     :param args: additional keyword arguments
+    :param wrapper_args: optional keyword arguments used to initialize the wrapper of
+        each root module
+    :param expert_batch_size: optional maximum number of experts of a mixture of
+        experts layer to compress at once, using `compress_batch` of the wrapper
+        class. Defaults to compressing each root module on its own
     """
 
     def __init__(
@@ -50,6 +66,8 @@ class LayerCompressor:
         layer_index: int,
         name: str,
         args: Dict,
+        wrapper_args: Optional[Dict] = None,
+        expert_batch_size: Optional[int] = None,
     ):
         self.module_compressor_class = module_compressor_class
         self.model = model
@@ -57,10 +75,17 @@ class LayerCompressor:
         self.layer_index = layer_index
         self.name = name
         self.args = args
+        self.wrapper_args = wrapper_args or {}
+        self.expert_batch_size = expert_batch_size
         self.handles = []
         self.early_stop_handle = None
         self.modules = {}
 
+        # modules which share the statistics of another module with identical inputs
+        self.shared_inputs = {}
+        self._layer_inputs = []
+        self._accumulated = set()
+
     def compressible_modules(self) -> Dict:
         """
         Get the list of modules in the layer that can be compressed
@@ -75,13 +100,7 @@ class LayerCompressor:
         Adds an early stopping exception to the input of the layer. This will cause the
         model to immediately exit the forward pass when reaching this layer.
         """
-
-        def trigger_early_stop_fn(self, args, kwargs):
-            raise EarlyStopException(args, kwargs)
-
-        self.early_stop_handle = self.layer.register_forward_pre_hook(
-            trigger_early_stop_fn, with_kwargs=True
-        )
+        self.early_stop_handle = set_early_stop(self.layer)
 
     def clear_early_stop(self):
         """
@@ -102,7 +121,9 @@ class LayerCompressor:
             layer = subset[name]
             full_name = self._get_full_submodule_name(name)
             with summon_full_params_context(self.layer):
-                wrapper = self.module_compressor_class(full_name, layer)
+                wrapper = self.module_compressor_class(
+                    full_name, layer, **self.wrapper_args
+                )
             if len(name) == 0:  # special case if layer has no children (i.e. lm_head)
                 with summon_full_params_context(self.model):
                     set_layer(full_name, wrapper, self.model)
@@ -114,29 +135,36 @@ class LayerCompressor:
 
         def add_batch(name):
             def tmp(_, inp, out):
-                self.modules[name].add_batch(inp[0].data, out.data)
+                if self._is_shared_input(name, inp[0]):
+                    return
+                self.modules[name].add_batch(
+                    inp[0].data,
+                    out.data,
+                    attention_mask=get_calibration_attention_mask(),
+                )
+                self._accumulated.add(name)
 
             return tmp
 
+        def clear_layer_inputs(*_args):
+            self._layer_inputs = []
+            self._accumulated = set()
+
         for name in self.modules:
             self.handles.append(subset[name].register_forward_hook(add_batch(name)))
 
-    def calibrate_layer(self, intermediates: Tuple[Tuple, Dict]) -> Tuple[Tuple, Dict]:
+        # inputs are only compared within a single forward pass of the layer
+        self.handles.append(self.layer.register_forward_pre_hook(clear_layer_inputs))
+        self.handles.append(self.layer.register_forward_hook(clear_layer_inputs))
+
+    def calibrate_layer(self, intermediates: IntermediatesCache) -> IntermediatesCache:
         """
         Runs all calibration samples through the stored layer
 
         :param intermediates: inputs to run through the layer
-        :return: outputs of the layer
-        """
-        outputs = [None for _ in range(len(intermediates))]
-        for idx in tqdm(range(len(intermediates))):
-            args, kwargs = intermediates[idx]
-            device = get_execution_device(self.layer)
-            output = self.layer(*tensors_to_device(args, device), **kwargs)
-            outputs[idx] = (tensors_to_device(output, "cpu"), kwargs)
-            torch.cuda.empty_cache()
-
-        return outputs
+        :return: outputs of the layer, stored with the same settings as the inputs
+        """
+        return run_layer_forward(self.layer, intermediates)
 
     def post_compress(self):
         """
@@ -146,6 +174,9 @@ class LayerCompressor:
             handle.remove()
 
         self.handles = []
+        self.shared_inputs = {}
+        self._layer_inputs = []
+        self._accumulated = set()
 
     def revert_layer_wrappers(self):
         """
@@ -161,22 +192,137 @@ class LayerCompressor:
             torch.cuda.empty_cache()
         self.modules = None
 
-    def compress(self):
+    def scale_inputs(self, input_scales: Dict[Module, torch.Tensor]):
+        """
+        Update the statistics of wrapped submodules whose inputs were divided by
+        channel-wise scales after calibration, such as by SmoothQuant
+
+        :param input_scales: mapping from submodules to the scales their inputs were
+            divided by
+        """
+        for name, module in self.modules.items():
+            # modules with shared inputs are scaled through the module they share with
+            if module.layer in input_scales and name not in self.shared_inputs:
+                module.scale_inputs(input_scales[module.layer])
+
+    def compress(self, data_parallel: bool = False):
         """
         Apply compression to each wrapped submodule in the layer
+
+        :param data_parallel: if True, each rank of the process group has calibrated
+            the layer on a shard of the calibration data. Statistics are summed across
+            ranks, rank 0 compresses each submodule and broadcasts its weights and
+            quantization parameters to the other ranks
         """
+        if data_parallel:
+            # statistics of modules with shared inputs are reduced through the module
+            # they are shared with
+            self._synchronize_shared_inputs()
+            for name, module in self.modules.items():
+                if name not in self.shared_inputs:
+                    module.all_reduce_statistics()
 
-        @torch.no_grad()
-        def compress_module(module):
-            if isinstance(module, self.module_compressor_class):
-                full_name = self._get_full_submodule_name(module.name)
-                logger.info(f"Compressing {full_name}...")
-                module.compress(**self.args)
+        for batch in self._get_compression_batches():
+            if not data_parallel or dist.get_rank() == 0:
+                for module in batch:
+                    full_name = self._get_full_submodule_name(module.name)
+                    logger.info(f"Compressing {full_name}...")
+                with torch.no_grad():
+                    if len(batch) == 1:
+                        batch[0].compress(**self.args)
+                    else:
+                        self.module_compressor_class.compress_batch(batch, **self.args)
+
+            for module in batch:
                 module.free()
+                if data_parallel:
+                    broadcast_module_parameters(module.layer, src=0)
 
-        self.layer.apply(compress_module)
         torch.cuda.empty_cache()
 
+    def _get_compression_batches(self) -> List[List[ModuleCompressionWrapper]]:
+        """
+        Group the wrapped submodules into batches which are compressed together. If
+        expert_batch_size is set, the same submodule of each expert of a mixture of
+        experts layer, such as `experts.0.w1` and `experts.1.w1`, is batched.
+        Otherwise each submodule is compressed on its own
+
+        :return: batches of wrapped submodules, in the order of the layer
+        """
+        if self.expert_batch_size is None:
+            return [[module] for module in self.modules.values()]
+
+        groups = {}
+        for name, module in self.modules.items():
+            key = EXPERT_PATTERN.sub("experts.*", name)
+            if key == name:
+                key = (name,)  # not an expert, compress on its own
+            groups.setdefault(key, []).append(module)
+
+        return [
+            group[start : start + self.expert_batch_size]
+            for group in groups.values()
+            for start in range(0, len(group), self.expert_batch_size)
+        ]
+
+    def _is_shared_input(self, name: str, inp: torch.Tensor) -> bool:
+        """
+        Check whether the input to a module is the same tensor which was already
+        passed to another module during the current forward pass of the layer, such
+        as q_proj, k_proj and v_proj. If so, the module shares the statistics
+        accumulated by the first module rather than calculating them again
+
+        :param name: name of the module receiving the input
+        :param inp: input to the module
+        :return: True if the statistics for this input were already accumulated
+        """
+        leader = next((n for x, n in self._layer_inputs if x is inp), None)
+        if leader is None:
+            self._layer_inputs.append((inp, name))
+
+        if name in self.shared_inputs:
+            if self.shared_inputs[name] == leader:
+                return True
+
+            # inputs are no longer identical, accumulate statistics separately. If
+            # the module shared with already accumulated its input to this forward
+            # pass, that batch is excluded
+            shared_with = self.shared_inputs.pop(name)
+            logger.debug(f"Unsharing statistics of {name} and {shared_with}")
+            self.modules[name].unshare_statistics(
+                exclude_latest_batch=shared_with in self._accumulated
+            )
+            return False
+
+        # only share statistics starting from the first batch
+        if leader is not None and self.modules[name].nsamples.item() == 0:
+            if self.modules[name].share_statistics(self.modules[leader]):
+                logger.debug(f"Sharing statistics of {name} with {leader}")
+                self.shared_inputs[name] = leader
+                return True
+
+        return False
+
+    def _synchronize_shared_inputs(self):
+        """
+        Only keep the statistics of modules shared if they are shared with the same
+        module on every rank of the process group. Sharing is decided by the inputs
+        seen by each rank, and all ranks must reduce the same statistics
+        """
+        names = list(self.modules.keys())
+        device = next(iter(self.modules.values())).nsamples.device
+        shared = torch.zeros(len(names), len(names), dtype=torch.int32, device=device)
+        for name, leader in self.shared_inputs.items():
+            shared[names.index(name), names.index(leader)] = 1
+        all_reduce_sum(shared)
+
+        world_size = dist.get_world_size()
+        for name, leader in list(self.shared_inputs.items()):
+            if shared[names.index(name), names.index(leader)] < world_size:
+                logger.debug(f"Unsharing statistics of {name} and {leader}")
+                self.modules[name].unshare_statistics()
+                del self.shared_inputs[name]
+
     def _get_full_submodule_name(self, name):
         full_name = ".".join(x for x in [self.name, name] if len(x) > 0)
         full_name = fix_fsdp_module_name(full_name)
@@ -1,17 +1,27 @@
+from collections.abc import Mapping
+from contextlib import contextmanager
 from itertools import cycle
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
 
 import torch
+from compressed_tensors import get_execution_device
 from torch.nn import Module
 from torch.utils.data import DataLoader
+from torch.utils.hooks import RemovableHandle
 from tqdm import tqdm
 
+from llmcompressor.modifiers.utils.intermediates_cache import IntermediatesCache
 from llmcompressor.pytorch.utils import tensors_module_forward, tensors_to_device
 
 __all__ = [
     "EarlyStopException",
     "apply_pad_mask_to_batch",
+    "calibration_attention_mask",
+    "get_calibration_attention_mask",
+    "remove_padding",
     "run_calibration_forward",
+    "set_early_stop",
+    "run_layer_forward",
     "is_moe_model",
 ]
 
@@ -43,6 +53,63 @@ def apply_pad_mask_to_batch(batch: Dict[str, torch.Tensor]) -> Dict[str, torch.T
     return batch
 
 
+_CALIBRATION_ATTENTION_MASK: Optional[torch.Tensor] = None
+
+
+@contextmanager
+def calibration_attention_mask(attention_mask: Optional[torch.Tensor]):
+    """
+    Context manager which sets the attention mask of the calibration batch currently
+    being run through the model, so that calibration hooks can exclude padding tokens
+
+    :param attention_mask: optional mask of shape (batch_size, sequence_length) where
+        padding tokens are 0. A mask without padding tokens is not set
+    """
+    global _CALIBRATION_ATTENTION_MASK
+    restore_value = _CALIBRATION_ATTENTION_MASK
+    # checked once per batch, so that hooks don't copy activations without padding
+    if attention_mask is not None and attention_mask.all():
+        attention_mask = None
+    _CALIBRATION_ATTENTION_MASK = attention_mask
+    try:
+        yield
+    finally:
+        _CALIBRATION_ATTENTION_MASK = restore_value
+
+
+def get_calibration_attention_mask() -> Optional[torch.Tensor]:
+    """
+    :return: attention mask of the calibration batch currently being run through the
+        model, or None if no mask is set or the batch has no padding tokens
+    """
+    return _CALIBRATION_ATTENTION_MASK
+
+
+def remove_padding(
+    value: torch.Tensor, attention_mask: Optional[torch.Tensor]
+) -> torch.Tensor:
+    """
+    Remove padding tokens from a batch of values, so that they do not contribute to
+    calibration statistics
+
+    :param value: tensor of shape (batch_size, sequence_length, hidden_size)
+    :param attention_mask: optional mask of shape (batch_size, sequence_length) where
+        padding tokens are 0
+    :return: tensor of shape (1, num_tokens, hidden_size) containing the values of all
+        non-padding tokens. If no mask is given or value does not have the layout of
+        the mask, such as the tokens routed to an expert or attention scores of shape
+        (batch_size, num_heads, ...), value is returned unchanged
+    """
+    if (
+        attention_mask is None
+        or value.dim() != 3
+        or value.shape[:2] != attention_mask.shape
+    ):
+        return value
+
+    return value[attention_mask.to(device=value.device, dtype=torch.bool)].unsqueeze(0)
+
+
 def run_calibration_forward(
     model: Module,
     calibration_dataloader: DataLoader,
@@ -50,10 +117,12 @@ def run_calibration_forward(
     calibration_function: Optional[Callable] = None,
     device: Optional[str] = None,
     mask_padding: bool = False,
-) -> List[torch.Tensor]:
+    intermediates: Optional[IntermediatesCache] = None,
+) -> IntermediatesCache:
     """
     Helper function used by one-shot modifiers, runs calibration data through a model to
-    update modifier statistics and trigger hooks
+    update modifier statistics and trigger hooks. The attention mask of each batch is
+    made available to hooks through `get_calibration_attention_mask`
 
     :param model: PyTorch model to run
     :param calibration_dataloader: data to use for calibration
@@ -62,7 +131,9 @@ def run_calibration_forward(
     :param calibration_function: option to pass a custom forward function for model
     :param device: option to move the model to a specific device before calibration
     :param mask_padding: whether to zero out padding tokens during calibration
-    :returns: list of last calculated model output if early stopping is triggered
+    :param intermediates: optional cache to store the inputs caught from early
+        stopping in, defaults to a cache with default settings
+    :returns: cache of last calculated model inputs if early stopping is triggered
     """
     model.eval()
 
@@ -83,7 +154,8 @@ def run_calibration_forward(
 
     # Store any inputs caught from early stopping, used for sequential compression
     # of GPTQ, SparseGPT and WANDA
-    intermediates = []
+    if intermediates is None:
+        intermediates = IntermediatesCache()
 
     # run through the calibration data
     for batch_idx, batch in enumerate(tqdm(_dataloader)):
@@ -92,13 +164,16 @@ def run_calibration_forward(
         if mask_padding:
             batch = apply_pad_mask_to_batch(batch)
         batch = tensors_to_device(batch, model_device)
-        with torch.no_grad():
+        attention_mask = (
+            batch.get("attention_mask") if isinstance(batch, Mapping) else None
+        )
+        with torch.no_grad(), calibration_attention_mask(attention_mask):
             try:
                 forward_fn(batch, module=model)
             except EarlyStopException as e:
                 # model was stopped early, save last calculated output and
                 # move on to next calibration sample
-                intermediates.append((e.args, e.kwargs))
+                intermediates.append(e.args, e.kwargs, attention_mask)
 
         # TODO: not ideal, figure out where we aren't freeing memory instead
         # currently without this we run OOM on the 2nd forward pass
@@ -107,6 +182,47 @@ def run_calibration_forward(
     return intermediates
 
 
+def set_early_stop(layer: Module) -> RemovableHandle:
+    """
+    Adds an early stopping exception to the input of a layer, so that the forward
+    pass of the model exits when reaching the layer. The inputs to the layer are
+    caught by `run_calibration_forward`
+
+    :param layer: layer to stop the forward pass at
+    :return: handle to remove the early stop with
+    """
+
+    def trigger_early_stop_fn(_module, args, kwargs):
+        raise EarlyStopException(args, kwargs)
+
+    return layer.register_forward_pre_hook(trigger_early_stop_fn, with_kwargs=True)
+
+
+def run_layer_forward(
+    layer: Module, intermediates: IntermediatesCache
+) -> IntermediatesCache:
+    """
+    Runs the inputs to a layer caught by early stopping through the layer, used for
+    sequential calibration one layer at a time. The attention mask of each input is
+    made available to hooks through `get_calibration_attention_mask`
+
+    :param layer: layer to run
+    :param intermediates: inputs to run through the layer
+    :return: outputs of the layer, stored with the same settings as the inputs
+    """
+    outputs = IntermediatesCache.like(intermediates)
+    for idx in tqdm(range(len(intermediates))):
+        args, kwargs = intermediates[idx]
+        attention_mask = intermediates.get_attention_mask(idx)
+        device = get_execution_device(layer)
+        with calibration_attention_mask(attention_mask):
+            output = layer(*tensors_to_device(args, device), **kwargs)
+        outputs.append(output, kwargs, attention_mask)
+        torch.cuda.empty_cache()
+
+    return outputs
+
+
 def is_moe_model(model: Module) -> bool:
     """
     Check if the model is a mixture of experts model
@@ -19,3 +19,4 @@ from .helpers import *
 from .base import *
 from .min_max import *
 from .mse import *
+from .histogram import *
@@ -26,7 +26,10 @@ from loguru import logger
 from torch import FloatTensor, IntTensor, Tensor
 from torch.nn import Module
 
-__all__ = ["Observer"]
+__all__ = ["Observer", "GROUPS_TENSOR_ID"]
+
+# tensor_id of the stacked running statistics of all groups of a tensor
+GROUPS_TENSOR_ID = "groups"
 
 
 class Observer(Module, RegistryMixin):
@@ -45,16 +48,22 @@ class Observer(Module, RegistryMixin):
 
     @torch.no_grad()
     def forward(
-        self, observed: Tensor, g_idx: Optional[Tensor] = None
+        self,
+        observed: Tensor,
+        g_idx: Optional[Tensor] = None,
+        record_tokens: bool = True,
     ) -> Tuple[FloatTensor, IntTensor]:
         """
         maps directly to get_qparams
         :param observed: optional observed tensor from which to calculate
             quantization parameters
         :param g_idx: optional mapping from column index to group index
+        :param record_tokens: whether to count the observed tokens. Disable if they
+            were already counted, such as before sampling a subset of them
         :return: tuple of scale and zero point based on last observed value
         """
-        self.record_observed_tokens(observed)
+        if record_tokens:
+            self.record_observed_tokens(observed)
         return self.get_qparams(observed=observed, g_idx=g_idx)
 
     def calculate_qparams(
@@ -102,13 +111,7 @@ class Observer(Module, RegistryMixin):
                 rows = observed.shape[0]
                 columns = observed.shape[1]
                 num_groups = int(ceil(columns / group_size))
-                self._scale = torch.empty(
-                    (rows, num_groups), dtype=observed.dtype, device=observed.device
-                )
                 zp_dtype = self.quantization_args.pytorch_dtype()
-                self._zero_point = torch.empty(
-                    (rows, num_groups), dtype=zp_dtype, device=observed.device
-                )
 
                 # support column-order (default) quantization as well as other orderings
                 # such as activation ordering. Below checks if g_idx has initialized
@@ -122,19 +125,43 @@ class Observer(Module, RegistryMixin):
                     perm = torch.argsort(g_idx)
                     observed = safe_permute(observed, perm, dim=1)
 
-                # TODO: experiment with vectorizing for loop for performance
-                end = 0
-                for group_index, group_count in enumerate(group_sizes):
-                    start = end
-                    end = start + group_count
-                    scale, zero_point = self.get_qparams_along_dim(
-                        observed[:, start:end],
-                        0,
-                        tensor_id=group_index,
+                if (
+                    observed.ndim == 2
+                    and columns == num_groups * group_size
+                    and len(group_sizes) == num_groups
+                    and torch.all(group_sizes == group_size)
+                ):
+                    # groups are contiguous and of equal size, calculate the qparams
+                    # of all groups at once. Running statistics of the groups are
+                    # stacked under a single tensor_id
+                    scale, zero_point = self.calculate_qparams(
+                        observed.reshape(rows, num_groups, group_size),
+                        reduce_dims=(2,),
+                        tensor_id=GROUPS_TENSOR_ID,
                     )
+                    self._scale = scale.reshape(rows, num_groups).to(observed.dtype)
+                    self._zero_point = zero_point.reshape(rows, num_groups).to(zp_dtype)
 
-                    self._scale[:, group_index] = scale.squeeze(1)
-                    self._zero_point[:, group_index] = zero_point.squeeze(1)
+                else:
+                    self._scale = torch.empty(
+                        (rows, num_groups), dtype=observed.dtype, device=observed.device
+                    )
+                    self._zero_point = torch.empty(
+                        (rows, num_groups), dtype=zp_dtype, device=observed.device
+                    )
+
+                    end = 0
+                    for group_index, group_count in enumerate(group_sizes):
+                        start = end
+                        end = start + group_count
+                        scale, zero_point = self.get_qparams_along_dim(
+                            observed[:, start:end],
+                            0,
+                            tensor_id=group_index,
+                        )
+
+                        self._scale[:, group_index] = scale.squeeze(1)
+                        self._zero_point[:, group_index] = zero_point.squeeze(1)
 
             elif self.quantization_args.strategy == QuantizationStrategy.CHANNEL:
                 # assume observed is transposed, because its the output, hence use dim 0
@@ -150,6 +177,16 @@ class Observer(Module, RegistryMixin):
 
         return self._scale, self._zero_point
 
+    def get_final_qparams(self) -> Optional[Tuple[FloatTensor, IntTensor]]:
+        """
+        Observers which derive their final quantization parameters from accumulated
+        statistics, rather than from each observed value, override this function
+
+        :return: tuple of scale and zero point to use once calibration is complete,
+            or None to keep the values returned by the last observation
+        """
+        return None
+
     def get_qparams_along_dim(
         self,
         observed,
@@ -13,10 +13,12 @@
 # limitations under the License.
 
 from collections import Counter
+from math import ceil
+from typing import Dict, Optional
 
 import torch
 
-__all__ = ["get_observer_token_count"]
+__all__ = ["get_observer_token_count", "TokenSampler"]
 
 
 def get_observer_token_count(module: torch.nn.Module) -> Counter:
@@ -34,3 +36,63 @@ def get_observer_token_count(module: torch.nn.Module) -> Counter:
                 module._num_observed_tokens
             )
     return token_counts
+
+
+class TokenSampler:
+    """
+    Samples a random subset of the tokens of activations before they are observed.
+    Sampling is deterministic given the seed and the order of the observed
+    activations, and the number of sampled tokens is tracked for logging
+
+    :param sample_rate: optional fraction of the tokens of each observation to sample
+    :param max_tokens: optional maximum number of tokens to sample per observation
+    :param seed: seed of the random sampling
+    """
+
+    def __init__(
+        self,
+        sample_rate: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        seed: int = 0,
+    ):
+        if sample_rate is not None and not 0 < sample_rate <= 1:
+            raise ValueError(f"Sample rate must be in (0, 1], got {sample_rate}")
+        if max_tokens is not None and max_tokens < 1:
+            raise ValueError(f"Max tokens must be at least 1, got {max_tokens}")
+
+        self.sample_rate = sample_rate
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.num_tokens = 0
+        self.num_sampled_tokens = 0
+        self._generators: Dict[torch.device, torch.Generator] = {}
+
+    def __call__(self, value: torch.Tensor) -> torch.Tensor:
+        """
+        :param value: activations of shape (..., num_features)
+        :return: activations of the sampled tokens, shaped (num_samples, num_features)
+            for two dimensional activations and (1, num_samples, num_features)
+            otherwise. value is returned unchanged if all tokens are sampled
+        """
+        tokens = value.reshape(-1, value.shape[-1])
+        num_tokens = tokens.shape[0]
+
+        num_samples = num_tokens
+        if self.sample_rate is not None:
+            num_samples = ceil(num_tokens * self.sample_rate)
+        if self.max_tokens is not None:
+            num_samples = min(num_samples, self.max_tokens)
+
+        self.num_tokens += num_tokens
+        self.num_sampled_tokens += num_samples
+        if num_samples == num_tokens:
+            return value
+
+        generator = self._generators.get(value.device, None)
+        if generator is None:
+            generator = torch.Generator(device=value.device).manual_seed(self.seed)
+            self._generators[value.device] = generator
+
+        indices = torch.randperm(num_tokens, generator=generator, device=value.device)
+        tokens = tokens[indices[:num_samples]]
+        return tokens if value.ndim == 2 else tokens.unsqueeze(0)
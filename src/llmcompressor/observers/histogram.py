@@ -0,0 +1,205 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from math import prod
+from typing import Any, Optional, Tuple
+
+import torch
+from compressed_tensors.quantization.quant_args import QuantizationArgs
+from compressed_tensors.quantization.utils import calculate_qparams
+from torch import FloatTensor, IntTensor, Tensor
+
+from llmcompressor.observers.base import GROUPS_TENSOR_ID, Observer
+
+__all__ = ["HistogramObserver"]
+
+
+@Observer.register("histogram")
+class HistogramObserver(Observer):
+    """
+    Implements a static quantization observer which accumulates a fixed size
+    histogram of the observed values, per tensor or per channel. Histograms are kept
+    on the device of the observed values and grow their range as new values are
+    observed, re-binning previous counts, so memory is constant in the number of
+    calibration batches. While calibrating, the scale and zero point cover the full
+    observed range. Once calibration is complete, the range is clipped to the given
+    percentile of the histogram, which is robust to outliers
+
+    :param quantization_args: settings of the quantization to observe for
+    :param bins: number of histogram bins per tensor or channel
+    :param percentile: percentage of observed values covered by the final range,
+        values beyond it are clipped evenly on both sides
+    """
+
+    def __init__(
+        self,
+        quantization_args: QuantizationArgs,
+        bins: int = 2048,
+        percentile: float = 99.99,
+    ):
+        super().__init__(quantization_args=quantization_args)
+
+        if not 0 < percentile <= 100:
+            raise ValueError(f"Percentile must be in (0, 100], got {percentile}")
+
+        self.bins = bins
+        self.percentile = percentile
+        self.histogram = {}
+        self.min_val = {}
+        self.max_val = {}
+        self.shape = {}
+
+    def calculate_qparams(
+        self,
+        observed: Tensor,
+        reduce_dims: Optional[Tuple[int]] = None,
+        tensor_id: Optional[Any] = None,
+    ) -> Tuple[FloatTensor, IntTensor]:
+        """
+        Accumulates the observed values into the histogram and returns the scale and
+        zero point of the full observed range
+
+        :param observed: observed tensor to calculate quantization parameters for
+        :param reduce_dims: optional tuple of dimensions to reduce along,
+            returned scale and zero point will be shaped (1,) along the
+            reduced dimensions. There is a histogram for each index of the
+            remaining dimensions
+        :param tensor_id: Optional id if different ranges of observed tensors are
+            passed, useful for sharding tensors by group_size
+        :return: tuple of scale and zero point derived from the observed tensor
+        """
+        # group indices start at 0, which must not map to the default histogram
+        tensor_id = "default" if tensor_id is None else tensor_id
+
+        if not reduce_dims:
+            shape = ()
+            values = observed.reshape(1, -1)
+        else:
+            kept_dims = [dim for dim in range(observed.ndim) if dim not in reduce_dims]
+            shape = tuple(
+                1 if dim in reduce_dims else size
+                for dim, size in enumerate(observed.shape)
+            )
+            values = observed.permute(*kept_dims, *reduce_dims)
+            values = values.reshape(prod(observed.shape[dim] for dim in kept_dims), -1)
+        values = values.float()
+
+        min_val, max_val = torch.aminmax(values, dim=1)
+        histogram = self.histogram.get(tensor_id, None)
+        if histogram is None:
+            histogram = torch.zeros(
+                (values.shape[0], self.bins), dtype=torch.long, device=values.device
+            )
+        else:
+            running_min_val = self.min_val[tensor_id]
+            running_max_val = self.max_val[tensor_id]
+            min_val = torch.minimum(min_val, running_min_val)
+            max_val = torch.maximum(max_val, running_max_val)
+            histogram = self._rebin(
+                histogram, running_min_val, running_max_val, min_val, max_val
+            )
+
+        indices = self._get_bin_indices(values, min_val, max_val)
+        histogram.scatter_add_(1, indices, torch.ones_like(indices))
+
+        self.histogram[tensor_id] = histogram
+        self.min_val[tensor_id] = min_val
+        self.max_val[tensor_id] = max_val
+        self.shape[tensor_id] = shape
+
+        return self._calculate_qparams(min_val, max_val, shape)
+
+    def get_final_qparams(self) -> Optional[Tuple[FloatTensor, IntTensor]]:
+        """
+        :return: scale and zero point of the percentile range of the histograms, or
+            None if no values were observed. Group qparams are shaped
+            (rows, num_groups), like those returned by get_qparams
+        """
+        if "default" in self.histogram:
+            return self._get_percentile_qparams("default")
+
+        if GROUPS_TENSOR_ID in self.histogram:
+            scale, zero_point = self._get_percentile_qparams(GROUPS_TENSOR_ID)
+            return scale.flatten(1), zero_point.flatten(1)
+
+        # groups of unequal size are observed separately, by group index
+        group_indices = sorted(self.histogram.keys())
+        if not group_indices:
+            return None
+
+        group_qparams = [self._get_percentile_qparams(idx) for idx in group_indices]
+        scale = torch.cat([scale for scale, _ in group_qparams], dim=1)
+        zero_point = torch.cat([zero_point for _, zero_point in group_qparams], dim=1)
+        return scale, zero_point
+
+    def reset(self):
+        """
+        Reset the state of the observer, including the histograms
+        """
+        super().reset()
+        self.histogram = {}
+        self.min_val = {}
+        self.max_val = {}
+        self.shape = {}
+
+    def _get_percentile_qparams(self, tensor_id: Any) -> Tuple[FloatTensor, IntTensor]:
+        histogram = self.histogram[tensor_id]
+        min_val, max_val = self.min_val[tensor_id], self.max_val[tensor_id]
+        bin_width = self._get_bin_width(min_val, max_val)
+
+        # smallest and largest bins which are not entirely clipped
+        cumulative = histogram.cumsum(dim=1)
+        total = cumulative[:, -1:]
+        clipped = total * (1 - self.percentile / 100) / 2
+        lower_bin = torch.searchsorted(cumulative, clipped, right=True)
+        upper_bin = torch.searchsorted(cumulative, total - clipped)
+        lower_bin = lower_bin.clamp(max=self.bins - 1).squeeze(1)
+        upper_bin = upper_bin.clamp(max=self.bins - 1).squeeze(1)
+
+        lower = min_val + lower_bin * bin_width
+        upper = torch.minimum(min_val + (upper_bin + 1) * bin_width, max_val)
+        return self._calculate_qparams(lower, upper, self.shape[tensor_id])
+
+    def _calculate_qparams(
+        self, min_val: Tensor, max_val: Tensor, shape: Tuple[int]
+    ) -> Tuple[FloatTensor, IntTensor]:
+        return calculate_qparams(
+            min_val.reshape(shape), max_val.reshape(shape), self.quantization_args
+        )
+
+    def _get_bin_width(self, min_val: Tensor, max_val: Tensor) -> Tensor:
+        bin_width = (max_val - min_val) / self.bins
+        return bin_width.clamp(min=torch.finfo(bin_width.dtype).tiny)
+
+    def _get_bin_indices(
+        self, values: Tensor, min_val: Tensor, max_val: Tensor
+    ) -> Tensor:
+        bin_width = self._get_bin_width(min_val, max_val)
+        indices = (values - min_val.unsqueeze(1)) / bin_width.unsqueeze(1)
+        return indices.long().clamp(0, self.bins - 1)
+
+    def _rebin(
+        self,
+        histogram: Tensor,
+        min_val: Tensor,
+        max_val: Tensor,
+        new_min_val: Tensor,
+        new_max_val: Tensor,
+    ) -> Tensor:
+        # counts are moved to the new bin containing the center of their old bin
+        bin_width = self._get_bin_width(min_val, max_val)
+        centers = torch.arange(self.bins, device=histogram.device) + 0.5
+        centers = min_val.unsqueeze(1) + centers * bin_width.unsqueeze(1)
+        indices = self._get_bin_indices(centers, new_min_val, new_max_val)
+        return torch.zeros_like(histogram).scatter_add_(1, indices, histogram)
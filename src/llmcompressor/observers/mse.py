@@ -12,16 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Any, Optional, Tuple
+from typing import Any, Optional, Tuple, Union
 
+import psutil
 import torch
-from compressed_tensors.quantization.quant_args import QuantizationArgs
+from compressed_tensors.quantization.quant_args import (
+    QuantizationArgs,
+    QuantizationStrategy,
+)
 from compressed_tensors.quantization.utils import calculate_qparams
 from torch import FloatTensor, IntTensor, Tensor
 
 from llmcompressor.observers.base import Observer
 
-__all__ = ["MovingAverageMSEObserver"]
+__all__ = [
+    "MovingAverageMSEObserver",
+    "MSE_SEARCH_MEMORY",
+    "MSE_SEARCH_MEMORY_FRACTION",
+]
+
+MSE_SEARCH_MEMORY: int = 2**24
+MSE_SEARCH_MEMORY_FRACTION: float = 0.25
+# fake quantizing a candidate allocates its output and about two temporaries
+MSE_CANDIDATE_COPIES: int = 3
 
 
 @Observer.register("mse")
@@ -29,6 +42,18 @@ class MovingAverageMSEObserver(Observer):
     """
     Implements a dynamic quantization observer that sets the scale and
     zero point based on a moving average of the mse-clipped min and max observed values
+
+    :param quantization_args: settings of the quantization to observe for
+    :param averaging_constant: constant of the moving average of the min and max
+    :param grid: number of shrink factors the clipping range is searched over
+    :param maxshrink: fraction of the grid to search, the smallest clipping range
+        searched is (1 - maxshrink) times the absolute min and max
+    :param norm: exponent of the quantization error which is minimized
+    :param search_memory: approximate number of bytes used by the fake quantized
+        candidates evaluated at once. Defaults to "auto", which uses
+        MSE_SEARCH_MEMORY_FRACTION of the free memory of the device of the observed
+        tensor, and at least MSE_SEARCH_MEMORY. None evaluates all shrink factors at
+        once
     """
 
     def __init__(
@@ -38,6 +63,7 @@ class MovingAverageMSEObserver(Observer):
         grid: float = 100.0,
         maxshrink: float = 0.80,
         norm: float = 2.4,
+        search_memory: Union[int, str, None] = "auto",
     ):
         super().__init__(quantization_args=quantization_args)
 
@@ -47,6 +73,7 @@ class MovingAverageMSEObserver(Observer):
         self.grid = grid
         self.maxshrink = maxshrink
         self.norm = norm
+        self.search_memory = search_memory
 
     def calculate_mse_min_max(
         self,
@@ -55,7 +82,8 @@ class MovingAverageMSEObserver(Observer):
     ):
         """
         Computes the mse-clipped min and max values of the observed tensor by
-        optimizing for quantization error
+        optimizing for quantization error. Shrink factors are evaluated in chunks
+        whose fake quantized candidates fit in the search memory
 
         :param observed: observed tensor to calculate quantization parameters for
         :param reduce_dims: optional tuple of dimensions to reduce along,
@@ -66,44 +94,94 @@ class MovingAverageMSEObserver(Observer):
 
         if not reduce_dims:
             absolute_min_val, absolute_max_val = torch.aminmax(observed)
+            sum_dims = tuple(range(1, observed.ndim + 1))
         else:
             absolute_min_val = torch.amin(observed, dim=reduce_dims, keepdims=True)
             absolute_max_val = torch.amax(observed, dim=reduce_dims, keepdims=True)
+            sum_dims = tuple(dim + 1 for dim in reduce_dims)
+
+        # candidates have one scale per reduced slice of the observed tensor, such
+        # as a stacked group, so they are applied by broadcasting
+        quantization_args = self.quantization_args
+        if quantization_args.strategy == QuantizationStrategy.GROUP:
+            quantization_args = quantization_args.model_copy(
+                update={"strategy": QuantizationStrategy.CHANNEL}
+            )
+
+        # shrink factors are applied in the precision pytorch uses for scalars
+        num_candidates = int(self.maxshrink * self.grid)
+        shrink_factors = torch.tensor(
+            [1 - i / self.grid for i in range(num_candidates)],
+            dtype=torch.promote_types(absolute_min_val.dtype, torch.float32),
+            device=observed.device,
+        ).reshape(-1, *([1] * observed.ndim))
+
+        chunk_size = self._get_chunk_size(observed, num_candidates)
 
         best = torch.full_like(
             absolute_min_val, torch.finfo(absolute_min_val.dtype).max
         )
         min_val = torch.ones_like(absolute_min_val)
         max_val = torch.zeros_like(absolute_max_val)
-        for i in range(int(self.maxshrink * self.grid)):
-            p = 1 - i / self.grid
-            shrinked_min_val = p * absolute_min_val
-            shrinked_max_val = p * absolute_max_val
+        for start in range(0, num_candidates, chunk_size):
+            p = shrink_factors[start : start + chunk_size]
+            shrinked_min_val = (p * absolute_min_val).to(absolute_min_val.dtype)
+            shrinked_max_val = (p * absolute_max_val).to(absolute_max_val.dtype)
 
             candidate_scales, candidate_zero_points = calculate_qparams(
-                shrinked_min_val, shrinked_max_val, self.quantization_args
+                shrinked_min_val, shrinked_max_val, quantization_args
             )
             q = fake_quantize(
-                observed,
+                observed.unsqueeze(0),
                 candidate_scales,
                 candidate_zero_points,
-                self.quantization_args,
+                quantization_args,
             )
 
             q -= observed
             q.abs_()
             q.pow_(self.norm)
-            if not reduce_dims:
-                err = torch.sum(q)
+            err = torch.sum(q, sum_dims, keepdims=True)
+            err = err.reshape(-1, *absolute_min_val.shape)
+
+            # the first candidate with the lowest error is kept, without syncing
+            chunk_best, chunk_index = torch.min(err, dim=0)
+            chunk_index = chunk_index.unsqueeze(0)
+            shrinked_min_val = shrinked_min_val.reshape(-1, *absolute_min_val.shape)
+            shrinked_max_val = shrinked_max_val.reshape(-1, *absolute_max_val.shape)
+
+            improved = chunk_best < best
+            best = torch.where(improved, chunk_best, best)
+            min_val = torch.where(
+                improved, shrinked_min_val.gather(0, chunk_index)[0], min_val
+            )
+            max_val = torch.where(
+                improved, shrinked_max_val.gather(0, chunk_index)[0], max_val
+            )
+        return min_val, max_val
+
+    def _get_chunk_size(self, observed: Tensor, num_candidates: int) -> int:
+        """
+        :param observed: observed tensor to search the clipping range of
+        :param num_candidates: number of shrink factors to evaluate
+        :return: number of shrink factors whose fake quantized candidates fit in the
+            search memory
+        """
+        search_memory = self.search_memory
+        if search_memory is None:
+            return num_candidates
+        if search_memory == "auto":
+            if observed.device.type == "cuda":
+                free_memory = torch.cuda.mem_get_info(observed.device)[0]
             else:
-                err = torch.sum(q, reduce_dims, keepdims=True)
+                free_memory = psutil.virtual_memory().available
+            search_memory = max(
+                MSE_SEARCH_MEMORY, int(free_memory * MSE_SEARCH_MEMORY_FRACTION)
+            )
 
-            tmp = err < best
-            if torch.any(tmp):
-                best[tmp] = err[tmp]
-                min_val[tmp] = shrinked_min_val[tmp]
-                max_val[tmp] = shrinked_max_val[tmp]
-        return min_val, max_val
+        candidate_size = observed.numel() * observed.element_size()
+        candidate_size *= MSE_CANDIDATE_COPIES
+        return max(1, min(num_candidates, search_memory // candidate_size))
 
     def calculate_qparams(
         self,
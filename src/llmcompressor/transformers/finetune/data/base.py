@@ -1,7 +1,13 @@
+import inspect
+import os
 from typing import Optional, Union
 
+import numpy
+import pyarrow
+import pyarrow.compute
 from compressed_tensors.registry import RegistryMixin
-from datasets import Dataset, IterableDataset
+from datasets import Dataset, DatasetDict, IterableDataset, IterableDatasetDict
+from datasets.fingerprint import Hasher
 from loguru import logger
 from transformers import AutoTokenizer
 
@@ -9,7 +15,12 @@ from llmcompressor.transformers.finetune.data.data_args import DataTrainingArgum
 from llmcompressor.transformers.finetune.data.data_helpers import (
     LABELS_MASK_VALUE,
     get_custom_datasets_from_path,
+    get_hub_dataset_revision,
+    get_local_files_fingerprint,
+    get_packing_fingerprint,
     get_raw_dataset,
+    get_tokenizer_fingerprint,
+    pack_dataset,
 )
 
 
@@ -94,6 +105,90 @@ class TextGenerationDataset(RegistryMixin):
             **self.raw_kwargs,
         )
 
+    def get_fingerprint(self, add_labels: bool = True) -> Optional[str]:
+        """
+        Fingerprint of the tokenized dataset, used as its key in the tokenized dataset
+        cache. Covers the dataset source and the commit of hub datasets, the split,
+        the preprocessing code of this dataset class, the packing and labelling code,
+        the tokenizer files and the tokenization settings. Hub datasets whose commit
+        can't be resolved, such as when offline, are not fingerprinted
+
+        :param add_labels: whether labels are included in the tokenized output
+        :return: hex digest identifying the tokenized dataset, or None if the dataset
+            source can't be fingerprinted, such as when streaming
+        """
+        if self.data_args.streaming or self.tokenizer is None:
+            return None
+
+        dataset = self.data_args.dataset
+        if isinstance(dataset, DatasetDict):
+            source = {name: split._fingerprint for name, split in dataset.items()}
+        elif isinstance(dataset, Dataset):
+            source = dataset._fingerprint
+        elif isinstance(dataset, str):
+            source = dataset
+            hub_dataset = not (
+                self.custom_dataset
+                or "data_files" in self.raw_kwargs
+                or os.path.exists(dataset)
+            )
+            if hub_dataset:
+                # hub datasets are identified by the commit of their revision, as
+                # unpinned revisions move with updates to the dataset
+                revision = get_hub_dataset_revision(
+                    dataset, self.raw_kwargs.get("revision")
+                )
+                if revision is None:
+                    logger.warning(
+                        f"Unable to resolve the hub revision of {dataset}, its "
+                        "tokenized dataset will not be cached"
+                    )
+                    return None
+                source = (dataset, revision)
+        else:
+            return None
+
+        preprocessing_code = [
+            inspect.getsource(cls)
+            for cls in type(self).__mro__
+            if issubclass(cls, TextGenerationDataset)
+        ]
+        # data files and storage options of custom datasets are set from dataset_path
+        # when loading the raw dataset
+        raw_kwargs = self.raw_kwargs
+        if self.custom_dataset:
+            raw_kwargs = {
+                key: value
+                for key, value in raw_kwargs.items()
+                if key not in ("data_files", "storage_options")
+            }
+        local_files = [
+            self.raw_kwargs.get("data_files"),
+            self.data_args.dataset_path,
+            dataset if isinstance(dataset, str) else None,
+        ]
+
+        return Hasher.hash(
+            [
+                source,
+                self.data_args.dataset_config_name,
+                self.data_args.dataset_path,
+                self.data_args.dvc_data_repository,
+                raw_kwargs,
+                get_local_files_fingerprint(local_files),
+                self.split,
+                preprocessing_code,
+                get_packing_fingerprint(),
+                get_tokenizer_fingerprint(self.tokenizer),
+                self.text_column,
+                self.max_seq_length,
+                self.padding,
+                self.data_args.concatenate_data,
+                self.data_args.packed_position_ids,
+                add_labels,
+            ]
+        )
+
     def tokenize_and_process(
         self, raw_dataset: Optional[Dataset] = None, add_labels: Optional[bool] = True
     ) -> Dataset:
@@ -125,35 +220,47 @@ class TextGenerationDataset(RegistryMixin):
 
             return result
 
-        # helper fn for filling to max_sequence_length by concatenating entries
-        def group_text_fn(data):
-            concatenated_data = {k: sum(data[k], []) for k in data.keys()}
-            total_length = len(concatenated_data[list(data.keys())[0]])
-            total_length = (total_length // self.max_seq_length) * self.max_seq_length
-            result = {
-                k: [
-                    t[i : i + self.max_seq_length]
-                    for i in range(0, total_length, self.max_seq_length)
-                ]
-                for k, t in concatenated_data.items()
-            }
-            return result
+        # helper fn for adding labels, needed for loss calculation. Operates on the
+        # flattened token buffers of a whole arrow batch
+        def label_fn(batch: pyarrow.Table) -> pyarrow.Table:
+            input_ids = batch.column("input_ids").combine_chunks()
+            lengths = pyarrow.compute.list_value_length(input_ids).to_numpy(
+                zero_copy_only=False
+            )
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+            labels = input_ids.flatten().to_numpy(zero_copy_only=False)
+            labels = labels.astype(numpy.int64)
 
-        # helper fn for adding labels, needed for loss calculation
-        def label_fn(data):
             # if the dataset uses prompts, mask them out so they don't contribute
             # to the loss calculation
-            prompt_len = 0
-            if self.PROMPT_KEY in data:
-                prompt_len = len(data[self.PROMPT_KEY])
-            data["labels"] = data["input_ids"].copy()
-            data["labels"][:prompt_len] = [LABELS_MASK_VALUE] * prompt_len
+            if self.PROMPT_KEY in batch.column_names:
+                prompt_lengths = pyarrow.compute.list_value_length(
+                    batch.column(self.PROMPT_KEY)
+                ).to_numpy(zero_copy_only=False)
+                positions = numpy.arange(len(labels)) - numpy.repeat(
+                    offsets[:-1], lengths
+                )
+                labels[positions < numpy.repeat(prompt_lengths, lengths)] = (
+                    LABELS_MASK_VALUE
+                )
+                batch = batch.drop_columns([self.PROMPT_KEY])
 
             # mask out padding in the labels as well
-            padding = len(data["attention_mask"]) - sum(data["attention_mask"])
-            if padding > 0:
-                data["labels"][-padding:] = [LABELS_MASK_VALUE] * padding
-            return data
+            if "attention_mask" in batch.column_names:
+                attention_mask = batch.column("attention_mask").combine_chunks()
+                attention_mask = attention_mask.flatten().to_numpy(zero_copy_only=False)
+                labels[attention_mask == 0] = LABELS_MASK_VALUE
+
+            labels = pyarrow.ListArray.from_arrays(
+                pyarrow.array(offsets, type=pyarrow.int32()), pyarrow.array(labels)
+            )
+            return batch.append_column("labels", labels)
+
+        # helper fn for removing prompts when no labels are added
+        def remove_prompt_fn(batch: pyarrow.Table) -> pyarrow.Table:
+            if self.PROMPT_KEY in batch.column_names:
+                batch = batch.drop_columns([self.PROMPT_KEY])
+            return batch
 
         if raw_dataset is None:
             raw_dataset = self.get_raw_dataset()
@@ -169,43 +276,33 @@ class TextGenerationDataset(RegistryMixin):
         )
 
         if self.data_args.concatenate_data:
-            dataset = self.map(
+            dataset = pack_dataset(
                 dataset,
-                function=group_text_fn,
-                batched=True,
-                num_proc=self.data_args.preprocessing_num_workers,
+                self.max_seq_length,
+                add_position_ids=self.data_args.packed_position_ids,
                 load_from_cache_file=not self.data_args.overwrite_cache,
-                desc="Grouping text",
             )
 
-        if isinstance(dataset, IterableDataset):
-            # so we can get column names from streamed_datasets
-            dataset = dataset._resolve_features()
-
-        column_names = dataset.column_names
-        if isinstance(column_names, dict):
-            column_names = column_names[list(column_names)[0]]
-
         if add_labels:
             dataset = self.map(
-                dataset,
+                dataset.with_format("arrow"),
                 function=label_fn,
-                batched=False,  # not compatible with batching, need row lengths
-                remove_columns=[self.PROMPT_KEY]
-                if self.PROMPT_KEY in column_names
-                else None,
+                batched=True,
                 num_proc=self.data_args.preprocessing_num_workers,
                 load_from_cache_file=not self.data_args.overwrite_cache,
                 desc="Adding labels",
-            )
-        else:
+            ).with_format(None)
+        elif isinstance(dataset, (IterableDataset, IterableDatasetDict)):
+            # the columns of streamed datasets are only known once they are streamed
             dataset = self.map(
-                dataset,
-                batched=False,  # not compatible with batching, need row lengths
-                remove_columns=[self.PROMPT_KEY]
-                if self.PROMPT_KEY in column_names
-                else None,
-            )
+                dataset.with_format("arrow"), function=remove_prompt_fn, batched=True
+            ).with_format(None)
+        else:
+            column_names = dataset.column_names
+            if isinstance(column_names, dict):
+                column_names = column_names[list(column_names)[0]]
+            if self.PROMPT_KEY in column_names:
+                dataset = dataset.remove_columns(self.PROMPT_KEY)
 
         return dataset
 
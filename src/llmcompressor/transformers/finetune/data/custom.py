@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from copy import deepcopy
-from typing import Dict, List, Union
+from typing import Callable, List, Optional, Union
 
+from datasets import IterableDataset, IterableDatasetDict
 from datasets.dataset_dict import Dataset, DatasetDict
+from datasets.fingerprint import Hasher
+from loguru import logger
 
 from llmcompressor.transformers.finetune.data import TextGenerationDataset
 from llmcompressor.transformers.utils.preprocessing_functions import (
@@ -51,7 +54,9 @@ class CustomDataset(TextGenerationDataset):
         """Get the raw dataset and apply preprocessing func if provided"""
 
         dataset = self.data_args.dataset
-        if isinstance(dataset, DatasetDict) or isinstance(dataset, Dataset):
+        if isinstance(
+            dataset, (DatasetDict, Dataset, IterableDatasetDict, IterableDataset)
+        ):
             # user passed in an already instantiated dataset, just use it directly
             raw_dataset = dataset
         else:
@@ -59,20 +64,9 @@ class CustomDataset(TextGenerationDataset):
             raw_dataset = super().get_raw_dataset()
 
         if self.preprocessing_func is not None:
-            if callable(self.preprocessing_func):
-                func = self.preprocessing_func
-            elif ":" in self.preprocessing_func:
-                # load func_name from "/path/to/file.py:func_name"
-                func = import_from_path(self.preprocessing_func)
-            else:
-                # load from the registry
-                func = PreprocessingFunctionRegistry.get_value_from_registry(
-                    name=self.preprocessing_func
-                )
-
             raw_dataset = self.map(
                 raw_dataset,
-                function=func,
+                function=self.get_preprocessing_func(),
                 batched=False,
                 num_proc=self.data_args.preprocessing_num_workers,
                 desc="Applying custom func to the custom dataset",
@@ -93,14 +87,65 @@ class CustomDataset(TextGenerationDataset):
 
         return raw_dataset
 
+    def get_preprocessing_func(self) -> Optional[Callable]:
+        """
+        Resolve the preprocessing function, which may be given as a callable, a path
+        of format `/path/to/file.py:func_name` or a name in the registry
+
+        :return: the preprocessing function, or None if not provided
+        """
+        if self.preprocessing_func is None or callable(self.preprocessing_func):
+            return self.preprocessing_func
+        if ":" in self.preprocessing_func:
+            # load func_name from "/path/to/file.py:func_name"
+            return import_from_path(self.preprocessing_func)
+
+        # load from the registry
+        return PreprocessingFunctionRegistry.get_value_from_registry(
+            name=self.preprocessing_func
+        )
+
+    def get_fingerprint(self, add_labels: bool = True) -> Optional[str]:
+        """
+        Fingerprint of the tokenized dataset, including the preprocessing function
+        and the removed columns
+
+        :param add_labels: whether labels are included in the tokenized output
+        :return: hex digest identifying the tokenized dataset, or None if the dataset
+            source can't be fingerprinted, such as when streaming
+        """
+        fingerprint = super().get_fingerprint(add_labels)
+        if fingerprint is None:
+            return None
+
+        try:
+            return Hasher.hash(
+                [
+                    fingerprint,
+                    self.get_preprocessing_func(),
+                    self.data_args.remove_columns,
+                ]
+            )
+        except Exception as exception:
+            logger.warning(
+                "Unable to fingerprint the preprocessing function, the tokenized "
+                f"dataset will not be cached: {exception}"
+            )
+            return None
+
     def get_remove_columns_from_dataset(
-        self, raw_dataset: Union[DatasetDict, Dataset]
+        self,
+        raw_dataset: Union[DatasetDict, Dataset, IterableDatasetDict, IterableDataset],
     ) -> List[str]:
         """Remove redandant columns from the dataset for processing"""
 
+        if isinstance(raw_dataset, (DatasetDict, IterableDatasetDict)):
+            raw_dataset = raw_dataset[list(raw_dataset.keys())[0]]
         remove_columns = raw_dataset.column_names
-        if isinstance(remove_columns, Dict):
-            remove_columns = raw_dataset[list(raw_dataset.keys())[0]].column_names
+        if remove_columns is None:
+            # columns of streamed datasets are unknown until the first example is
+            # streamed
+            remove_columns = raw_dataset._resolve_features().column_names
 
         remove_columns = set(remove_columns)
         if self.text_column in remove_columns:
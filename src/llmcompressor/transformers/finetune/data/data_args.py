@@ -91,6 +91,15 @@ class DataTrainingArguments(CustomDataTrainingArguments):
             "help": "Whether or not to concatenate datapoints to fill max_seq_length"
         },
     )
+    packed_position_ids: bool = field(
+        default=False,
+        metadata={
+            "help": "When concatenating data, whether to add position_ids which "
+            "restart at 0 at the start of each document within a block, marking "
+            "document boundaries for attention implementations which support them, "
+            "such as flash_attention_2"
+        },
+    )
     raw_kwargs: Optional[Dict] = field(
         default=None,
         metadata={"help": "Additional keyboard args to pass to datasets load_data"},
@@ -103,6 +112,31 @@ class DataTrainingArguments(CustomDataTrainingArguments):
         default=512,
         metadata={"help": "Number of samples to use for one-shot calibration"},
     )
+    num_calibration_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Optional total number of tokens to use for one-shot calibration. "
+            "If set, padding is stripped from the calibration samples, which are "
+            "selected until the budget is reached, instead of selecting "
+            "num_calibration_samples samples"
+        },
+    )
+    calibration_sequence_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Optional maximum length of calibration sequences when calibrating "
+            "with num_calibration_tokens. Longer samples are split into sequences of "
+            "this length"
+        },
+    )
+    calibration_batch_size: int = field(
+        default=1,
+        metadata={
+            "help": "Number of calibration samples per forward pass. Samples of "
+            "similar length are batched together and padding tokens are excluded "
+            "from calibration statistics"
+        },
+    )
     shuffle_calibration_samples: Optional[bool] = field(
         default=True,
         metadata={
@@ -117,6 +151,18 @@ class DataTrainingArguments(CustomDataTrainingArguments):
         default=False,
         metadata={"help": "Overwrite the cached preprocessed datasets or not."},
     )
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Optional directory to cache tokenized datasets in, which are "
+            "reused across runs and processes. Entries are keyed by a fingerprint of "
+            "the dataset source, split, preprocessing, tokenizer files and "
+            "tokenization settings. Hub datasets are identified by name and the "
+            "commit of the `revision` in raw_kwargs, or of the main branch. They "
+            "aren't cached if the commit can't be resolved, such as when offline. "
+            "Set overwrite_cache to refresh an entry"
+        },
+    )
     preprocessing_num_workers: Optional[int] = field(
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
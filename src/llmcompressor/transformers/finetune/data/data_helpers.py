@@ -1,9 +1,29 @@
+import heapq
+import inspect
+import json
 import logging
 import os
-from typing import Any, Callable, Dict, List, Optional
-
+import re
+import shutil
+import tempfile
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import numpy
+import pyarrow
+import pyarrow.compute
 import torch
-from datasets import Dataset, load_dataset
+from datasets import (
+    Dataset,
+    DatasetDict,
+    Features,
+    IterableDataset,
+    IterableDatasetDict,
+    load_dataset,
+    load_from_disk,
+)
+from datasets.fingerprint import Hasher
+from huggingface_hub import dataset_info
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from transformers.data import default_data_collator
 
@@ -12,9 +32,19 @@ LABELS_MASK_VALUE = -100
 
 __all__ = [
     "format_calibration_data",
+    "select_calibration_tokens",
+    "sample_iterable_dataset",
     "get_raw_dataset",
     "make_dataset_splits",
     "get_custom_datasets_from_path",
+    "SequencePacker",
+    "pack_dataset",
+    "get_tokenizer_fingerprint",
+    "get_packing_fingerprint",
+    "get_local_files_fingerprint",
+    "get_hub_dataset_revision",
+    "load_tokenized_dataset",
+    "save_tokenized_dataset",
 ]
 
 
@@ -24,10 +54,15 @@ def format_calibration_data(
     do_shuffle: bool = True,
     collate_fn: Callable = default_data_collator,
     accelerator: Optional[Any] = None,
+    batch_size: int = 1,
+    num_calibration_tokens: Optional[int] = None,
+    sequence_length: Optional[int] = None,
+    seed: Optional[int] = None,
 ) -> List[torch.Tensor]:
     """
     Creates a dataloader out of the calibration dataset split, trimming it to
-    the desired number of calibration samples
+    the desired number of calibration samples, or to a budget of calibration tokens.
+    Streamed datasets are sampled in a single pass, see `sample_iterable_dataset`
 
     :param tokenized_dataset: dataset to convert to dataloader
     :param num_calibration_samples: number of data samples to convert
@@ -35,29 +70,76 @@ def format_calibration_data(
     samples, true by default
     :param collate_fn: optional custom collate function, or use default
     :param accelerator: optional accelerator for if preparing in FSDP mode
+    :param batch_size: number of calibration samples per batch. Samples of similar
+        length are batched together and padded to the longest sample in the batch,
+        with an attention mask marking the padding tokens
+    :param num_calibration_tokens: optional total number of non-padding tokens to
+        calibrate with, see `select_calibration_tokens`. Replaces
+        num_calibration_samples if set
+    :param sequence_length: optional maximum length of the calibration sequences
+        when calibrating with a token budget, longer samples are split
+    :param seed: optional seed of the order in which samples are selected and
+        batched
     :return: list of trimmed calibration data tensors
     """
-    safe_calibration_samples = len(tokenized_dataset)
-    if num_calibration_samples is not None:
-        safe_calibration_samples = min(len(tokenized_dataset), num_calibration_samples)
-        if safe_calibration_samples != num_calibration_samples:
-            LOGGER.warn(
-                f"Requested {num_calibration_samples} calibration samples but "
-                f"the provided dataset only has {safe_calibration_samples}. "
+    generator = None
+    if seed is not None:
+        generator = torch.Generator().manual_seed(seed)
+
+    if isinstance(tokenized_dataset, IterableDataset):
+        tokenized_dataset = sample_iterable_dataset(
+            tokenized_dataset,
+            num_samples=num_calibration_samples
+            if num_calibration_tokens is None
+            else None,
+            num_tokens=num_calibration_tokens,
+            do_shuffle=do_shuffle,
+            seed=seed,
+        )
+
+    if num_calibration_tokens is not None:
+        tokenized_calibration = select_calibration_tokens(
+            tokenized_dataset,
+            num_calibration_tokens,
+            sequence_length=sequence_length,
+            do_shuffle=do_shuffle,
+            seed=seed,
+        )
+    else:
+        safe_calibration_samples = len(tokenized_dataset)
+        if num_calibration_samples is not None:
+            safe_calibration_samples = min(
+                len(tokenized_dataset), num_calibration_samples
             )
-
-    if do_shuffle:
-        tokenized_dataset = tokenized_dataset.shuffle()
-    tokenized_calibration = tokenized_dataset.select(range(safe_calibration_samples))
-
-    dataloader_params = {
-        "batch_size": 1,
-        "sampler": RandomSampler(tokenized_calibration)
-        if do_shuffle
-        else SequentialSampler(tokenized_calibration),
-        "collate_fn": collate_fn,
-        "pin_memory": True,
-    }
+            if safe_calibration_samples != num_calibration_samples:
+                LOGGER.warn(
+                    f"Requested {num_calibration_samples} calibration samples but "
+                    f"the provided dataset only has {safe_calibration_samples}. "
+                )
+
+        if do_shuffle:
+            tokenized_dataset = tokenized_dataset.shuffle(seed=seed)
+        tokenized_calibration = tokenized_dataset.select(
+            range(safe_calibration_samples)
+        )
+
+    if batch_size > 1:
+        dataloader_params = {
+            "batch_sampler": _get_length_bucketed_batches(
+                tokenized_calibration, batch_size, do_shuffle, generator
+            ),
+            "collate_fn": partial(_collate_padded, collate_fn=collate_fn),
+            "pin_memory": True,
+        }
+    else:
+        dataloader_params = {
+            "batch_size": 1,
+            "sampler": RandomSampler(tokenized_calibration, generator=generator)
+            if do_shuffle
+            else SequentialSampler(tokenized_calibration),
+            "collate_fn": collate_fn,
+            "pin_memory": True,
+        }
 
     calib_dataloader = DataLoader(tokenized_calibration, **dataloader_params)
     if accelerator:
@@ -66,6 +148,230 @@ def format_calibration_data(
     return calib_dataloader
 
 
+def sample_iterable_dataset(
+    dataset: IterableDataset,
+    num_samples: Optional[int] = None,
+    num_tokens: Optional[int] = None,
+    do_shuffle: bool = True,
+    seed: Optional[int] = None,
+) -> Dataset:
+    """
+    Sample calibration data from a streamed dataset in a single pass, without
+    storing the dataset. Each sample is assigned a random key, and the samples with
+    the smallest keys are kept in a reservoir until either num_samples samples or
+    num_tokens non-padding tokens are reached. This gives the same distribution as
+    shuffling the whole dataset and taking the first samples, with memory bounded by
+    the size of the reservoir. Without shuffling, the stream is read until the
+    reservoir is full
+
+    :param dataset: streamed tokenized dataset to sample from
+    :param num_samples: number of samples to keep
+    :param num_tokens: number of non-padding tokens to keep, the last sample may
+        exceed the budget. Replaces num_samples if set
+    :param do_shuffle: whether to sample randomly, rather than from the start of
+        the stream
+    :param seed: optional seed of the random sampling
+    :return: in-memory dataset of the sampled examples, in a random order if
+        do_shuffle is set
+    """
+    rng = numpy.random.default_rng(seed)
+    reservoir = []  # max heap of (-key, index, sample), so the largest key is first
+    reservoir_tokens = 0
+
+    def num_sample_tokens(sample: Dict[str, Any]) -> int:
+        if "attention_mask" in sample:
+            return int(sum(sample["attention_mask"]))
+        return len(sample["input_ids"])
+
+    def is_full() -> bool:
+        if num_tokens is not None:
+            return reservoir_tokens >= num_tokens
+        return num_samples is not None and len(reservoir) >= num_samples
+
+    def can_pop() -> bool:
+        if num_tokens is not None:
+            largest_tokens = num_sample_tokens(reservoir[0][2])
+            return reservoir_tokens - largest_tokens >= num_tokens
+        return num_samples is not None and len(reservoir) > num_samples
+
+    for index, sample in enumerate(dataset):
+        key = rng.random() if do_shuffle else index
+        if is_full():
+            if not do_shuffle:
+                # keys only increase, later samples can't enter the reservoir
+                break
+            if key >= -reservoir[0][0]:
+                continue
+
+        heapq.heappush(reservoir, (-key, index, sample))
+        reservoir_tokens += num_sample_tokens(sample)
+        while can_pop():
+            reservoir_tokens -= num_sample_tokens(heapq.heappop(reservoir)[2])
+
+    samples = [sample for _, _, sample in sorted(reservoir, reverse=True)]
+    return Dataset.from_list(samples, features=dataset.features)
+
+
+def select_calibration_tokens(
+    tokenized_dataset: Dataset,
+    num_tokens: int,
+    sequence_length: Optional[int] = None,
+    do_shuffle: bool = True,
+    seed: Optional[int] = None,
+) -> Dataset:
+    """
+    Select calibration samples until a budget of tokens is reached. Padding tokens
+    are stripped from the samples, so that only the tokens which contribute to
+    calibration statistics count towards the budget, and the last selected sample is
+    truncated to the remaining budget. Samples longer than sequence_length are split
+    into sequences of at most sequence_length tokens. Columns which aren't aligned
+    with the input_ids of each sample are dropped
+
+    :param tokenized_dataset: dataset to select calibration samples from
+    :param num_tokens: total number of tokens to select
+    :param sequence_length: optional maximum number of tokens per sequence
+    :param do_shuffle: whether to select samples in a random order, rather than
+        from the start of the dataset
+    :param seed: optional seed of the random order
+    :return: dataset of calibration sequences, containing num_tokens tokens unless
+        the dataset has fewer
+    """
+    table = tokenized_dataset.with_format("arrow")[:]
+    lengths = _list_lengths(table.column("input_ids"))
+    offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+    keep = numpy.ones(offsets[-1], dtype=bool)
+    if "attention_mask" in table.column_names:
+        attention_mask = table.column("attention_mask").combine_chunks().flatten()
+        keep = attention_mask.to_numpy(zero_copy_only=False) != 0
+    keep_offsets = numpy.concatenate([[0], numpy.cumsum(keep)])
+    num_kept = keep_offsets[offsets[1:]] - keep_offsets[offsets[:-1]]
+
+    # select samples until their tokens exceed the budget
+    order = numpy.arange(len(lengths))
+    if do_shuffle:
+        order = numpy.random.default_rng(seed).permutation(len(lengths))
+    selected_tokens = numpy.cumsum(num_kept[order])
+    num_selected = int(numpy.searchsorted(selected_tokens, num_tokens)) + 1
+    num_selected = min(num_selected, len(order))
+    order = order[:num_selected]
+    if num_selected == 0 or selected_tokens[-1] < num_tokens:
+        available = selected_tokens[-1] if num_selected > 0 else 0
+        LOGGER.warn(
+            f"Requested {num_tokens} calibration tokens but the provided dataset "
+            f"only has {available} non-padding tokens."
+        )
+        if num_selected == 0:
+            return tokenized_dataset
+
+    # truncate the last sample to the remaining budget
+    sample_lengths = num_kept[order]
+    sample_lengths[-1] -= max(int(selected_tokens[num_selected - 1]) - num_tokens, 0)
+
+    # indices of the kept tokens of each selected sample, in the selected order
+    kept_indices = numpy.flatnonzero(keep)
+    starts = keep_offsets[offsets[order]]
+    sample_offsets = numpy.concatenate([[0], numpy.cumsum(sample_lengths)])
+    positions = numpy.arange(sample_offsets[-1]) - numpy.repeat(
+        sample_offsets[:-1], sample_lengths
+    )
+    token_indices = kept_indices[numpy.repeat(starts, sample_lengths) + positions]
+
+    # split samples into sequences of at most sequence_length tokens
+    sequence_lengths = sample_lengths[sample_lengths > 0]
+    if sequence_length is not None:
+        num_splits = -(-sequence_lengths // sequence_length)
+        split_index = numpy.arange(num_splits.sum()) - numpy.repeat(
+            numpy.cumsum(num_splits) - num_splits, num_splits
+        )
+        sequence_lengths = numpy.minimum(
+            numpy.repeat(sequence_lengths, num_splits) - split_index * sequence_length,
+            sequence_length,
+        )
+    sequence_offsets = pyarrow.array(
+        numpy.concatenate([[0], numpy.cumsum(sequence_lengths)]), type=pyarrow.int32()
+    )
+
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if not _is_list_type(column.type):
+            continue
+        if not numpy.array_equal(_list_lengths(column), lengths):
+            continue
+        values = column.flatten().take(pyarrow.array(token_indices))
+        columns[name] = pyarrow.ListArray.from_arrays(sequence_offsets, values)
+
+    features = Features({name: tokenized_dataset.features[name] for name in columns})
+    return Dataset.from_dict(columns, features=features)
+
+
+def _get_length_bucketed_batches(
+    dataset: Dataset,
+    batch_size: int,
+    do_shuffle: bool,
+    generator: Optional[torch.Generator] = None,
+) -> List[List[int]]:
+    """
+    Group dataset indices into batches of samples with similar lengths, to minimize
+    the number of padding tokens
+
+    :param dataset: tokenized dataset to batch
+    :param batch_size: number of samples per batch
+    :param do_shuffle: whether to shuffle the order of the batches
+    :param generator: optional generator of the order of the batches
+    :return: list of batches of dataset indices
+    """
+    if "input_ids" in dataset.column_names:
+        lengths = [len(input_ids) for input_ids in dataset["input_ids"]]
+        indices = sorted(range(len(dataset)), key=lambda index: lengths[index])
+    else:
+        indices = list(range(len(dataset)))
+
+    batches = [
+        indices[start : start + batch_size]
+        for start in range(0, len(indices), batch_size)
+    ]
+    if do_shuffle:
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        batches = [batches[index] for index in order]
+
+    return batches
+
+
+def _collate_padded(
+    features: List[Dict[str, Any]], collate_fn: Callable
+) -> Dict[str, Any]:
+    """
+    Right-pad variable length sequences to the longest sequence in the batch before
+    collating. Labels are padded with LABELS_MASK_VALUE, all other sequences with 0,
+    which also marks padding tokens in the attention mask
+
+    :param features: samples of the batch
+    :param collate_fn: collate function to apply to the padded samples
+    :return: collated batch
+    """
+    features = [dict(feature) for feature in features]
+    for key, value in features[0].items():
+        if not isinstance(value, (list, torch.Tensor)):
+            continue
+
+        lengths = [len(feature[key]) for feature in features]
+        max_length = max(lengths)
+        if min(lengths) == max_length:
+            continue
+
+        pad_value = LABELS_MASK_VALUE if key == "labels" else 0
+        for feature, length in zip(features, lengths):
+            padding = [pad_value] * (max_length - length)
+            if isinstance(feature[key], torch.Tensor):
+                padding = torch.tensor(padding, dtype=feature[key].dtype)
+                feature[key] = torch.cat([feature[key], padding])
+            else:
+                feature[key] = list(feature[key]) + padding
+
+    return collate_fn(features)
+
+
 def get_raw_dataset(
     data_args,
     cache_dir: Optional[str] = None,
@@ -113,7 +419,7 @@ def make_dataset_splits(
     # handles case where all splits are contained in a single dataset
     if "all" in tokenized_datasets and len(tokenized_datasets) == 1:
         tokenized_datasets = tokenized_datasets.get("all")
-        if isinstance(tokenized_datasets, Dataset):
+        if isinstance(tokenized_datasets, (Dataset, IterableDataset)):
             tokenized_datasets = {"train": tokenized_datasets}
 
     train_split = eval_split = predict_split = calib_split = None
@@ -243,3 +549,317 @@ def transform_dataset_keys(data_files: Dict[str, Any]):
             transform_dataset_key(dataset_key)
 
     return data_files
+
+
+def get_tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash the files of a tokenizer, including its vocabulary, special tokens and chat
+    template, as written by `save_pretrained`
+
+    :param tokenizer: tokenizer to fingerprint
+    :return: hex digest of the tokenizer files
+    """
+    hasher = Hasher()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokenizer.save_pretrained(tmp_dir)
+        for root, _, files in sorted(os.walk(tmp_dir)):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                hasher.update(os.path.relpath(path, tmp_dir))
+                if filename == "tokenizer.json":
+                    # fast tokenizers store the truncation and padding settings of
+                    # their last call, which don't change the tokenizer itself
+                    with open(path, "r") as file:
+                        config = json.load(file)
+                    config.pop("truncation", None)
+                    config.pop("padding", None)
+                    hasher.update(json.dumps(config, sort_keys=True))
+                else:
+                    with open(path, "rb") as file:
+                        hasher.update(file.read())
+
+    return hasher.hexdigest()
+
+
+def get_packing_fingerprint() -> str:
+    """
+    Hash the source code of `pack_dataset` and its helpers, which tokenized datasets
+    are packed with, along with the value labels are masked with
+
+    :return: hex digest of the packing and labelling code
+    """
+    packing_code = [
+        inspect.getsource(obj)
+        for obj in (SequencePacker, pack_dataset, _is_list_type, _list_lengths)
+    ]
+    return Hasher.hash([packing_code, LABELS_MASK_VALUE])
+
+
+def get_local_files_fingerprint(paths: Union[None, str, List, Dict]) -> Optional[str]:
+    """
+    Hash the size and modification time of each local file referenced by paths, so
+    that edits to local dataset files are detected without reading them
+
+    :param paths: file or directory path, or a list or dict of them such as the
+        `data_files` argument of `load_dataset`
+    :return: hex digest of the file stats, or None if no local files are referenced
+    """
+    if isinstance(paths, dict):
+        paths = [paths[key] for key in sorted(paths)]
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+
+    stats = []
+    for path in paths:
+        if isinstance(path, (list, tuple, dict)):
+            stats.append(get_local_files_fingerprint(path))
+        elif isinstance(path, str) and os.path.isfile(path):
+            stats.append((path, os.path.getsize(path), os.path.getmtime(path)))
+        elif isinstance(path, str) and os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    file_path = os.path.join(root, filename)
+                    stats.append(
+                        (
+                            file_path,
+                            os.path.getsize(file_path),
+                            os.path.getmtime(file_path),
+                        )
+                    )
+
+    if not any(stat is not None for stat in stats):
+        return None
+
+    return Hasher.hash(stats)
+
+
+def get_hub_dataset_revision(
+    name: str, revision: Optional[str] = None
+) -> Optional[str]:
+    """
+    Resolve a revision of a dataset on the Hugging Face hub to its commit sha, so
+    that updates to a dataset which isn't pinned to a commit are detected
+
+    :param name: name of the dataset on the hub
+    :param revision: optional branch, tag or commit sha. Defaults to the main branch
+    :return: commit sha of the revision, or None if it can't be resolved, for
+        example when offline
+    """
+    if revision is not None and re.fullmatch(r"[0-9a-f]{40}", revision):
+        return revision
+
+    try:
+        return dataset_info(name, revision=revision).sha
+    except Exception as err:
+        LOGGER.debug(f"Unable to resolve the hub revision of {name}: {err}")
+        return None
+
+
+def load_tokenized_dataset(
+    cache_dir: str, fingerprint: str
+) -> Optional[Union[Dataset, DatasetDict]]:
+    """
+    Load a tokenized dataset previously stored by `save_tokenized_dataset`. The
+    arrow files of the dataset are memory-mapped rather than read into memory
+
+    :param cache_dir: directory of the tokenized dataset cache
+    :param fingerprint: fingerprint of the tokenized dataset
+    :return: the cached dataset, or None if it is not in the cache
+    """
+    path = os.path.join(cache_dir, fingerprint)
+    if not os.path.isdir(path):
+        return None
+
+    LOGGER.info(f"Loading tokenized dataset from cache {path}")
+    return load_from_disk(path)
+
+
+def save_tokenized_dataset(
+    dataset: Union[Dataset, DatasetDict], cache_dir: str, fingerprint: str
+) -> str:
+    """
+    Store a tokenized dataset in the cache under its fingerprint. The dataset is
+    written to a temporary directory which is then renamed, so that concurrent
+    processes never load a partially written dataset
+
+    :param dataset: tokenized dataset to store
+    :param cache_dir: directory of the tokenized dataset cache
+    :param fingerprint: fingerprint of the tokenized dataset
+    :return: path of the cached dataset
+    """
+    path = os.path.join(cache_dir, fingerprint)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{fingerprint}.", dir=cache_dir)
+    try:
+        dataset.save_to_disk(tmp_dir)
+        if os.path.isdir(path):
+            # replace a stale entry, such as when overwriting the cache
+            shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_dir, path)
+    except OSError:
+        # another process stored the same dataset first
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return path
+
+
+class SequencePacker:
+    """
+    Packs tokenized documents into blocks of block_size tokens. Documents are
+    concatenated through their arrow buffers in linear time, and the tokens which
+    don't fill a block are carried over to the next batch, so only the tail of the
+    last batch is dropped. Batches must therefore be passed in order, by a single
+    process. The carried tokens are discarded when a batch starting at index 0 is
+    passed, so that each pass over a streamed dataset is packed the same way.
+    Columns which aren't aligned with the input_ids of each document, such as
+    prompts, are dropped
+
+    :param block_size: number of tokens per block
+    :param add_position_ids: whether to add position_ids which restart at 0 at the
+        start of each document and each block, marking the document boundaries
+        within a block for attention implementations which support them
+    """
+
+    DOCUMENT_STARTS_KEY = "document_starts"
+
+    def __init__(self, block_size: int, add_position_ids: bool = False):
+        self.block_size = block_size
+        self.add_position_ids = add_position_ids
+        self._remainder: Dict[str, numpy.ndarray] = {}
+
+    def __call__(
+        self, batch: pyarrow.Table, indices: Optional[List[int]] = None
+    ) -> pyarrow.Table:
+        """
+        :param batch: batch of tokenized documents, with one list column per feature
+        :param indices: optional indices of the documents of the batch within the
+            dataset, as passed by `map(..., with_indices=True)`
+        :return: table of the blocks which could be filled, including the tokens
+            carried over from previous batches
+        """
+        if indices is not None and len(indices) > 0 and indices[0] == 0:
+            # start of a new pass over the dataset
+            self._remainder = {}
+
+        lengths = _list_lengths(batch.column("input_ids"))
+        columns = {}
+        for name in batch.column_names:
+            column = batch.column(name).combine_chunks()
+            if not _is_list_type(column.type):
+                continue
+            if not numpy.array_equal(_list_lengths(column), lengths):
+                continue
+            columns[name] = column.flatten().to_numpy(zero_copy_only=False)
+
+        starts = numpy.zeros(int(lengths.sum()), dtype=bool)
+        offsets = numpy.cumsum(lengths) - lengths
+        starts[offsets[lengths > 0]] = True
+        columns[self.DOCUMENT_STARTS_KEY] = starts
+
+        for name, values in columns.items():
+            if name in self._remainder:
+                columns[name] = numpy.concatenate([self._remainder[name], values])
+
+        num_tokens = len(starts) + len(
+            self._remainder.get(self.DOCUMENT_STARTS_KEY, ())
+        )
+        num_packed = num_tokens - num_tokens % self.block_size
+        self._remainder = {
+            name: values[num_packed:].copy() for name, values in columns.items()
+        }
+
+        starts = columns.pop(self.DOCUMENT_STARTS_KEY)[:num_packed]
+        if self.add_position_ids:
+            columns["position_ids"] = self._get_position_ids(starts)
+
+        block_offsets = pyarrow.array(
+            numpy.arange(0, num_packed + 1, self.block_size, dtype=numpy.int32)
+        )
+        return pyarrow.table(
+            {
+                name: pyarrow.ListArray.from_arrays(
+                    block_offsets, pyarrow.array(values[:num_packed])
+                )
+                for name, values in columns.items()
+            }
+        )
+
+    def _get_position_ids(self, starts: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param starts: mask of the tokens which start a document
+        :return: position of each token since the start of its document or block
+        """
+        indices = numpy.arange(len(starts))
+        segment_starts = starts | (indices % self.block_size == 0)
+        segment_starts = numpy.maximum.accumulate(
+            numpy.where(segment_starts, indices, 0)
+        )
+        return indices - segment_starts
+
+
+def pack_dataset(
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict],
+    block_size: int,
+    add_position_ids: bool = False,
+    load_from_cache_file: bool = True,
+    batch_size: int = 1000,
+) -> Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict]:
+    """
+    Concatenate the tokenized documents of a dataset and split them into blocks of
+    block_size tokens, see SequencePacker. Documents are read in batches of
+    batch_size, and the remaining tokens of each batch are carried to the next, so
+    packing runs in a single process
+
+    :param dataset: tokenized dataset to pack
+    :param block_size: number of tokens per block
+    :param add_position_ids: whether to add position_ids marking the document
+        boundaries within each block
+    :param load_from_cache_file: whether to reuse a cached result of packing an
+        in-memory dataset
+    :param batch_size: number of documents to read at once
+    :return: dataset of packed blocks
+    """
+    if isinstance(dataset, (DatasetDict, IterableDatasetDict)):
+        return type(dataset)(
+            {
+                name: pack_dataset(
+                    split,
+                    block_size,
+                    add_position_ids,
+                    load_from_cache_file,
+                    batch_size,
+                )
+                for name, split in dataset.items()
+            }
+        )
+
+    packer = SequencePacker(block_size, add_position_ids=add_position_ids)
+    if isinstance(dataset, IterableDataset):
+        # the output tables of streamed datasets replace the input tables
+        packed = dataset.with_format("arrow").map(
+            packer, with_indices=True, batched=True, batch_size=batch_size
+        )
+    else:
+        packed = dataset.with_format("arrow").map(
+            packer,
+            with_indices=True,
+            batched=True,
+            batch_size=batch_size,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=load_from_cache_file,
+            desc="Packing sequences",
+        )
+
+    return packed.with_format(None)
+
+
+def _is_list_type(data_type: pyarrow.DataType) -> bool:
+    return pyarrow.types.is_list(data_type) or pyarrow.types.is_large_list(data_type)
+
+
+def _list_lengths(column: Union[pyarrow.Array, pyarrow.ChunkedArray]) -> numpy.ndarray:
+    return pyarrow.compute.list_value_length(column).to_numpy(zero_copy_only=False)
@@ -20,7 +20,9 @@ from llmcompressor.transformers.finetune.data import TextGenerationDataset
 from llmcompressor.transformers.finetune.data.data_args import DataTrainingArguments
 from llmcompressor.transformers.finetune.data.data_helpers import (
     format_calibration_data,
+    load_tokenized_dataset,
     make_dataset_splits,
+    save_tokenized_dataset,
 )
 from llmcompressor.transformers.finetune.model_args import ModelArguments
 from llmcompressor.transformers.finetune.training_args import TrainingArguments
@@ -106,15 +108,31 @@ class StageRunner:
             )
 
             dataset = self._data_args.dataset
-            if hasattr(dataset, "column_names") and "input_ids" in dataset.column_names:
+            # the columns of streamed datasets may be unknown until they are streamed
+            column_names = getattr(dataset, "column_names", None) or []
+            if "input_ids" in column_names:
                 # dataset is already tokenized
                 tokenized_datasets[split_name] = dataset
             else:
-                # dataset needs to be tokenized
-                raw_dataset = dataset_manager.get_raw_dataset()
-                tokenized_dataset = dataset_manager.tokenize_and_process(
-                    raw_dataset, add_labels=add_labels
-                )
+                # dataset needs to be tokenized, unless it is already in the cache
+                cache_dir = self._data_args.tokenized_cache_dir
+                fingerprint = None
+                tokenized_dataset = None
+                if cache_dir is not None:
+                    fingerprint = dataset_manager.get_fingerprint(add_labels)
+                if fingerprint is not None and not self._data_args.overwrite_cache:
+                    tokenized_dataset = load_tokenized_dataset(cache_dir, fingerprint)
+
+                if tokenized_dataset is None:
+                    raw_dataset = dataset_manager.get_raw_dataset()
+                    tokenized_dataset = dataset_manager.tokenize_and_process(
+                        raw_dataset, add_labels=add_labels
+                    )
+                    if fingerprint is not None:
+                        save_tokenized_dataset(
+                            tokenized_dataset, cache_dir, fingerprint
+                        )
+
                 tokenized_datasets[split_name] = tokenized_dataset
 
         self.datasets = make_dataset_splits(
@@ -150,6 +168,10 @@ class StageRunner:
                 num_calibration_samples=self._data_args.num_calibration_samples,
                 do_shuffle=self._data_args.shuffle_calibration_samples,
                 accelerator=self.trainer.accelerator,
+                batch_size=self._data_args.calibration_batch_size,
+                num_calibration_tokens=self._data_args.num_calibration_tokens,
+                sequence_length=self._data_args.calibration_sequence_length,
+                seed=self._training_args.seed,
             )
 
             # if we don't run a forward pass after initializing the FSDP model for the
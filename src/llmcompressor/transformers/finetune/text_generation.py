@@ -20,6 +20,7 @@
 import os
 from pathlib import PosixPath
 
+from datasets import IterableDataset
 from loguru import logger
 from transformers import (
     AutoConfig,
@@ -335,6 +336,11 @@ def main(
     eval_dataset = stage_runner.get_dataset_split("validation")
     calib_dataset = stage_runner.get_dataset_split("calibration")
 
+    # streamed calibration data has no length, which the trainer requires of datasets
+    # used for training, and is only used for one-shot calibration
+    if train_dataset is None and not isinstance(calib_dataset, IterableDataset):
+        train_dataset = calib_dataset
+
     # Initialize our Trainer
     data_collator = DefaultDataCollator()
     trainer = Trainer(
@@ -344,7 +350,7 @@ def main(
         recipe_args=training_args.recipe_args,
         args=training_args,
         data_args=data_args,
-        train_dataset=train_dataset or calib_dataset,
+        train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         tokenizer=tokenizer,
         data_collator=data_collator,
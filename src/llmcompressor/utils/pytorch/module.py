@@ -4,7 +4,10 @@ Utility / helper functions
 
 import difflib
 import re
-from typing import Dict, List, Optional, Tuple, Union
+import weakref
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 from compressed_tensors.quantization.utils import is_module_quantized
@@ -60,6 +63,7 @@ __all__ = [
     "get_layers_params",
     "get_matching_layer",
     "get_no_split_params",
+    "get_sequential_layers",
 ]
 
 
@@ -77,8 +81,7 @@ def match_targets(name: str, targets: Union[str, List[str]]) -> Tuple[bool, int]
 
     for index, target in enumerate(targets):
         if target[:3] == "re:":
-            pattern = target[3:]
-            if re.match(pattern, name):
+            if _compile_target(target).match(name):
                 return True, index
         elif name == target:
             return True, index
@@ -97,6 +100,235 @@ def match_class(layer: Module, targets: Union[str, List[str]]) -> Tuple[bool, in
     return False, -1
 
 
+@lru_cache(maxsize=None)
+def _compile_target(target: str) -> "re.Pattern":
+    return re.compile(target[3:])
+
+
+# incremented whenever a module or parameter is registered to any module, which
+# invalidates the module indexes built before
+_module_tree_version = 0
+
+# handles of the global registration hooks which track the module tree version. The
+# hooks are registered when the first module index is built rather than on import
+_module_tree_hooks: Optional[List[Any]] = None
+
+
+def _increment_module_tree_version(*_args):
+    global _module_tree_version
+    _module_tree_version += 1
+
+
+def _track_module_tree() -> bool:
+    """
+    Register the global hooks which track the module tree version, if not already
+    registered
+
+    :return: True if the module tree version is tracked by this version of torch
+    """
+    global _module_tree_hooks
+    if _module_tree_hooks is None:
+        _module_tree_hooks = []
+        if hasattr(torch.nn.modules.module, "register_module_module_registration_hook"):
+            _module_tree_hooks = [
+                torch.nn.modules.module.register_module_module_registration_hook(
+                    _increment_module_tree_version
+                ),
+                torch.nn.modules.module.register_module_parameter_registration_hook(
+                    _increment_module_tree_version
+                ),
+            ]
+
+    return len(_module_tree_hooks) > 0
+
+
+_MODULE_INDEXES: "weakref.WeakKeyDictionary[Module, _ModuleIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class _ModuleIndex:
+    """
+    Index of the submodules of a model in the order of `named_modules`, with names
+    fixed for FSDP. Keeps the positions of submodules by name and by class name, and
+    the parent and the end of the subtree of each submodule as a prefix tree. Used to
+    resolve targets without walking the module tree and matching regexes on every
+    call. Resolved targets are cached until the module tree changes. Parameters are
+    cached by name and looked up on their module on every call, since parameters
+    may be replaced without registration hooks, such as by offloading
+
+    :param module: module to index
+    :param version: module tree version the index is built at
+    """
+
+    def __init__(self, module: Module, version: int):
+        self.version = version
+        self.names: List[str] = []
+        self.layers: List[Module] = []
+        self.parents: List[int] = []
+        self.attr_names: List[str] = []
+        self.subtree_ends: List[int] = []
+        self.name_positions: Dict[str, List[int]] = {}
+        self.class_positions: Dict[str, List[int]] = {}
+        self.resolved: Dict[Tuple, List[Tuple[str, int, Optional[str]]]] = {}
+
+        memo = set()
+        # stack of (layer, name, parent position, attribute name in parent)
+        stack = [(module, "", -1, "")]
+        open_subtrees = []
+        while stack:
+            layer, name, parent, attr_name = stack.pop()
+            if layer in memo:
+                continue
+            memo.add(layer)
+
+            # close the subtrees which do not contain this layer
+            while open_subtrees and open_subtrees[-1] != parent:
+                self.subtree_ends[open_subtrees.pop()] = len(self.names)
+
+            position = len(self.names)
+            fixed_name = fix_fsdp_module_name(name)
+            self.names.append(fixed_name)
+            self.layers.append(layer)
+            self.parents.append(parent)
+            self.attr_names.append(attr_name)
+            self.subtree_ends.append(-1)
+            self.name_positions.setdefault(fixed_name, []).append(position)
+            class_name = layer.__class__.__name__
+            self.class_positions.setdefault(class_name, []).append(position)
+            open_subtrees.append(position)
+
+            prefix = name + ("." if name else "")
+            children = [
+                (child, prefix + child_name, position, child_name)
+                for child_name, child in layer._modules.items()
+                if child is not None
+            ]
+            stack.extend(reversed(children))
+
+        for position in open_subtrees:
+            self.subtree_ends[position] = len(self.names)
+
+    def is_current(self, positions: List[int]) -> bool:
+        """
+        :param positions: positions of indexed submodules
+        :return: True if each of the submodules is still attached to the module
+            through the same parents, catching deleted modules which the module tree
+            version does not track
+        """
+        checked = set()
+        for position in positions:
+            while position > 0 and position not in checked:
+                checked.add(position)
+                parent = self.layers[self.parents[position]]
+                child = parent._modules.get(self.attr_names[position])
+                if child is not self.layers[position]:
+                    return False
+                position = self.parents[position]
+
+        return True
+
+    def match(
+        self, targets: List[str], params: bool
+    ) -> Tuple[List[Tuple[str, int, Any]], List[str]]:
+        """
+        Match targets to the names and classes of submodules and the names of their
+        direct parameters, following the semantics of `match_layers_params`. Only
+        regex targets require matching every submodule, other targets are looked up
+
+        :param targets: names, regexes prefixed with "re:" or class names to match
+        :param params: True to resolve parameters instead of modules
+        :return: list of resolved names, positions of the resolved submodules and
+            resolved values, and the list of targets which could not be found
+        """
+        key = (tuple(targets), params)
+        if key in self.resolved:
+            matches = self._get_values(self.resolved[key])
+            if matches is not None:
+                return matches, []
+
+        if any(target[:3] == "re:" for target in targets):
+            candidates = range(len(self.names))
+        else:
+            candidates = set()
+            for target in targets:
+                candidates.update(self.name_positions.get(target, []))
+                candidates.update(self.class_positions.get(target, []))
+                layer_name, _, _ = target.rpartition(".")
+                candidates.update(self.name_positions.get(layer_name, []))
+            candidates = sorted(candidates)
+
+        # resolved names mapped to the position of their submodule and the name of
+        # the resolved parameter, or None to resolve the submodule itself
+        resolved = {}
+        targets_found = [False for _ in range(len(targets))]
+        for position in candidates:
+            name, layer = self.names[position], self.layers[position]
+            match, match_index = match_targets(name, targets)
+            if match and not params:
+                targets_found[match_index] = True
+                resolved[name] = (position, None)
+            else:
+                match, match_index = match_class(layer, targets)
+                if match:
+                    targets_found[match_index] = True
+                    resolved[name] = (position, None)
+
+            for param_name, _ in layer.named_parameters(recurse=False):
+                param_match, param_match_index = match_targets(
+                    f"{name}.{param_name}", targets
+                )
+                if param_match:
+                    targets_found[param_match_index] = True
+                    resolved[name] = (position, param_name if params else None)
+
+        missed = [target for found, target in zip(targets_found, targets) if not found]
+        entries = [
+            (name, position, param_name)
+            for name, (position, param_name) in resolved.items()
+        ]
+        if len(missed) == 0:
+            self.resolved[key] = entries
+
+        return self._get_values(entries), missed
+
+    def _get_values(
+        self, entries: List[Tuple[str, int, Optional[str]]]
+    ) -> Optional[List[Tuple[str, int, Any]]]:
+        """
+        :param entries: resolved names, positions of submodules and optional names
+            of their parameters
+        :return: resolved names, positions of submodules and the submodules or their
+            current parameters, or None if a parameter no longer exists
+        """
+        matches = []
+        for name, position, param_name in entries:
+            value = self.layers[position]
+            if param_name is not None:
+                value = getattr(value, param_name, None)
+                if value is None:
+                    return None
+            matches.append((name, position, value))
+
+        return matches
+
+
+def _get_module_index(module: Module, rebuild: bool = False) -> _ModuleIndex:
+    """
+    :param module: module to get the index of
+    :param rebuild: True to rebuild the index even if the module tree is unchanged
+    :return: index of the module, rebuilt if the module tree changed since it was
+        last built
+    """
+    tracked = _track_module_tree()
+    index = _MODULE_INDEXES.get(module)
+    if rebuild or index is None or not tracked or index.version != _module_tree_version:
+        index = _ModuleIndex(module, _module_tree_version)
+        _MODULE_INDEXES[module] = index
+
+    return index
+
+
 def get_default_params(layers: Dict[str, Module]) -> Dict[str, Parameter]:
     params = {}
     for name, layer in layers.items():
@@ -128,38 +360,16 @@ def match_layers_params(
     if isinstance(targets, str):
         targets = [targets]
 
-    resolved = {}
-    targets_found = [False for _ in range(len(targets))]
-
-    for name, layer in module.named_modules():
-        # due to nesting, FSDP may not be the top layer
-        name = fix_fsdp_module_name(name)
-        match, match_index = match_targets(name, targets)
-        if match and not params:
-            targets_found[match_index] = True
-            resolved[name] = layer
-        else:
-            match, match_index = match_class(layer, targets)
-            if match:
-                targets_found[match_index] = True
-                resolved[name] = layer
-
-        for param_name, param in layer.named_parameters():
-            if "." in param_name:  # skip parameters of nested layers
-                continue
-
-            param_match, param_match_index = match_targets(
-                f"{name}.{param_name}", targets
-            )
-            if param_match:
-                targets_found[param_match_index] = True
-                resolved[f"{name}"] = layer if not params else param
+    index = _get_module_index(module)
+    matches, missed = index.match(targets, params)
+    if not index.is_current([position for _, position, _ in matches]):
+        index = _get_module_index(module, rebuild=True)
+        matches, missed = index.match(targets, params)
 
-    missed = [target for found, target in zip(targets_found, targets) if not found]
     if len(missed) > 0:
         raise ValueError(f"Could not find targets {missed} in module {module}")
 
-    return resolved
+    return {name: value for name, _, value in matches}
 
 
 def get_layers(targets: Union[str, List[str]], module: Module) -> Dict[str, Module]:
@@ -309,6 +519,26 @@ def get_matching_layer(
     best matches name_to_match, or None if no match can be found
     """
     potential_matches = get_layers(target, module)
+
+    # only consider matches in the subtree of the closest ancestor of name_to_match
+    # which contains any, found by bisecting the positions of the matches
+    index = _get_module_index(module)
+    if name_to_match in index.name_positions:
+        position = index.name_positions[name_to_match][0]
+        positions = sorted(index.name_positions[name][0] for name in potential_matches)
+        while position != -1:
+            start = bisect_left(positions, position)
+            end = bisect_left(positions, index.subtree_ends[position])
+            if start < end:
+                names = {index.names[match] for match in positions[start:end]}
+                potential_matches = {
+                    name: layer
+                    for name, layer in potential_matches.items()
+                    if name in names
+                }
+                break
+            position = index.parents[position]
+
     largest_substring = 0
     match = None
     for name, module in potential_matches.items():
@@ -338,3 +568,39 @@ def get_no_split_params(module: Module) -> Union[str, List[str]]:
     if hasattr(model, "_no_split_modules"):
         return model._no_split_modules
     return ALL_TARGET
+
+
+def get_sequential_layers(
+    model: Module, layers: List[Module]
+) -> Optional[List[Module]]:
+    """
+    Get the layers of a model which shouldn't be split, such as the decoder layers of
+    a Hugging Face Transformer model, from the first to the last of the given layers.
+    The outputs of each of these layers are the inputs to the next one, so calibration
+    data can be passed through them one at a time
+
+    :param model: model containing the layers
+    :param layers: layers to pass calibration data through, in order
+    :return: layers which shouldn't be split, from the first to the last of the given
+        layers, or None if the given layers are not such layers in model order
+    """
+    no_split_params = get_no_split_params(model)
+    if no_split_params == ALL_TARGET or not layers:
+        return None
+
+    try:
+        no_split_layers = list(get_layers(no_split_params, model).values())
+    except ValueError:
+        # the model has no layers of the no split classes
+        return None
+
+    positions = []
+    for layer in layers:
+        position = next(
+            (idx for idx, other in enumerate(no_split_layers) if other is layer), None
+        )
+        if position is None or (positions and position <= positions[-1]):
+            return None
+        positions.append(position)
+
+    return no_split_layers[positions[0] : positions[-1] + 1]
@@ -116,3 +116,45 @@ def test_cache_reset():
     assert len(different_cache.v_observers) == 0
 
     assert hex(id(cache)) != hex(id(different_cache))
+
+    different_cache.reset()
+
+
+def test_update_observe_only():
+    args = QuantizationArgs(num_bits=8, type="float", symmetric=True)
+    key_states = torch.randn(2, 4, 8, 16)
+    value_states = torch.randn(2, 4, 8, 16)
+
+    cache = QuantizedKVParameterCache(args)
+    cache.update(key_states, value_states, 0)
+    k_scale, v_scale = cache.get_scales(0)
+    cache.reset()
+
+    # states are returned unquantized, with the same scales
+    observe_cache = QuantizedKVParameterCache(args, observe_only=True)
+    keys, values = observe_cache.update(key_states, value_states, 0)
+    assert keys is key_states
+    assert values is value_states
+    assert torch.equal(observe_cache.get_scales(0)[0], k_scale)
+    assert torch.equal(observe_cache.get_scales(0)[1], v_scale)
+    observe_cache.reset()
+
+
+def test_update_per_head():
+    args = QuantizationArgs(
+        num_bits=8, type="float", symmetric=True, strategy="channel"
+    )
+    num_heads = 4
+    key_states = torch.randn(2, num_heads, 8, 16)
+    value_states = torch.randn(2, num_heads, 8, 16) * torch.arange(1, 5).reshape(
+        1, -1, 1, 1
+    )
+
+    cache = QuantizedKVParameterCache(args, observe_only=True)
+    cache.update(key_states, value_states, 0)
+    k_scale, v_scale = cache.get_scales(0)
+
+    assert k_scale.shape == v_scale.shape == (num_heads,)
+    expected_v_scale = value_states.abs().amax(dim=(0, 2, 3)) / 448.0
+    assert torch.allclose(v_scale, expected_v_scale)
+    cache.reset()
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import torch
+from compressed_tensors.quantization.lifecycle.helpers import disable_quantization
 from compressed_tensors.quantization.lifecycle.initialize import (
     initialize_module_for_quantization,
 )
@@ -21,8 +23,12 @@ from compressed_tensors.quantization.quant_scheme import QuantizationScheme
 from torch.nn import Linear
 
 from llmcompressor.modifiers.quantization.calibration import (
+    apply_deferred_calibration,
+    calibrate_input_hook,
+    defer_calibration,
     freeze_module_quantization,
     initialize_observer,
+    observe_input_hook,
 )
 
 
@@ -49,3 +55,62 @@ def test_set_module_for_calibration():
     assert not hasattr(layer, "weight_observer")
 
     assert layer.quantization_status == QuantizationStatus("frozen")
+
+
+def test_freeze_final_qparams():
+    quantization_scheme = QuantizationScheme(
+        targets=["*"],
+        input_activations=QuantizationArgs(
+            num_bits=8, symmetric=False, observer="histogram"
+        ),
+    )
+
+    layer = Linear(4, 4)
+
+    initialize_module_for_quantization(layer, quantization_scheme)
+    layer.quantization_status = QuantizationStatus("calibration")
+    initialize_observer(layer, "input")
+
+    inputs = torch.linspace(-1.0, 1.0, 100000).reshape(1, -1, 4)
+    inputs[0, 0, 0] = -100.0
+    calibrate_input_hook(layer, (inputs,))
+    calibrated_scale = layer.input_scale.clone()
+
+    # the histogram observer clips the outlier once calibration is complete
+    freeze_module_quantization(layer)
+    assert layer.input_scale.shape == calibrated_scale.shape
+    assert layer.input_scale < calibrated_scale / 10
+
+
+def test_deferred_calibration():
+    quantization_scheme = QuantizationScheme(
+        targets=["*"],
+        input_activations=QuantizationArgs(num_bits=8, symmetric=False),
+    )
+    inputs = [torch.randn(1, 8, 4) * (index + 1) for index in range(3)]
+
+    layer = Linear(4, 4)
+    initialize_module_for_quantization(layer, quantization_scheme)
+    initialize_observer(layer, "input")
+    for inp in inputs:
+        calibrate_input_hook(layer, (inp,))
+
+    deferred_layer = Linear(4, 4)
+    initialize_module_for_quantization(deferred_layer, quantization_scheme)
+    initialize_observer(deferred_layer, "input")
+    defer_calibration(deferred_layer)
+    initial_scale = deferred_layer.input_scale.clone()
+    for inp in inputs:
+        observe_input_hook(deferred_layer, (inp,))
+
+    # parameters are only written once calibration is complete
+    assert torch.equal(deferred_layer.input_scale, initial_scale)
+    apply_deferred_calibration(deferred_layer)
+    assert deferred_layer.quantization_enabled
+    assert torch.equal(deferred_layer.input_scale, layer.input_scale)
+    assert torch.equal(deferred_layer.input_zero_point, layer.input_zero_point)
+
+    # modules disabled for other reasons are left untouched
+    disable_quantization(layer)
+    apply_deferred_calibration(layer)
+    assert not layer.quantization_enabled
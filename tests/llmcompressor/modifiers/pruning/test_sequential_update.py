@@ -0,0 +1,138 @@
+from typing import List
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llmcompressor.core import active_session, create_session
+from llmcompressor.modifiers import Modifier
+from llmcompressor.modifiers.obcq import SparseGPTModifier
+from llmcompressor.modifiers.pruning.wanda import WandaPruningModifier
+from llmcompressor.modifiers.utils.layer_checkpoint import LayerCheckpoint
+
+NUM_LAYERS = 3
+
+
+def _tiny_llama() -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        vocab_size=100,
+    )
+    return LlamaForCausalLM(config)
+
+
+def _calibration_data():
+    generator = torch.Generator().manual_seed(1)
+    return [
+        {
+            "input_ids": torch.randint(0, 100, (1, 16), generator=generator),
+            "attention_mask": torch.ones(1, 16, dtype=torch.long),
+        }
+        for _ in range(4)
+    ]
+
+
+def _prune(model: LlamaForCausalLM, recipe: List[Modifier]):
+    with create_session():
+        session = active_session()
+        session.initialize(
+            model=model, recipe=recipe, calib_data=_calibration_data(), start=-1
+        )
+        session.finalize()
+
+
+def _assert_equal_weights(model: LlamaForCausalLM, expected: LlamaForCausalLM):
+    expected_params = dict(expected.named_parameters())
+    for name, param in model.named_parameters():
+        assert torch.equal(param, expected_params[name]), name
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("modifier_cls", [SparseGPTModifier, WandaPruningModifier])
+def test_sequential_update(modifier_cls):
+    model = _tiny_llama()
+    _prune(model, [modifier_cls(sparsity=0.5, sequential_update=True)])
+
+    # pruning one layer at a time with full forward passes calibrates each layer on
+    # the outputs of the previously pruned layers, like the cached layer inputs
+    expected = _tiny_llama()
+    for index in range(NUM_LAYERS):
+        targets = [f"model.layers.{index}"]
+        _prune(expected, [modifier_cls(sparsity=0.5, targets=targets)])
+    _assert_equal_weights(model, expected)
+
+    # without sequential updates, later layers are calibrated on the original outputs
+    # of earlier layers
+    non_sequential = _tiny_llama()
+    _prune(non_sequential, [modifier_cls(sparsity=0.5)])
+    last_layer = f"model.layers.{NUM_LAYERS - 1}.mlp.down_proj.weight"
+    assert not torch.equal(
+        dict(model.named_parameters())[last_layer],
+        dict(non_sequential.named_parameters())[last_layer],
+    )
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("modifier_cls", [SparseGPTModifier, WandaPruningModifier])
+@pytest.mark.parametrize(
+    "targets",
+    [
+        # layers between targets are not pruned, but their outputs are propagated
+        ["model.layers.0", "model.layers.2"],
+        # lm_head is not a decoder layer, each target is calibrated with a full
+        # forward pass
+        ["model.layers.0", "model.layers.1", "lm_head"],
+    ],
+)
+def test_sequential_update_targets(modifier_cls, targets):
+    model = _tiny_llama()
+    _prune(model, [modifier_cls(sparsity=0.5, sequential_update=True, targets=targets)])
+
+    expected = _tiny_llama()
+    for target in targets:
+        _prune(expected, [modifier_cls(sparsity=0.5, targets=[target])])
+    _assert_equal_weights(model, expected)
+
+    untargeted = dict(_tiny_llama().named_parameters())
+    for name, param in model.named_parameters():
+        if not any(name.startswith(f"{target}.") for target in targets):
+            assert torch.equal(param, untargeted[name]), name
+
+
+@pytest.mark.integration
+def test_sequential_update_checkpoint_resume(tmp_path, monkeypatch):
+    def build_modifier(**kwargs):
+        return SparseGPTModifier(sparsity=0.5, sequential_update=True, **kwargs)
+
+    expected = _tiny_llama()
+    _prune(expected, [build_modifier()])
+
+    # interrupt compression once the first layer is saved
+    save_layer = LayerCheckpoint.save_layer
+
+    def interrupted_save_layer(self, layer_compressor, intermediates=None):
+        save_layer(self, layer_compressor, intermediates)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(LayerCheckpoint, "save_layer", interrupted_save_layer)
+    with pytest.raises(KeyboardInterrupt):
+        _prune(_tiny_llama(), [build_modifier(checkpoint_dir=str(tmp_path))])
+    monkeypatch.undo()
+
+    # the first layer is restored and compression resumes from its saved outputs
+    completed_layers = []
+
+    def recorded_save_layer(self, layer_compressor, intermediates=None):
+        completed_layers.append(layer_compressor.layer_index)
+        save_layer(self, layer_compressor, intermediates)
+
+    monkeypatch.setattr(LayerCheckpoint, "save_layer", recorded_save_layer)
+    model = _tiny_llama()
+    _prune(model, [build_modifier(checkpoint_dir=str(tmp_path))])
+    assert completed_layers == list(range(1, NUM_LAYERS))
+    _assert_equal_weights(model, expected)
@@ -0,0 +1,223 @@
+from typing import List, Union
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llmcompressor.core import active_session, create_session
+from llmcompressor.modifiers import Modifier, StageModifiers
+from llmcompressor.modifiers.quantization import GPTQModifier, QuantizationModifier
+from llmcompressor.modifiers.quantization.cache import QuantizedKVParameterCache
+from llmcompressor.modifiers.smoothquant import SmoothQuantModifier
+
+STATIC_SCHEME = {
+    "targets": ["Linear"],
+    "weights": {"num_bits": 8, "symmetric": True, "strategy": "channel"},
+    "input_activations": {
+        "num_bits": 8,
+        "symmetric": True,
+        "strategy": "tensor",
+        "dynamic": False,
+    },
+}
+
+
+def _tiny_llama() -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        vocab_size=100,
+    )
+    return LlamaForCausalLM(config)
+
+
+def _calibration_data():
+    generator = torch.Generator().manual_seed(1)
+    return [
+        {
+            "input_ids": torch.randint(0, 100, (1, 16), generator=generator),
+            "attention_mask": torch.ones(1, 16, dtype=torch.long),
+        }
+        for _ in range(8)
+    ]
+
+
+def _build_gptq(static: bool, **kwargs) -> GPTQModifier:
+    if static:
+        return GPTQModifier(
+            config_groups={"group_0": STATIC_SCHEME}, ignore=["lm_head"], **kwargs
+        )
+    return GPTQModifier(targets="Linear", scheme="W8A8", ignore=["lm_head"], **kwargs)
+
+
+def _compress(recipe: Union[str, List[Modifier]]):
+    """
+    :param recipe: recipe of a SmoothQuantModifier followed by a GPTQModifier
+    :return: the compressed model, and whether GPTQ ran the smoothing calibration
+    """
+    if QuantizedKVParameterCache._instance is not None:
+        # start from fresh kv cache observers
+        QuantizedKVParameterCache._instance.reset()
+
+    model = _tiny_llama()
+    with create_session():
+        session = active_session()
+        session.initialize(
+            model=model,
+            recipe=recipe,
+            calib_data=_calibration_data(),
+            start=-1,
+        )
+        fused = session.lifecycle.modifiers[0].modifiers[1].smoothing_modifier_
+        session.finalize()
+
+    return model, fused is not None
+
+
+def _logits(model: LlamaForCausalLM) -> torch.Tensor:
+    inputs = torch.randint(0, 100, (2, 16), generator=torch.Generator().manual_seed(2))
+    with torch.no_grad():
+        return model(inputs).logits
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("static", [False, True])
+def test_fused_calibration_matches_separate_passes(static):
+    fused_model, fused = _compress(
+        [
+            SmoothQuantModifier(smoothing_strength=0.8),
+            _build_gptq(static, fused_calibration=True),
+        ]
+    )
+    separate_model, separate = _compress(
+        [SmoothQuantModifier(smoothing_strength=0.8), _build_gptq(static)]
+    )
+    assert fused and not separate
+
+    # the attention weights of the first layer are compressed from the same inputs
+    first_layer = zip(
+        fused_model.model.layers[0].self_attn.named_parameters(),
+        separate_model.model.layers[0].self_attn.parameters(),
+    )
+    for (name, fused_param), separate_param in first_layer:
+        if name.endswith("weight"):
+            assert torch.equal(fused_param, separate_param), name
+
+    # later layers are smoothed by the ranges of quantized rather than original
+    # inputs, and static activations are calibrated on compressed layers
+    fused_params = dict(fused_model.named_parameters())
+    for name, separate_param in separate_model.named_parameters():
+        if separate_param.is_floating_point():
+            difference = (fused_params[name] - separate_param).norm()
+            assert difference <= 0.02 * separate_param.norm(), name
+
+    fused_logits = _logits(fused_model)
+    separate_logits = _logits(separate_model)
+    assert (fused_logits - separate_logits).norm() <= 0.02 * separate_logits.norm()
+
+
+SPANNING_RECIPE = """
+test_stage:
+    test_modifiers:
+        SmoothQuantModifier:
+            mappings:
+                # the final norm and lm_head are outside of the decoder layers
+                - [["lm_head"], "model.norm"]
+        GPTQModifier:
+            targets: Linear
+            scheme: W8A8
+            ignore: ["lm_head"]
+            fused_calibration: {fused}
+"""
+
+KV_CACHE_RECIPE = """
+test_stage:
+    test_modifiers:
+        SmoothQuantModifier:
+            smoothing_strength: 0.8
+        GPTQModifier:
+            fused_calibration: {fused}
+            quantize:
+                QuantizationModifier:
+                    ignore: ["lm_head"]
+                    config_groups:
+                        group_0:
+                            targets: ["Linear"]
+                            weights:
+                                num_bits: 8
+                                strategy: channel
+                    kv_cache_scheme:
+                        num_bits: 8
+                        strategy: tensor
+"""
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("recipe", [SPANNING_RECIPE, KV_CACHE_RECIPE])
+def test_fused_calibration_fallback(recipe):
+    fallback_model, fused = _compress(recipe.format(fused=True))
+    separate_model, _ = _compress(recipe.format(fused=False))
+
+    assert not fused
+    separate_state = separate_model.state_dict()
+    for name, value in fallback_model.state_dict().items():
+        assert torch.equal(value, separate_state[name]), name
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    "modifiers,fused",
+    [
+        ([SmoothQuantModifier(), GPTQModifier(fused_calibration=True)], True),
+        ([SmoothQuantModifier(), GPTQModifier()], False),
+        ([GPTQModifier(fused_calibration=True), SmoothQuantModifier()], False),
+        (
+            [
+                SmoothQuantModifier(),
+                QuantizationModifier(),
+                GPTQModifier(fused_calibration=True),
+            ],
+            False,
+        ),
+        (
+            [
+                SmoothQuantModifier(num_calibration_steps=4),
+                GPTQModifier(fused_calibration=True),
+            ],
+            False,
+        ),
+        (
+            [
+                SmoothQuantModifier(),
+                GPTQModifier(fused_calibration=True, data_parallel=True),
+            ],
+            False,
+        ),
+        (
+            [
+                SmoothQuantModifier(),
+                GPTQModifier(fused_calibration=True, checkpoint_dir="checkpoint"),
+            ],
+            False,
+        ),
+        (
+            [
+                SmoothQuantModifier(initialized_=True),
+                GPTQModifier(fused_calibration=True),
+            ],
+            False,
+        ),
+    ],
+)
+def test_stage_fuse_calibration(modifiers, fused):
+    stage = StageModifiers(modifiers=modifiers)
+    stage._fuse_calibration()
+
+    smoothing = next(mod for mod in modifiers if isinstance(mod, SmoothQuantModifier))
+    gptq = next(mod for mod in modifiers if isinstance(mod, GPTQModifier))
+    assert smoothing.fused_calibration_ == fused
+    assert (gptq.smoothing_modifier_ is smoothing) == fused
@@ -1,12 +1,21 @@
 from collections import OrderedDict
 
+import pytest
 import torch
+from compressed_tensors.quantization import QuantizationArgs
 from compressed_tensors.quantization.lifecycle.apply import apply_quantization_config
+from compressed_tensors.quantization.lifecycle.forward import fake_quantize
 from compressed_tensors.quantization.quant_config import QuantizationConfig
 from compressed_tensors.quantization.quant_scheme import preset_name_to_scheme
+from compressed_tensors.quantization.utils import calculate_range
 from loguru import logger
 
-from llmcompressor.modifiers.quantization.gptq.utils.gptq_wrapper import GPTQWrapper
+from llmcompressor.modifiers.quantization.gptq.utils.gptq_wrapper import (
+    GPTQWrapper,
+    _fake_quantize_column,
+)
+from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
+from llmcompressor.observers import Observer
 
 
 def test_ignore():
@@ -39,3 +48,231 @@ def test_ignore():
 
     assert sum("Skipping unquantized layer first_layer" in m for m in messages) == 1
     assert sum("Skipping unquantized layer second_layer" in m for m in messages) == 0
+
+
+class SharedInputLayer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.q_proj = torch.nn.Linear(8, 8)
+        self.k_proj = torch.nn.Linear(8, 8)
+        self.o_proj = torch.nn.Linear(8, 8)
+
+    def forward(self, x):
+        return self.o_proj(self.q_proj(x) + self.k_proj(x))
+
+
+def test_shared_hessian():
+    model = torch.nn.Sequential(OrderedDict([("layer", SharedInputLayer())]))
+    config = QuantizationConfig(
+        config_groups={"group_0": preset_name_to_scheme("W4A16", targets=["Linear"])},
+    )
+    apply_quantization_config(model, config)
+    weights = {n: m.weight.clone() for n, m in model.layer.named_children()}
+
+    args = {"blocksize": 128, "percdamp": 0.01}
+    compressor = LayerCompressor(GPTQWrapper, model, model.layer, 0, "layer", args)
+    compressor.pre_compress()
+
+    inputs = [torch.randn(1, 4, 8) for _ in range(3)]
+    with torch.no_grad():
+        for inp in inputs:
+            model.layer(inp)
+
+    assert compressor.shared_inputs == {"k_proj": "q_proj"}
+    assert compressor.modules["k_proj"].H is compressor.modules["q_proj"].H
+    assert compressor.modules["o_proj"].H is not compressor.modules["q_proj"].H
+
+    # compressing from a shared hessian gives the same result as a separate one
+    separate = torch.nn.Linear(8, 8)
+    separate.weight.data = weights["k_proj"]
+    apply_quantization_config(torch.nn.Sequential(separate), config)
+    with torch.no_grad():
+        separate_compressor = GPTQWrapper("separate", separate)
+        for inp in inputs:
+            separate_compressor.add_batch(inp, None)
+        separate_compressor.compress(**args)
+
+    compressor.compress()
+    compressor.post_compress()
+    compressor.revert_layer_wrappers()
+
+    assert torch.equal(model.layer.k_proj.weight, separate.weight)
+    assert torch.equal(model.layer.k_proj.weight_scale, separate.weight_scale)
+
+
+class DivergingInputLayer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.q_proj = torch.nn.Linear(8, 8)
+        self.k_proj = torch.nn.Linear(8, 8)
+        self.k_inputs = []
+        self.mode = "shared"
+
+    def forward(self, x):
+        # after the first batch, k_proj either receives a different input than
+        # q_proj, or q_proj is not called at all
+        k_input = x if self.mode == "shared" else x * 2
+        self.k_inputs.append(k_input)
+        if self.mode == "skip_leader":
+            return self.k_proj(k_input)
+        return self.q_proj(x) + self.k_proj(k_input)
+
+
+@pytest.mark.parametrize("mode", ["diverge", "skip_leader"])
+def test_unshared_hessian(mode):
+    model = torch.nn.Sequential(OrderedDict([("layer", DivergingInputLayer())]))
+    args = {"blocksize": 128, "percdamp": 0.01}
+    compressor = LayerCompressor(GPTQWrapper, model, model.layer, 0, "layer", args)
+    compressor.pre_compress()
+
+    with torch.no_grad():
+        model.layer(torch.randn(1, 4, 8))
+        assert compressor.shared_inputs == {"k_proj": "q_proj"}
+
+        model.layer.mode = mode
+        for _ in range(2):
+            model.layer(torch.randn(1, 4, 8))
+
+    # the Hessian of k_proj only holds its own inputs once unshared
+    assert compressor.shared_inputs == {}
+    separate = GPTQWrapper("separate", torch.nn.Linear(8, 8))
+    for inp in model.layer.k_inputs:
+        separate.add_batch(inp, None)
+
+    k_proj = compressor.modules["k_proj"]
+    assert k_proj.H is not compressor.modules["q_proj"].H
+    assert torch.equal(k_proj.nsamples, separate.nsamples)
+    assert torch.allclose(k_proj.H, separate.H)
+    compressor.post_compress()
+    compressor.revert_layer_wrappers()
+
+
+def test_scale_inputs():
+    model = torch.nn.Sequential(OrderedDict([("layer", SharedInputLayer())]))
+    input_layers = [model.layer.q_proj, model.layer.k_proj]
+    args = {"blocksize": 128, "percdamp": 0.01}
+    compressor = LayerCompressor(GPTQWrapper, model, model.layer, 0, "layer", args)
+    compressor.pre_compress()
+
+    inputs = [torch.randn(1, 4, 8) for _ in range(3)]
+    scales = torch.rand(8) + 0.5
+    with torch.no_grad():
+        for inp in inputs:
+            model.layer(inp)
+
+    # the hessian of the scaled inputs, computed after calibration
+    expected = GPTQWrapper("expected", torch.nn.Linear(8, 8))
+    for inp in inputs:
+        expected.add_batch(inp / scales, None)
+
+    compressor.scale_inputs({layer: scales for layer in input_layers})
+
+    assert compressor.modules["k_proj"].H is compressor.modules["q_proj"].H
+    assert torch.allclose(compressor.modules["q_proj"].H, expected.H, atol=1e-5)
+    compressor.revert_layer_wrappers()
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        QuantizationArgs(num_bits=4, symmetric=True, strategy="channel"),
+        QuantizationArgs(num_bits=4, symmetric=False, strategy="channel"),
+        QuantizationArgs(num_bits=8, type="float", strategy="channel"),
+    ],
+)
+def test_fake_quantize_column(args):
+    weight = torch.randn(16, 8)
+    observer = Observer.load_from_registry("minmax", quantization_args=args)
+    scale, zero_point = observer(weight)
+    q_min, q_max = calculate_range(args, weight.device)
+
+    for column_idx in range(weight.shape[1]):
+        column = weight[:, column_idx]
+        expected = fake_quantize(column, scale[:, 0], zero_point[:, 0], args)
+        quantized = _fake_quantize_column(
+            column, scale[:, 0], zero_point[:, 0], q_min, q_max, args
+        )
+        assert torch.equal(quantized, expected)
+
+
+def test_add_batch_padding():
+    lengths = [3, 5]
+    inputs = [torch.randn(1, length, 8) for length in lengths]
+
+    unbatched = GPTQWrapper("module", torch.nn.Linear(8, 8))
+    for inp in inputs:
+        unbatched.add_batch(inp, None)
+
+    padded = torch.zeros(2, max(lengths), 8)
+    attention_mask = torch.zeros(2, max(lengths), dtype=torch.long)
+    for index, (inp, length) in enumerate(zip(inputs, lengths)):
+        padded[index, :length] = inp[0]
+        attention_mask[index, :length] = 1
+
+    batched = GPTQWrapper("module", torch.nn.Linear(8, 8))
+    batched.add_batch(padded, None, attention_mask=attention_mask)
+
+    assert batched.nsamples == unbatched.nsamples
+    assert torch.allclose(batched.H, unbatched.H)
+
+
+def test_add_batch_expert_inputs():
+    # the tokens routed to an expert are not aligned with the attention mask, even
+    # if their number matches the sequence length
+    inp = torch.randn(5, 8)
+    attention_mask = torch.tensor([[1, 1, 1, 0, 0]])
+
+    expected = GPTQWrapper("module", torch.nn.Linear(8, 8))
+    expected.add_batch(inp, None)
+
+    wrapper = GPTQWrapper("module", torch.nn.Linear(8, 8))
+    wrapper.add_batch(inp, None, attention_mask=attention_mask)
+
+    assert torch.equal(wrapper.H, expected.H)
+
+
+def test_add_batch_subsampled():
+    inputs = [torch.randn(1, 16, 8) for _ in range(3)]
+
+    def subsampled_hessian(**kwargs):
+        layer = torch.nn.Linear(8, 8)
+        wrapper = GPTQWrapper("module", layer, max_hessian_tokens=4, **kwargs)
+        for inp in inputs:
+            wrapper.add_batch(inp, None)
+        return wrapper.H
+
+    # the sampled tokens are reproducible, and only depend on the seed
+    torch.manual_seed(0)
+    expected = subsampled_hessian()
+    torch.manual_seed(1)
+    assert torch.equal(subsampled_hessian(), expected)
+    assert not torch.equal(subsampled_hessian(hessian_sampling_seed=1), expected)
+
+
+@pytest.mark.parametrize("scheme", ["W4A16", "W8A16", "FP8"])
+def test_compress_batch(scheme):
+    experts = torch.nn.ModuleList([torch.nn.Linear(32, 16) for _ in range(4)])
+    config = QuantizationConfig(
+        config_groups={"group_0": preset_name_to_scheme(scheme, targets=["Linear"])},
+    )
+    apply_quantization_config(experts, config)
+    weights = [expert.weight.clone() for expert in experts]
+    inputs = [torch.randn(1, 4, 32) for _ in experts]
+
+    with torch.no_grad():
+        wrappers = [GPTQWrapper(f"{i}", expert) for i, expert in enumerate(experts)]
+        for wrapper, inp in zip(wrappers, inputs):
+            wrapper.add_batch(inp, None)
+        GPTQWrapper.compress_batch(wrappers, blocksize=8)
+
+    for weight, inp, expert in zip(weights, inputs, experts):
+        separate = torch.nn.Linear(32, 16)
+        separate.weight.data = weight
+        apply_quantization_config(torch.nn.Sequential(separate), config)
+        with torch.no_grad():
+            separate_wrapper = GPTQWrapper("separate", separate)
+            separate_wrapper.add_batch(inp, None)
+            separate_wrapper.compress(blocksize=8)
+
+        assert torch.equal(expert.weight, separate.weight)
+        assert torch.equal(expert.weight_scale, separate.weight_scale)
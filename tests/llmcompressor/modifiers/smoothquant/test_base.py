@@ -1,9 +1,16 @@
 import unittest
 
 import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
 
+from llmcompressor.core import active_session, create_session
 from llmcompressor.modifiers.factory import ModifierFactory
-from llmcompressor.modifiers.smoothquant.base import SmoothQuantModifier
+from llmcompressor.modifiers.smoothquant import base
+from llmcompressor.modifiers.smoothquant.base import (
+    SmoothQuantMapping,
+    SmoothQuantModifier,
+)
 from tests.llmcompressor.modifiers.conf import setup_modifier_factory
 
 
@@ -52,3 +59,166 @@ class TestSmoothQuantDefaults(unittest.TestCase):
 
         assert non_default_sq.smoothing_strength == strength
         assert non_default_sq.mappings == dummy_map
+
+
+@pytest.mark.unit
+def test_scale_hooks_update_in_place():
+    layer = torch.nn.LayerNorm(8)
+    modifier = SmoothQuantModifier()
+    modifier.resolved_mappings_ = [SmoothQuantMapping("norm", layer, [])]
+    modifier.scales_ = {}
+    modifier._setup_scale_hooks()
+
+    inputs = [torch.randn(2, 4, 8) * (index + 1) for index in range(3)]
+    layer(inputs[0])
+    min_vals = modifier.scales_["norm"].min_channel_vals
+    max_vals = modifier.scales_["norm"].max_channel_vals
+    for inp in inputs[1:]:
+        layer(inp)
+
+    outputs = torch.cat([layer(inp).reshape(-1, 8) for inp in inputs])
+    assert modifier.scales_["norm"].min_channel_vals is min_vals
+    assert modifier.scales_["norm"].max_channel_vals is max_vals
+    assert torch.equal(min_vals, outputs.min(dim=0).values)
+    assert torch.equal(max_vals, outputs.max(dim=0).values)
+    modifier.remove_hooks()
+
+
+@pytest.mark.unit
+def test_cache_search_inputs_samples_every_batch():
+    layer = torch.nn.Identity()
+    modifier = SmoothQuantModifier(smoothing_strength_grid=[0.5], max_search_tokens=32)
+    modifier.resolved_mappings_ = [SmoothQuantMapping("norm", layer, [])]
+    modifier.scales_ = {}
+    modifier.search_inputs_ = {}
+    modifier._setup_scale_hooks()
+
+    # the first batch alone holds more tokens than the search budget
+    for index in range(4):
+        layer(torch.full((1, 64, 8), float(index)))
+    modifier.remove_hooks()
+
+    _, cached = modifier.search_inputs_["norm"]
+    assert cached.shape == (32, 8)
+    assert set(cached[:, 0].tolist()) == {0.0, 1.0, 2.0, 3.0}
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("chunk_numel", [2**28, 1])
+def test_search_smoothing_strength(monkeypatch, chunk_numel):
+    monkeypatch.setattr(base, "SEARCH_CHUNK_NUMEL", chunk_numel)
+    torch.manual_seed(0)
+    layers = {name: torch.nn.Identity() for name in ("persistent", "sparse")}
+    balance_layer = torch.nn.Linear(64, 64)
+    modifier = SmoothQuantModifier(
+        smoothing_strength_grid=[0.1, 0.3, 0.5, 0.7, 0.9], max_search_tokens=128
+    )
+    modifier.resolved_mappings_ = [
+        SmoothQuantMapping(name, layer, [balance_layer])
+        for name, layer in layers.items()
+    ]
+    modifier.scales_ = {}
+    modifier.search_inputs_ = {}
+    modifier._setup_scale_hooks()
+
+    # an outlier channel on every token, and one only on a few tokens
+    for _ in range(4):
+        inputs = torch.randn(1, 64, 64)
+        persistent = inputs.clone()
+        persistent[..., 3] *= 100
+        sparse = inputs.clone()
+        sparse[:, ::64, 3] *= 100
+        layers["persistent"](persistent)
+        layers["sparse"](sparse)
+    modifier.remove_hooks()
+
+    strengths = {}
+    for mapping in modifier.resolved_mappings_:
+        scale = modifier.scales_[mapping.smooth_name]
+        activation_scales = scale.max_channel_vals - scale.min_channel_vals
+        strengths[mapping.smooth_name] = modifier._search_smoothing_strength(
+            mapping, activation_scales
+        )
+
+    # a persistent outlier is balanced evenly with the weights, while smoothing a
+    # rare outlier as strongly would needlessly spread it to the weights
+    assert strengths["persistent"] == 0.5
+    assert strengths["sparse"] < strengths["persistent"]
+    assert modifier.search_inputs_ == {}
+
+
+SEQUENTIAL_RECIPE = """
+test_stage:
+    test_modifiers:
+        SmoothQuantModifier:
+            smoothing_strength: 0.8
+            {mappings}
+            {sequential_targets}
+"""
+
+# the final norm and lm_head are outside of the decoder layers
+SPANNING_MAPPINGS = """mappings:
+                - [["re:.*gate_proj", "re:.*up_proj"], "re:.*post_attention_layernorm"]
+                - [["lm_head"], "model.norm"]"""
+
+
+def _smooth_tiny_llama(recipe: str) -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        vocab_size=100,
+    )
+    model = LlamaForCausalLM(config)
+
+    generator = torch.Generator().manual_seed(1)
+    calib_data = [
+        {
+            "input_ids": torch.randint(0, 100, (1, 16), generator=generator),
+            "attention_mask": torch.ones(1, 16, dtype=torch.long),
+        }
+        for _ in range(4)
+    ]
+    with create_session():
+        session = active_session()
+        session.initialize(model=model, recipe=recipe, calib_data=calib_data, start=-1)
+        session.finalize()
+
+    return model
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize(
+    "mappings,sequential", [("", True), (SPANNING_MAPPINGS, False)]
+)
+def test_sequential_targets(monkeypatch, mappings, sequential):
+    calibrated_sequentially = []
+    calibrate_sequential = SmoothQuantModifier._calibrate_sequential
+
+    def recorded_calibrate_sequential(self, *args, **kwargs):
+        calibrated_sequentially.append(True)
+        calibrate_sequential(self, *args, **kwargs)
+
+    monkeypatch.setattr(
+        SmoothQuantModifier, "_calibrate_sequential", recorded_calibrate_sequential
+    )
+    model = _smooth_tiny_llama(
+        SEQUENTIAL_RECIPE.format(
+            mappings=mappings,
+            sequential_targets="sequential_targets: LlamaDecoderLayer",
+        )
+    )
+    expected = _smooth_tiny_llama(
+        SEQUENTIAL_RECIPE.format(mappings=mappings, sequential_targets="")
+    )
+
+    # smoothing does not change the outputs of a layer, so calibrating one layer at
+    # a time sees the same activations as a pass through the whole model. Mappings
+    # which span layers fall back to a pass through the whole model
+    assert bool(calibrated_sequentially) == sequential
+    expected_params = dict(expected.named_parameters())
+    for name, param in model.named_parameters():
+        assert torch.allclose(param, expected_params[name], atol=1e-5), name
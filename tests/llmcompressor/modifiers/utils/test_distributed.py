@@ -0,0 +1,114 @@
+import socket
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable, List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from compressed_tensors.quantization.lifecycle.apply import apply_quantization_config
+from compressed_tensors.quantization.quant_config import QuantizationConfig
+from compressed_tensors.quantization.quant_scheme import preset_name_to_scheme
+
+from llmcompressor.modifiers.quantization.gptq.utils.gptq_wrapper import GPTQWrapper
+from llmcompressor.modifiers.utils.distributed import (
+    all_reduce_sum,
+    broadcast_module_parameters,
+    shard_dataloader,
+)
+from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
+
+# inputs containing this value are copied before being passed to k_proj
+UNSHARE_MARKER = 4.0
+
+
+def _run_rank(rank: int, world_size: int, port: int, fn: Callable[[int], None]):
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+        timeout=timedelta(seconds=60),
+    )
+    fn(rank)
+    # the process group is left to process exit, gloo can hang tearing it down
+    # once the other rank has already exited
+    dist.barrier()
+
+
+def _spawn(fn: Callable[[int], None], world_size: int = 2):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    mp.spawn(_run_rank, args=(world_size, port, fn), nprocs=world_size)
+
+
+def _check_helpers(rank: int):
+    assert shard_dataloader(range(5)) == [rank, rank + 2, rank + 4][: 3 - rank]
+
+    tensor = torch.full((2,), float(rank + 1))
+    all_reduce_sum(tensor)
+    assert torch.equal(tensor, torch.full((2,), 3.0))
+
+    linear = torch.nn.Linear(4, 4)
+    torch.nn.init.constant_(linear.weight, rank)
+    broadcast_module_parameters(linear, src=0)
+    assert torch.equal(linear.weight, torch.zeros(4, 4))
+
+
+def test_distributed_helpers():
+    _spawn(_check_helpers)
+
+
+class SharedInputLayer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.q_proj = torch.nn.Linear(8, 8)
+        self.k_proj = torch.nn.Linear(8, 8)
+
+    def forward(self, x):
+        k_input = x.clone() if (x == UNSHARE_MARKER).any() else x
+        return self.q_proj(x) + self.k_proj(k_input)
+
+
+def _compress_layer(
+    batches: List[torch.Tensor], data_parallel: bool
+) -> torch.nn.Module:
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(OrderedDict([("layer", SharedInputLayer())]))
+    config = QuantizationConfig(
+        config_groups={"group_0": preset_name_to_scheme("W4A16", targets=["Linear"])},
+    )
+    apply_quantization_config(model, config)
+
+    args = {"blocksize": 128, "percdamp": 0.01}
+    compressor = LayerCompressor(GPTQWrapper, model, model.layer, 0, "layer", args)
+    compressor.pre_compress()
+    with torch.no_grad():
+        for batch in batches:
+            model.layer(batch)
+    compressor.compress(data_parallel=data_parallel)
+    compressor.post_compress()
+    compressor.revert_layer_wrappers()
+
+    return model
+
+
+def _check_data_parallel_gptq(rank: int):
+    # integer inputs are summed exactly, in any order
+    generator = torch.Generator().manual_seed(1)
+    batches = [
+        torch.randint(-3, 4, (1, 4, 8), generator=generator).float() for _ in range(4)
+    ]
+    # only the second rank stops sharing the statistics of q_proj and k_proj
+    batches[3][0, 0, 0] = UNSHARE_MARKER
+
+    expected = dict(_compress_layer(batches, data_parallel=False).named_parameters())
+    model = _compress_layer(shard_dataloader(batches), data_parallel=True)
+    for name, param in model.named_parameters():
+        assert torch.equal(param, expected[name]), name
+
+
+def test_data_parallel_gptq():
+    _spawn(_check_data_parallel_gptq)
@@ -0,0 +1,79 @@
+import torch
+
+from llmcompressor.modifiers.utils.hessian import (
+    accumulate_hessian,
+    batch_invert_hessian,
+    invert_hessian,
+    normalize_hessian,
+)
+
+
+def test_accumulate_hessian():
+    inputs = [torch.randn(10, 4, dtype=torch.bfloat16) for _ in range(3)]
+
+    H = torch.zeros(4, 4)
+    for inp in inputs:
+        accumulate_hessian(H, inp, chunk_size=3)
+    normalize_hessian(H, torch.tensor([len(inputs)]))
+
+    expected = sum(inp.float().t() @ inp.float() for inp in inputs) * 2 / len(inputs)
+    assert torch.allclose(H, expected, atol=1e-5)
+
+
+def test_accumulate_hessian_subsampled():
+    # with identical tokens, the subsampled estimate is exact
+    inp = torch.randn(1, 4).repeat(10, 1)
+
+    H = torch.zeros(4, 4)
+    accumulate_hessian(H, inp, max_tokens=3)
+
+    assert torch.allclose(H, inp.t() @ inp, atol=1e-5)
+
+
+def test_accumulate_hessian_subsampled_seed():
+    inp = torch.randn(10, 4)
+
+    def subsampled_hessian(seed):
+        H = torch.zeros(4, 4)
+        generator = torch.Generator().manual_seed(seed)
+        accumulate_hessian(H, inp, max_tokens=3, generator=generator)
+        return H
+
+    assert torch.equal(subsampled_hessian(0), subsampled_hessian(0))
+    assert not torch.equal(subsampled_hessian(0), subsampled_hessian(1))
+
+
+def test_invert_hessian_escalation():
+    # indefinite with eigenvalues 2.05 and -0.05
+    H = torch.tensor([[1.0, 1.05], [1.05, 1.0]])
+
+    Hinv, damp_frac = invert_hessian(H.clone(), 0.01, max_percdamp=1.0)
+
+    assert damp_frac == 0.08
+    expected = torch.linalg.inv(H + damp_frac * torch.eye(2))
+    assert torch.allclose(Hinv.t() @ Hinv, expected, atol=1e-4)
+
+
+def test_invert_hessian_eigenvalue_fallback():
+    # indefinite with eigenvalues 3 and -1
+    H = torch.tensor([[1.0, 2.0], [2.0, 1.0]])
+
+    Hinv, damp_frac = invert_hessian(H.clone(), 0.01, max_percdamp=0.1)
+
+    assert damp_frac == 0.1
+    expected = torch.linalg.inv(torch.tensor([[1.55, 1.45], [1.45, 1.55]]))
+    assert torch.allclose(Hinv.t() @ Hinv, expected, atol=1e-4)
+
+
+def test_batch_invert_hessian():
+    inputs = torch.randn(3, 16, 4)
+    H = inputs.transpose(1, 2) @ inputs
+    H[1] = torch.tensor([[1.0, 1.05], [1.05, 1.0]]).repeat(2, 2)
+
+    Hinv, damp_fracs = batch_invert_hessian(H.clone(), 0.01, max_percdamp=1.0)
+
+    for index in range(3):
+        expected, damp_frac = invert_hessian(H[index].clone(), 0.01, 1.0)
+        assert damp_fracs[index] == damp_frac
+        assert torch.allclose(Hinv[index], expected, atol=1e-4)
+    assert damp_fracs[0] == 0.01
@@ -0,0 +1,68 @@
+import gc
+
+import pytest
+import torch
+
+from llmcompressor.modifiers.utils.intermediates_cache import IntermediatesCache
+
+
+@pytest.mark.parametrize("offload_dtype", [None, "bfloat16"])
+@pytest.mark.parametrize("max_memory", [None, 0])
+def test_intermediates_cache(offload_dtype, max_memory, tmp_path):
+    cache = IntermediatesCache(offload_dtype, max_memory, offload_dir=str(tmp_path))
+    samples = [
+        ((torch.randn(1, 8, 16), None), {"attention_mask": torch.ones(1, 8)})
+        for _ in range(3)
+    ]
+    for args, kwargs in samples:
+        cache.append(args, kwargs)
+
+    assert len(cache) == len(samples)
+    for (args, kwargs), (expected_args, expected_kwargs) in zip(cache, samples):
+        assert args[0].dtype == expected_args[0].dtype
+        assert args[1] is None
+        atol = 0.0 if offload_dtype is None else 5e-2
+        assert torch.allclose(args[0], expected_args[0], atol=atol, rtol=atol)
+        assert torch.equal(kwargs["attention_mask"], expected_kwargs["attention_mask"])
+
+    # identical keyword tensors are stored once
+    assert cache[0][1]["attention_mask"] is cache[2][1]["attention_mask"]
+
+    # memory-mapped files are removed once mapped
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_intermediates_cache_deduplicate():
+    cache = IntermediatesCache()
+    masks = [torch.ones(1, 8), torch.ones(1, 8), torch.zeros(1, 8)]
+    for mask in masks:
+        cache.append((torch.randn(1, 8),), {"attention_mask": mask})
+
+    outputs = IntermediatesCache.like(cache)
+    outputs.append((torch.randn(1, 8),), {"attention_mask": torch.zeros(1, 8)})
+
+    # tensors with the same content are stored once, also across shared caches
+    stored = [kwargs["attention_mask"] for _, kwargs in [*cache, *outputs]]
+    assert stored[0] is masks[0] and stored[1] is masks[0]
+    assert stored[2] is masks[2] and stored[3] is masks[2]
+    kwargs_tensors = cache._kwargs_tensors
+    assert len(kwargs_tensors) == 2
+
+    # stored tensors are released with the caches referring to them
+    del cache, outputs, masks, mask, stored
+    gc.collect()
+    assert len(kwargs_tensors) == 0
+
+
+def test_intermediates_cache_budget():
+    cache = IntermediatesCache(max_memory=1536)
+    cache.append((torch.zeros(128),), {})
+    cache.append((torch.zeros(128),), {})
+
+    outputs = IntermediatesCache.like(cache)
+    outputs.append((torch.zeros(128),), {})
+    assert cache._budget is outputs._budget
+    assert cache._budget.used == 1536
+
+    del cache
+    assert outputs._budget.used == 512
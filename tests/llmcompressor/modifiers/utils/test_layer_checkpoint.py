@@ -0,0 +1,38 @@
+import torch
+
+from llmcompressor.modifiers.quantization.gptq.utils import GPTQWrapper
+from llmcompressor.modifiers.utils.layer_checkpoint import LayerCheckpoint
+from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
+
+
+def _make_layer_compressors(model):
+    return [
+        LayerCompressor(GPTQWrapper, model, layer, idx, f"{idx}", {})
+        for idx, layer in enumerate(model)
+    ]
+
+
+def test_layer_checkpoint(tmp_path):
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+    layer_compressors = _make_layer_compressors(model)
+    intermediates = [((torch.randn(2, 4),), {"attention_mask": None})]
+
+    checkpoint = LayerCheckpoint(str(tmp_path), "fingerprint")
+    assert checkpoint.load(layer_compressors) == (0, None)
+    checkpoint.save_layer(layer_compressors[0], intermediates)
+
+    # only completed layers are restored
+    resumed_model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+    resumed_layer_compressors = _make_layer_compressors(resumed_model)
+    checkpoint = LayerCheckpoint(str(tmp_path), "fingerprint")
+    num_completed, loaded = checkpoint.load(resumed_layer_compressors)
+
+    assert num_completed == 1
+    assert torch.equal(loaded[0][0][0], intermediates[0][0][0])
+    assert torch.equal(resumed_model[0].weight, model[0].weight)
+    assert torch.equal(resumed_model[0].bias, model[0].bias)
+    assert not torch.equal(resumed_model[1].weight, model[1].weight)
+
+    # checkpoints of a different run are ignored
+    checkpoint = LayerCheckpoint(str(tmp_path), "other_fingerprint")
+    assert checkpoint.load(resumed_layer_compressors) == (0, None)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    calibration_attention_mask,
+    get_calibration_attention_mask,
+    remove_padding,
+)
+
+
+@pytest.mark.unit
+def test_calibration_attention_mask():
+    attention_mask = torch.tensor([[1, 1, 0], [1, 1, 1]])
+    with calibration_attention_mask(attention_mask):
+        assert get_calibration_attention_mask() is attention_mask
+
+        # batches without padding are not masked
+        with calibration_attention_mask(torch.ones(2, 3, dtype=torch.long)):
+            assert get_calibration_attention_mask() is None
+
+        assert get_calibration_attention_mask() is attention_mask
+    assert get_calibration_attention_mask() is None
+
+
+@pytest.mark.unit
+def test_remove_padding():
+    attention_mask = torch.tensor([[1, 1, 0], [1, 0, 0]])
+    value = torch.arange(2 * 3 * 4).reshape(2, 3, 4)
+    expected = torch.stack([value[0, 0], value[0, 1], value[1, 0]]).unsqueeze(0)
+    assert torch.equal(remove_padding(value, attention_mask), expected)
+
+    # values without the layout of the mask are unchanged
+    for shape in [(2, 3), (2, 3, 4, 5), (2, 4, 4)]:
+        value = torch.zeros(shape)
+        assert remove_padding(value, attention_mask) is value
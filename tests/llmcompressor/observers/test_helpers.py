@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from functools import partial
+
+import pytest
 import torch
 from compressed_tensors.quantization import (
     QuantizationConfig,
@@ -24,7 +27,7 @@ from llmcompressor.modifiers.quantization.calibration import (
     calibrate_input_hook,
     initialize_observer,
 )
-from llmcompressor.observers.helpers import get_observer_token_count
+from llmcompressor.observers.helpers import TokenSampler, get_observer_token_count
 
 
 def _prep_for_input_quant_calibration(module: torch.nn.Module):
@@ -107,3 +110,50 @@ def test_get_observer_token_count():
 
     # there are no more information in the counter
     assert len(counter) == 0
+
+
+@pytest.mark.parametrize(
+    "sample_rate,max_tokens,expected_samples",
+    [(0.25, None, 4), (None, 6, 6), (0.5, 6, 6)],
+)
+def test_token_sampler(sample_rate, max_tokens, expected_samples):
+    value = torch.randn(2, 8, 4)
+    sampler = TokenSampler(sample_rate=sample_rate, max_tokens=max_tokens, seed=42)
+    sampled = sampler(value)
+
+    assert sampled.shape == (1, expected_samples, 4)
+    assert sampler.num_tokens == 16
+    assert sampler.num_sampled_tokens == expected_samples
+
+    # sampled tokens are a subset of the tokens, deterministic given the seed
+    tokens = value.reshape(-1, 4)
+    assert all((tokens == token).all(dim=1).any() for token in sampled[0])
+    same_sampler = TokenSampler(sample_rate=sample_rate, max_tokens=max_tokens, seed=42)
+    assert torch.equal(same_sampler(value), sampled)
+
+    # values are unchanged if all tokens are sampled
+    assert TokenSampler(max_tokens=32)(value) is value
+
+
+def test_token_sampler_observed_tokens():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    config = QuantizationConfig(
+        config_groups={
+            "group_1": {
+                "input_activations": {"num_bits": 8, "strategy": "tensor"},
+                "targets": ["Linear"],
+            },
+        },
+    )
+    apply_quantization_config(model, config)
+    model.apply(lambda module: initialize_observer(module, base_name="input"))
+
+    sampler = TokenSampler(max_tokens=2)
+    model[0].register_forward_pre_hook(
+        partial(calibrate_input_hook, token_sampler=sampler)
+    )
+    model(torch.randn(8, 4))
+
+    # all tokens routed to the module are counted, only the sampled are observed
+    assert get_observer_token_count(model)["0"] == 8
+    assert sampler.num_sampled_tokens == 2
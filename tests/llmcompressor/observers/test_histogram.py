@@ -0,0 +1,105 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+import torch
+from compressed_tensors.quantization.quant_args import QuantizationArgs
+from compressed_tensors.quantization.utils import calculate_qparams
+
+from llmcompressor.observers import HistogramObserver, Observer
+
+
+def test_histogram_observer_percentile():
+    args = QuantizationArgs(num_bits=8, symmetric=False, observer="histogram")
+    observer = Observer.load_from_registry("histogram", quantization_args=args)
+    assert isinstance(observer, HistogramObserver)
+
+    # an outlier sets the range while calibrating, but is clipped once complete
+    tensor = torch.linspace(-1.0, 1.0, 100000)
+    tensor[0] = -100.0
+    scale, zero_point = observer(tensor)
+    assert torch.isclose(scale, torch.tensor(101.0 / 255)).item()
+
+    final_scale, final_zero_point = observer.get_final_qparams()
+    assert final_scale.shape == scale.shape
+    assert final_zero_point.shape == zero_point.shape
+    assert final_scale.item() < 2.2 / 255
+
+
+def test_histogram_observer_rebin():
+    args = QuantizationArgs(num_bits=8, symmetric=True, observer="histogram")
+    observer = HistogramObserver(quantization_args=args, bins=64, percentile=100.0)
+
+    batches = [torch.randn(2, 16) * (index + 1) for index in range(4)]
+    for batch in batches:
+        observer(batch)
+
+    # counts are preserved as the range grows
+    histogram = observer.histogram["default"]
+    assert histogram.sum().item() == sum(batch.numel() for batch in batches)
+
+    # the full range is kept when no values are clipped
+    observed = torch.cat([batch.flatten() for batch in batches])
+    assert torch.isclose(observer.min_val["default"], observed.min()).item()
+    assert torch.isclose(observer.max_val["default"], observed.max()).item()
+    final_scale, _ = observer.get_final_qparams()
+    expected_scale, _ = calculate_qparams(observed.min(), observed.max(), args)
+    assert torch.allclose(final_scale, expected_scale)
+
+
+@pytest.mark.parametrize("strategy", ["tensor", "channel"])
+def test_histogram_observer_shapes(strategy):
+    args = QuantizationArgs(num_bits=4, strategy=strategy, observer="histogram")
+    observer = Observer.load_from_registry("histogram", quantization_args=args)
+    minmax = Observer.load_from_registry("minmax", quantization_args=args)
+
+    weight = torch.randn(8, 32)
+    scale, zero_point = observer(weight)
+    expected_scale, expected_zero_point = minmax(weight)
+    assert torch.allclose(scale, expected_scale)
+    assert torch.equal(zero_point, expected_zero_point)
+
+    final_scale, final_zero_point = observer.get_final_qparams()
+    assert final_scale.shape == expected_scale.shape
+    assert final_zero_point.shape == expected_zero_point.shape
+
+
+@pytest.mark.parametrize("equal_groups", [True, False])
+def test_histogram_observer_groups(equal_groups):
+    args = QuantizationArgs(
+        num_bits=4, strategy="group", group_size=8, observer="histogram"
+    )
+    observer = HistogramObserver(quantization_args=args, percentile=100.0)
+    minmax = Observer.load_from_registry("minmax", quantization_args=args)
+
+    # groups of unequal size are observed separately
+    weight = torch.randn(4, 32)
+    g_idx = (
+        None if equal_groups else torch.tensor([0] * 4 + [1] * 12 + [2] * 8 + [3] * 8)
+    )
+    expected_scale, expected_zero_point = minmax(weight, g_idx=g_idx)
+    observer(weight, g_idx=g_idx)
+
+    # the full range of every group is kept when no values are clipped
+    final_scale, final_zero_point = observer.get_final_qparams()
+    assert final_scale.shape == expected_scale.shape == (4, 4)
+    assert torch.allclose(final_scale, expected_scale, atol=1e-6)
+    assert torch.equal(final_zero_point, expected_zero_point)
+
+
+def test_histogram_observer_invalid_percentile():
+    args = QuantizationArgs(num_bits=8, observer="histogram")
+    with pytest.raises(ValueError):
+        HistogramObserver(quantization_args=args, percentile=0.0)
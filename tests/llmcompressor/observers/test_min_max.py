@@ -17,7 +17,7 @@ import pytest
 import torch
 from compressed_tensors.quantization.quant_args import QuantizationArgs
 
-from llmcompressor.observers import Observer
+from llmcompressor.observers import GROUPS_TENSOR_ID, Observer
 
 
 def make_dummy_g_idx(columns: int, group_size: int) -> torch.Tensor:
@@ -116,3 +116,27 @@ def test_g_idx():
 
     assert scale_g_idx == pytest.approx(scale)
     assert zero_point_g_idx == pytest.approx(zero_point)
+
+
+@pytest.mark.parametrize("use_g_idx", [False, True])
+def test_group_qparams(use_g_idx):
+    group_size = 4
+    tensor = torch.randn(16, 32)
+    weights = QuantizationArgs(num_bits=4, strategy="group", group_size=group_size)
+    g_idx = make_dummy_g_idx(tensor.shape[1], group_size) if use_g_idx else None
+
+    observer = Observer.load_from_registry("minmax", quantization_args=weights)
+    scale, zero_point = observer(tensor, g_idx=g_idx)
+
+    grouped = tensor if g_idx is None else tensor[:, torch.argsort(g_idx)]
+    for group_index in range(tensor.shape[1] // group_size):
+        group = grouped[:, group_index * group_size : (group_index + 1) * group_size]
+        expected_scale, expected_zero_point = Observer.load_from_registry(
+            "minmax", quantization_args=weights
+        ).get_qparams_along_dim(group, dim=0)
+        assert torch.equal(scale[:, group_index], expected_scale[:, 0])
+        assert torch.equal(zero_point[:, group_index], expected_zero_point[:, 0])
+
+    # running statistics of all groups are stored as one tensor
+    assert list(observer.min_val.keys()) == [GROUPS_TENSOR_ID]
+    assert observer.min_val[GROUPS_TENSOR_ID].shape == (16, 8, 1)
@@ -12,12 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from types import SimpleNamespace
 
+import psutil
 import pytest
 import torch
 from compressed_tensors.quantization.quant_args import QuantizationArgs
 
 from llmcompressor.observers import MovingAverageMSEObserver, Observer
+from llmcompressor.observers.mse import (
+    MSE_CANDIDATE_COPIES,
+    MSE_SEARCH_MEMORY,
+    MSE_SEARCH_MEMORY_FRACTION,
+)
 
 
 @pytest.mark.parametrize(
@@ -55,3 +62,64 @@ def test_mse_observer_symmetric_scale_range():
     # if symmetric, max symmetric_range = abs(-128) / 255
     assert round(scale.item(), 4) <= 1.0039
     assert round(zero_point.item(), 4) == 0
+
+
+def test_mse_observer_group_qparams():
+    group_size = 4
+    tensor = torch.randn(16, 32)
+    weights = QuantizationArgs(num_bits=4, strategy="group", group_size=group_size)
+
+    observer = Observer.load_from_registry("mse", quantization_args=weights)
+    scale, zero_point = observer(tensor)
+
+    for group_index in range(tensor.shape[1] // group_size):
+        group = tensor[:, group_index * group_size : (group_index + 1) * group_size]
+        expected_scale, expected_zero_point = Observer.load_from_registry(
+            "mse", quantization_args=weights
+        ).get_qparams_along_dim(group, dim=0)
+        assert torch.equal(scale[:, group_index], expected_scale[:, 0])
+        assert torch.equal(zero_point[:, group_index], expected_zero_point[:, 0])
+
+
+@pytest.mark.parametrize("reduce_dims", [None, (1,)])
+def test_mse_observer_search_memory(reduce_dims):
+    tensor = torch.randn(16, 32)
+    weights = QuantizationArgs(num_bits=4, strategy="channel")
+
+    # candidates evaluated one at a time or all at once give the same result
+    sequential = MovingAverageMSEObserver(weights, search_memory=1)
+    batched = MovingAverageMSEObserver(weights, search_memory=None)
+    min_val, max_val = sequential.calculate_mse_min_max(tensor, reduce_dims)
+    batched_min_val, batched_max_val = batched.calculate_mse_min_max(
+        tensor, reduce_dims
+    )
+
+    assert torch.equal(min_val, batched_min_val)
+    assert torch.equal(max_val, batched_max_val)
+
+
+def test_mse_observer_search_memory_large_tensor(monkeypatch):
+    # larger than MSE_SEARCH_MEMORY, which alone would fit one candidate at a time
+    tensor = torch.randn(2048, 2560)
+    assert tensor.numel() * tensor.element_size() > MSE_SEARCH_MEMORY
+    weights = QuantizationArgs(num_bits=4, strategy="channel")
+
+    free_memory = 2**31
+    monkeypatch.setattr(
+        psutil, "virtual_memory", lambda: SimpleNamespace(available=free_memory)
+    )
+    # a coarse grid keeps the sequential search short
+    observer = MovingAverageMSEObserver(weights, grid=20.0)
+    num_candidates = int(observer.maxshrink * observer.grid)
+    chunk_size = observer._get_chunk_size(tensor, num_candidates)
+    candidate_size = tensor.numel() * tensor.element_size() * MSE_CANDIDATE_COPIES
+    assert chunk_size == int(free_memory * MSE_SEARCH_MEMORY_FRACTION) // candidate_size
+    assert 1 < chunk_size < num_candidates
+
+    sequential = MovingAverageMSEObserver(weights, grid=20.0, search_memory=1)
+    min_val, max_val = observer.calculate_mse_min_max(tensor, (1,))
+    sequential_min_val, sequential_max_val = sequential.calculate_mse_min_max(
+        tensor, (1,)
+    )
+    assert torch.equal(min_val, sequential_min_val)
+    assert torch.equal(max_val, sequential_max_val)
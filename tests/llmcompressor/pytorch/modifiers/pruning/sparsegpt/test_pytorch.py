@@ -86,6 +86,26 @@ class TestCreateDefaultQuantModifier(unittest.TestCase):
         assert should_be_default_quant_scheme.weights is None
 
 
+@pytest.mark.unit
+class TestForwardTokenSamplingArgs(unittest.TestCase):
+    def setUp(self):
+        setup_modifier_factory()
+
+    @parameterized.expand([[0], [7]])
+    def test_forward_token_sampling_args(self, seed):
+        modifier = GPTQModifier(
+            token_sample_rate=0.5, max_observed_tokens=64, token_sampling_seed=seed
+        )
+
+        testing_harness = LifecyleTestingHarness(model=LinearNet())
+        modifier.on_initialize_structure(testing_harness.get_state())
+        quantization_modifier = modifier.quantization_modifier_
+        assert quantization_modifier.token_sample_rate == 0.5
+        assert quantization_modifier.max_observed_tokens == 64
+        assert quantization_modifier.token_sampling_seed == seed
+        assert "token_sampling_seed" in quantization_modifier.model_fields_set
+
+
 @pytest.mark.unit
 class TestSetQuantIfModifierAlreadyExists(unittest.TestCase):
     def setUp(self):
@@ -1,9 +1,25 @@
+from types import SimpleNamespace
+
+import pyarrow
 import pytest
+import torch
+from datasets import Dataset, IterableDataset
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
 
+from llmcompressor.transformers.finetune.data import TextGenerationDataset, data_helpers
 from llmcompressor.transformers.finetune.data.data_args import DataTrainingArguments
 from llmcompressor.transformers.finetune.data.data_helpers import (
+    LABELS_MASK_VALUE,
+    SequencePacker,
+    format_calibration_data,
     get_raw_dataset,
+    load_tokenized_dataset,
     make_dataset_splits,
+    pack_dataset,
+    sample_iterable_dataset,
+    save_tokenized_dataset,
+    select_calibration_tokens,
 )
 
 
@@ -53,3 +69,314 @@ def test_separate_datasets():
         split_datasets = make_dataset_splits(
             datasets, do_train=True, do_eval=True, do_predict=True
         )
+
+
+@pytest.mark.unit
+def test_format_calibration_data_batched():
+    lengths = [5, 2, 7, 3, 6]
+    dataset = Dataset.from_dict(
+        {
+            "input_ids": [list(range(1, length + 1)) for length in lengths],
+            "attention_mask": [[1] * length for length in lengths],
+        }
+    )
+
+    dataloader = format_calibration_data(dataset, do_shuffle=False, batch_size=2)
+    batches = list(dataloader)
+    assert [batch["input_ids"].shape[0] for batch in batches] == [2, 2, 1]
+
+    # samples are bucketed by length and right padded
+    assert batches[0]["input_ids"].tolist() == [[1, 2, 0], [1, 2, 3]]
+    assert batches[0]["attention_mask"].tolist() == [[1, 1, 0], [1, 1, 1]]
+    assert batches[1]["attention_mask"].sum(dim=1).tolist() == [5, 6]
+    assert batches[2]["input_ids"].shape == (1, 7)
+
+
+def _word_tokenizer(words):
+    vocab = {word: index for index, word in enumerate(["<unk>", "<pad>"] + words)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<pad>"
+    )
+
+
+@pytest.mark.unit
+def test_tokenized_dataset_cache(tmp_path):
+    dataset = Dataset.from_dict({"text": ["a b c", "b c", "c a b a"]})
+    tokenizer = _word_tokenizer(["a", "b", "c"])
+
+    def get_fingerprint(tokenizer=tokenizer, **kwargs):
+        data_args = DataTrainingArguments(dataset=dataset, **kwargs)
+        dataset_manager = TextGenerationDataset.load_from_registry(
+            "custom", data_args=data_args, split=None, tokenizer=tokenizer
+        )
+        return dataset_manager, dataset_manager.get_fingerprint()
+
+    dataset_manager, fingerprint = get_fingerprint()
+    assert get_fingerprint()[1] == fingerprint
+    assert get_fingerprint(max_seq_length=8)[1] != fingerprint
+    assert get_fingerprint(concatenate_data=True)[1] != fingerprint
+    assert get_fingerprint(tokenizer=_word_tokenizer(["c", "b", "a"]))[1] != fingerprint
+    assert get_fingerprint(streaming=True)[1] is None
+
+    assert load_tokenized_dataset(str(tmp_path), fingerprint) is None
+    tokenized = dataset_manager.tokenize_and_process()
+    # tokenizing doesn't change the fingerprint of the tokenizer
+    assert dataset_manager.get_fingerprint() == fingerprint
+    save_tokenized_dataset(tokenized, str(tmp_path), fingerprint)
+    # storing the same dataset again replaces the entry
+    save_tokenized_dataset(tokenized, str(tmp_path), fingerprint)
+    assert [path.name for path in tmp_path.iterdir()] == [fingerprint]
+
+    cached = load_tokenized_dataset(str(tmp_path), fingerprint)
+    assert cached.column_names == tokenized.column_names
+    assert cached["input_ids"] == tokenized["input_ids"]
+    assert cached["labels"] == tokenized["labels"]
+
+
+@pytest.mark.unit
+def test_packing_code_fingerprint(monkeypatch):
+    data_args = DataTrainingArguments(dataset=Dataset.from_dict({"text": ["a b"]}))
+    dataset_manager = TextGenerationDataset.load_from_registry(
+        "custom", data_args=data_args, split=None, tokenizer=_word_tokenizer(["a"])
+    )
+    fingerprint = dataset_manager.get_fingerprint()
+
+    # changes to the packing and labelling helpers invalidate cached datasets
+    monkeypatch.setattr(data_helpers, "LABELS_MASK_VALUE", -1)
+    assert dataset_manager.get_fingerprint() != fingerprint
+
+
+@pytest.mark.unit
+def test_hub_dataset_fingerprint(monkeypatch):
+    commits = {"main": "a" * 40, "v1": "b" * 40}
+    requested = []
+
+    def dataset_info(name, revision=None):
+        requested.append(revision)
+        if revision is None:
+            revision = "main"
+        if revision not in commits:
+            raise ConnectionError("offline")
+        return SimpleNamespace(sha=commits[revision])
+
+    monkeypatch.setattr(data_helpers, "dataset_info", dataset_info)
+
+    def get_fingerprint(revision=None):
+        raw_kwargs = {} if revision is None else {"revision": revision}
+        data_args = DataTrainingArguments(dataset="org/data", raw_kwargs=raw_kwargs)
+        dataset_manager = TextGenerationDataset.load_from_registry(
+            "custom", data_args=data_args, split=None, tokenizer=_word_tokenizer([])
+        )
+        return dataset_manager.get_fingerprint()
+
+    fingerprint = get_fingerprint()
+    assert fingerprint is not None
+    assert get_fingerprint() == fingerprint
+    assert get_fingerprint("v1") not in (None, fingerprint)
+
+    # an update to the main branch changes the fingerprint of unpinned datasets
+    commits["main"] = "c" * 40
+    assert get_fingerprint() != fingerprint
+
+    # commits are used without a request, revisions which can't be resolved
+    # aren't cached
+    requested.clear()
+    assert get_fingerprint("d" * 40) is not None
+    assert requested == []
+    assert get_fingerprint("missing") is None
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("streaming", [False, True])
+def test_pack_dataset(streaming):
+    lengths = [5, 2, 7, 0, 3, 6, 4]
+    documents = {
+        "input_ids": [list(range(100 * i, 100 * i + n)) for i, n in enumerate(lengths)],
+        "attention_mask": [[1] * length for length in lengths],
+        "prompt": [[1, 2, 3]] * len(lengths),
+    }
+    dataset = Dataset.from_dict(documents)
+    if streaming:
+        dataset = dataset.to_iterable_dataset()
+
+    block_size = 4
+    # small batches, so that tokens are carried over between batches
+    packed = pack_dataset(dataset, block_size, add_position_ids=True, batch_size=2)
+    if streaming:
+        # a second pass doesn't start with the tail of the first
+        assert list(packed) == list(packed)
+    packed = list(packed)
+
+    tokens = sum(documents["input_ids"], [])
+    num_blocks = len(tokens) // block_size
+    assert len(packed) == num_blocks
+    assert [block["input_ids"] for block in packed] == [
+        tokens[i * block_size : (i + 1) * block_size] for i in range(num_blocks)
+    ]
+    assert all(block["attention_mask"] == [1] * block_size for block in packed)
+    assert all("prompt" not in block for block in packed)
+
+    # positions restart at the start of each document and block
+    assert [block["position_ids"] for block in packed] == [
+        [0, 1, 2, 3],
+        [0, 0, 1, 0],
+        [0, 1, 2, 3],
+        [0, 1, 0, 1],
+        [0, 0, 1, 2],
+        [0, 1, 2, 0],
+    ]
+
+
+@pytest.mark.unit
+def test_sequence_packer_restarts():
+    batches = [
+        pyarrow.table({"input_ids": [[1, 2, 3], [4, 5]]}),
+        pyarrow.table({"input_ids": [[6, 7, 8]]}),
+    ]
+    packer = SequencePacker(4)
+
+    first_pass = [packer(batches[0], [0, 1]), packer(batches[1], [2])]
+    assert first_pass[0]["input_ids"].to_pylist() == [[1, 2, 3, 4]]
+    assert first_pass[1]["input_ids"].to_pylist() == [[5, 6, 7, 8]]
+
+    # the tokens carried over from the end of the first pass are discarded
+    packer(pyarrow.table({"input_ids": [[9]]}), [3])
+    assert packer(batches[0], [0, 1]).equals(first_pass[0])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("pad_to_max_length", [True, False])
+def test_tokenize_and_process_labels(pad_to_max_length):
+    dataset = Dataset.from_dict(
+        {"text": ["a b c", "c a b a b", "b"], "prompt": ["a", "c a b a b c", ""]}
+    )
+    data_args = DataTrainingArguments(
+        dataset=dataset, max_seq_length=4, pad_to_max_length=pad_to_max_length
+    )
+    dataset_manager = TextGenerationDataset.load_from_registry(
+        "custom",
+        data_args=data_args,
+        split=None,
+        tokenizer=_word_tokenizer(["a", "b", "c"]),
+    )
+    tokenized = dataset_manager.tokenize_and_process()
+
+    # prompts and padding are masked out of the labels
+    mask = LABELS_MASK_VALUE
+    expected = [[mask, 3, 4, mask], [mask, mask, mask, mask], [3, mask, mask, mask]]
+    if not pad_to_max_length:
+        expected = [[mask, 3, 4], [mask, mask, mask, mask], [3]]
+
+    assert "prompt" not in tokenized.column_names
+    assert tokenized["labels"] == expected
+    assert tokenized.features["labels"].feature.dtype == "int64"
+
+
+@pytest.mark.unit
+def test_tokenize_streamed_dataset_columns():
+    def generate_examples():
+        yield {"text": "a b c", "meta": {"id": 0}}
+        yield {"text": "c a b a b", "meta": {"id": 1}}
+
+    # the features of generated streams are unknown until they are streamed
+    dataset = IterableDataset.from_generator(generate_examples)
+    assert dataset.column_names is None
+
+    data_args = DataTrainingArguments(
+        dataset=dataset, streaming=True, pad_to_max_length=False
+    )
+    dataset_manager = TextGenerationDataset.load_from_registry(
+        "custom",
+        data_args=data_args,
+        split=None,
+        tokenizer=_word_tokenizer(["a", "b", "c"]),
+    )
+    tokenized = dataset_manager.tokenize_and_process()
+
+    # raw columns of streamed datasets are removed, so examples can be passed to the
+    # model as keyword arguments
+    examples = list(tokenized)
+    for example in examples:
+        assert "meta" not in example and "text" not in example
+    assert [example["input_ids"] for example in examples] == [
+        [2, 3, 4],
+        [4, 2, 3, 2, 3],
+    ]
+
+
+@pytest.mark.unit
+def test_select_calibration_tokens():
+    lengths = [3, 2, 5, 1]
+    dataset = Dataset.from_dict(
+        {
+            "input_ids": [
+                list(range(10 * i, 10 * i + n)) + [0] * (5 - n)
+                for i, n in enumerate(lengths)
+            ],
+            "attention_mask": [[1] * n + [0] * (5 - n) for n in lengths],
+            "prompt": [[1]] * len(lengths),
+        }
+    )
+
+    # padding is stripped, the last sample is truncated to the budget and long
+    # samples are split
+    selected = select_calibration_tokens(
+        dataset, num_tokens=9, sequence_length=2, do_shuffle=False
+    )
+    assert selected.column_names == ["input_ids", "attention_mask"]
+    assert selected["input_ids"] == [[0, 1], [2], [10, 11], [20, 21], [22, 23]]
+    assert all(all(mask) for mask in selected["attention_mask"])
+
+    # the order is random but reproducible
+    first = select_calibration_tokens(dataset, num_tokens=6, seed=0)["input_ids"]
+    second = select_calibration_tokens(dataset, num_tokens=6, seed=0)["input_ids"]
+    assert first == second
+    assert sum(len(sample) for sample in first) == 6
+
+    def get_batches(seed):
+        dataloader = format_calibration_data(
+            dataset, num_calibration_tokens=8, batch_size=2, seed=seed
+        )
+        return [(batch["input_ids"], batch["attention_mask"]) for batch in dataloader]
+
+    batches = get_batches(seed=1)
+    for (input_ids, mask), (other_input_ids, _) in zip(batches, get_batches(seed=1)):
+        assert torch.equal(input_ids, other_input_ids)
+    assert sum(mask.sum() for _, mask in batches) == 8
+
+
+@pytest.mark.unit
+def test_sample_iterable_dataset():
+    lengths = [(i % 5) + 1 for i in range(100)]
+    dataset = Dataset.from_dict(
+        {
+            "input_ids": [[i] * n + [0] * (5 - n) for i, n in enumerate(lengths)],
+            "attention_mask": [[1] * n + [0] * (5 - n) for n in lengths],
+        }
+    )
+    stream = dataset.to_iterable_dataset()
+
+    sampled = sample_iterable_dataset(stream, num_samples=10, seed=0)
+    assert len(sampled) == 10
+    assert (
+        sampled["input_ids"]
+        == sample_iterable_dataset(stream, num_samples=10, seed=0)["input_ids"]
+    )
+    assert len({ids[0] for ids in sampled["input_ids"]}) == 10
+
+    # the budget is reached, and no sample could be dropped while meeting it
+    sampled = sample_iterable_dataset(stream, num_tokens=30, seed=0)
+    tokens = [sum(mask) for mask in sampled["attention_mask"]]
+    assert sum(tokens) >= 30 and sum(tokens[:-1]) < 30
+
+    # without shuffling, the start of the stream is taken
+    sampled = sample_iterable_dataset(stream, num_tokens=6, do_shuffle=False)
+    assert sampled["input_ids"] == dataset.select(range(3))["input_ids"]
+
+    # streamed calibration data is tokenized and sampled without storing the stream
+    dataloader = format_calibration_data(
+        stream, num_calibration_tokens=12, batch_size=2, seed=0
+    )
+    assert sum(batch["attention_mask"].sum() for batch in dataloader) == 12
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+
+import pytest
+import torch
+
+from llmcompressor.utils.pytorch.module import (
+    get_layer,
+    get_layers,
+    get_matching_layer,
+    get_params,
+    set_layer,
+)
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(4)
+        self.q_proj = torch.nn.Linear(4, 4)
+        self.k_proj = torch.nn.Linear(4, 4)
+
+
+def make_model(num_blocks: int = 12) -> torch.nn.Module:
+    blocks = [(f"block{index}", Block()) for index in range(num_blocks)]
+    return torch.nn.Sequential(OrderedDict(blocks))
+
+
+@pytest.mark.parametrize(
+    "targets,expected",
+    [
+        ("re:.*q_proj", [f"block{index}.q_proj" for index in range(12)]),
+        ("block3.k_proj", ["block3.k_proj"]),
+        ("Block", [f"block{index}" for index in range(12)]),
+        (
+            ["block1.norm", "re:block2\\..*proj"],
+            ["block1.norm", "block2.q_proj", "block2.k_proj"],
+        ),
+        ("block5.q_proj.bias", ["block5.q_proj"]),
+    ],
+)
+def test_get_layers(targets, expected):
+    model = make_model()
+    assert list(get_layers(targets, model)) == expected
+    # resolved from the cached index
+    assert list(get_layers(targets, model)) == expected
+
+
+def test_get_params():
+    model = make_model()
+    params = get_params(["re:block1\\..*weight"], model)
+    assert list(params) == ["block1.norm", "block1.q_proj", "block1.k_proj"]
+    assert params["block1.q_proj"] is model.block1.q_proj.weight
+
+    with pytest.raises(ValueError):
+        get_layers(["block1.q_proj", "missing"], model)
+
+
+def test_get_layers_module_tree_changes():
+    model = make_model()
+    get_layers("re:.*q_proj", model)
+
+    layer = torch.nn.Linear(4, 4)
+    set_layer("block1.q_proj", layer, model)
+    assert get_layers("re:.*q_proj", model)["block1.q_proj"] is layer
+
+    model.block2.v_proj = torch.nn.Linear(4, 4)
+    assert get_layer("block2.v_proj", model)[1] is model.block2.v_proj
+
+    # deleting modules is not tracked by the module tree version
+    del model.block3.q_proj
+    assert "block3.q_proj" not in get_layers("re:.*q_proj", model)
+
+
+def test_get_matching_layer():
+    model = make_model()
+    for index in range(12):
+        name, layer = get_matching_layer("re:.*q_proj", f"block{index}.norm", model)
+        assert name == f"block{index}.q_proj"
+        assert layer is getattr(model, f"block{index}").q_proj
+
+
+def test_get_params_replaced_without_hooks():
+    model = make_model()
+    assert get_params(["block1.q_proj.weight"], model)["block1.q_proj"] is (
+        model.block1.q_proj.weight
+    )
+
+    # offloading replaces parameters without calling registration hooks
+    weight = torch.nn.Parameter(torch.zeros(4, 4))
+    model.block1.q_proj._parameters["weight"] = weight
+    assert get_params(["block1.q_proj.weight"], model)["block1.q_proj"] is weight